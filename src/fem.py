@@ -1,7 +1,7 @@
 import numpy as np
 from scipy import sparse, linalg
 import numbers
-from mesh import QuadCell, Edge, Vertex
+from mesh import QuadCell, Edge, Vertex, LinearQuadtree
 from bisect import bisect_left       
 from _operator import index
 from itertools import count
@@ -1097,6 +1097,34 @@ class Function(object):
         return self.__f
     
     
+    def eval_matrix(self, x, derivative=(0,), node=None):
+        """
+        Return the sparse matrix mapping the function's nodal values to its 
+        values (or those of its derivatives) at a set of points, so that 
+        repeated evaluations at the same points, e.g. of all samples, reduce 
+        to a sparse-dense product.
+        
+        Inputs:
+        
+            x: double, (n_points, dim) array of points
+            
+            derivative: tuple, (order,i,j) specifying the derivative
+            
+            node: Node, containing all points x (optional)
+            
+        Output:
+        
+            E: double, (n_points, n_dofs) sparse matrix, with columns ordered
+                as self.global_dofs(), so that E.dot(self.fn()) are the 
+                function values at x.
+        """
+        assert self.fn_type() == 'nodal', \
+            'Evaluation matrices are only defined for nodal functions.'
+        E = self.dofhandler.eval_matrix(x, derivative=derivative, node=node,
+                                        flag=self.__flag)
+        return E[:,self.__global_dofs]
+    
+    
     def eval(self, x, node=None, derivative=(0,), samples='all'):
         """
         Evaluate function at an array of points x
@@ -1180,7 +1208,7 @@ class Function(object):
         # ---------------------------------------------------------------------
         # Parse sample size
         # ---------------------------------------------------------------------
-        if samples is not 'all':
+        if not (isinstance(samples, str) and samples == 'all'):
             if type(samples) is int:
                 sample_size = 1
             else:
@@ -1218,68 +1246,26 @@ class Function(object):
     
         elif self.fn_type() == 'nodal':
             #
-            # Initialize output array
-            #
-            n_samples = self.n_samples()
-            if n_samples is None:
-                f_vec = np.empty(x.shape[0])
-            elif samples is 'all':
-                f_vec = np.empty((x.shape[0],n_samples))
-            else:
-                f_vec = np.empty((x.shape[0],sample_size))    
-                
-            #
-            # Determine tree nodes to traverse
+            # Evaluation matrix
             # 
-            if node is None:
-                node_list = self.dofhandler.mesh.root_node().find_leaves(flag=flag)
-            else:
+            if node is not None:
                 assert all(node.quadcell().contains_point(x)), \
                 'Node specified, but not all points contained in node.'
-                node_list = [node]
-            #
-            # Evaluate function on each node
-            #
-            for node in node_list:
-                #
-                # Evaluate function at local dofs 
-                # 
-                idx_node = [self.__global_dofs.index(i) for i in \
-                            self.dofhandler.get_global_dofs(node)]  
-                if self.n_samples() is None:
-                    f_loc = self.__f[idx_node]
-                elif samples is 'all':
-                    f_loc = self.__f[idx_node,:]
-                else:
-                    f_loc = self.__f[np.ix_(idx_node, samples)]
-    
-                #
-                # Evaluate shape function at x-values
-                #   
-                cell = node.quadcell()  # TODO: Only works in 2d
-                in_cell = cell.contains_point(x)
-                x_loc = x[in_cell,:]
-                x_ref = cell.map_to_reference(x_loc)
-                phi = self.dofhandler.element.shape(x_ref, derivatives=derivative)
-                #
-                # Update output vector
-                # 
-                if n_samples is None:
-                    f_vec[in_cell] = np.dot(phi, f_loc)
-                else:
-                    f_vec[in_cell,:] = np.dot(phi, f_loc)
-                                                                     
+            E = self.eval_matrix(x, derivative=derivative, node=node)
             #
-            # Determine multiplier for derivatives (chain rule)
+            # Sparse-dense product 
             # 
-            c = cell.derivative_multiplier(derivative)
-            f_vec *= c
+            if self.n_samples() is None or \
+                (isinstance(samples, str) and samples == 'all'):
+                f_vec = E.dot(self.__f)
+            else:
+                f_vec = E.dot(self.__f[:,samples])
         elif self.fn_type() == 'constant':
             n_samples = self.n_samples()
             
             if n_samples is None:
                 f_vec = self.fn()*np.ones((x.shape[0]))
-            elif samples == 'all':
+            elif isinstance(samples, str) and samples == 'all':
                 one = np.ones((x.shape[0], n_samples))
                 f_vec = np.dot(one, self.fn())
             else:
@@ -1487,12 +1473,18 @@ class DofHandler(object):
     def __init__(self, mesh, element):
         """
         Constructor
+        
+        Note: The dofs of a LinearQuadtree mesh are distributed directly 
+            from its Morton keys (see distribute_dofs_vectorized). Methods 
+            that refer to Node objects (get_global_dofs, fill_dofs, 
+            share_dofs_with_neighbors, etc.) require a Mesh.
         """
         self.element = element
         self.mesh = mesh
         self.__global_dofs = {}
         self.__hanging_nodes = {}
         self.__dof_count = 0
+        self.__cell_dofs = None
         
     
     def clear_dofs(self):
@@ -1501,22 +1493,38 @@ class DofHandler(object):
         """
         self.__global_dofs = {}
         self.__dof_count = 0
+        self.__cell_dofs = None
         
                 
-    def distribute_dofs(self, nested=False):
+    def distribute_dofs(self, nested=False, vectorized=False):
         """
         global enumeration of degrees of freedom
         
+        Inputs:
+        
+            nested: bool, distribute dofs on all nodes of the tree (True), 
+                or only on the LEAF nodes (False).
+                
+            vectorized: bool, distribute the LEAF nodes' dofs by means of 
+                array operations (see distribute_dofs_vectorized).
+        
         Note: When root's children are in a grid, then the root has no DOFs 
+        
+        Note: The dofs of a LinearQuadtree are always distributed vectorized.
         """
         #
         # Ensure the mesh is balanced
         # 
         assert self.mesh.is_balanced(), \
             'Mesh must be balanced before dofs can be distributed.'
+        
+        if vectorized or isinstance(self.mesh, LinearQuadtree):
+            assert not nested, \
+                'Vectorized distribution only applies to LEAF nodes.'
+            self.distribute_dofs_vectorized()
             
-        if not nested:
-            for node in self.mesh.root_node().find_leaves():
+        elif not nested:
+            for node in self.mesh.nodes():
                 # 
                 # Fill in own nodes
                 # 
@@ -1554,6 +1562,128 @@ class DofHandler(object):
                     # Share dofs with children
                     # 
                     self.share_dofs_with_children(node)
+    
+    
+    def distribute_dofs_vectorized(self):
+        """
+        Enumerate the degrees of freedom of all LEAF nodes at once.
+        
+        The nodes of all cells are mapped onto integer coordinates on a grid
+        of the finest level, which identifies coinciding nodes of adjacent 
+        cells (for continuous elements). Dofs are numbered in the order in 
+        which they first occur in the list of leaves.
+        
+        Note: The resulting (n_cells, n_dofs) table of cell dofs and the 
+            dof coordinates are stored (see cell_dofs and dof_vertices). For
+            a Mesh, the dictionary of global dofs is filled from the table, 
+            so the rest of the DofHandler's methods apply as before. A 
+            LinearQuadtree is used as is, without constructing Nodes.
+        """
+        if isinstance(self.mesh, LinearQuadtree):
+            leaves, tree = None, self.mesh
+        else:
+            leaves, tree = self.mesh.nodes(), self.mesh.linear_quadtree()
+        boxes = tree.boxes()
+        x_ref = np.array(self.element.reference_nodes(), dtype=float)
+        n_cells, n_dofs_loc = tree.n_cells(), x_ref.shape[0]
+        #
+        # Physical coordinates of all cell nodes
+        # 
+        hx = boxes[:,1] - boxes[:,0]
+        hy = boxes[:,3] - boxes[:,2]
+        x = np.empty((n_cells, n_dofs_loc, 2))
+        x[:,:,0] = boxes[:,[0]] + hx[:,np.newaxis]*x_ref[:,0]
+        x[:,:,1] = boxes[:,[2]] + hy[:,np.newaxis]*x_ref[:,1]
+        if self.element.torn_element():
+            #
+            # Discontinuous elements: no shared dofs 
+            # 
+            cell_dofs = np.arange(n_cells*n_dofs_loc)
+            first = cell_dofs
+        else:
+            #
+            # Integer coordinates of nodes, in units of 1/p of the finest cells
+            # 
+            p = self.element.polynomial_degree()
+            level = tree.max_level()
+            levels = tree.levels()
+            i, j = tree.decode(tree.keys(), levels)
+            scale = (np.int64(1) << (level - levels))[:,np.newaxis]
+            r = np.round(x_ref*p).astype(np.int64)
+            ii = scale*(p*i[:,np.newaxis] + r[:,0])
+            jj = scale*(p*j[:,np.newaxis] + r[:,1])
+            nx = 1 if tree.grid_size() is None else tree.grid_size()[0] 
+            n_i = (p*nx << level) + 1
+            #
+            # Identify coinciding nodes
+            # 
+            _, first, inverse = np.unique((jj*n_i + ii).ravel(), 
+                                          return_index=True, 
+                                          return_inverse=True)
+            #
+            # Number dofs in order of first occurrence
+            # 
+            order = np.argsort(first)
+            rank = np.empty(len(first), dtype=np.int64)
+            rank[order] = np.arange(len(first))
+            cell_dofs = rank[inverse]
+            first = first[order]
+        cell_dofs = cell_dofs.reshape(n_cells, n_dofs_loc).astype(np.int32)
+        #
+        # Store dofs, together with the state of the mesh they refer to
+        #
+        if leaves is None:
+            state = tree.keys()
+        else:
+            self.__global_dofs = dict(zip(leaves, cell_dofs.tolist()))
+            state = self.mesh.root_node().modification_count()
+        self.__dof_count = len(first)
+        self.__dof_coordinates = x.reshape(-1,2)[first]
+        self.__cell_dofs = (state, cell_dofs)
+        
+        
+    def __cell_dofs_current(self):
+        """
+        Determine whether the table stored by distribute_dofs_vectorized 
+        refers to the current mesh, i.e. whether the Mesh has not been 
+        modified since, or the LinearQuadtree still holds the same keys 
+        (refine and coarsen replace the array of keys). 
+        """
+        if self.__cell_dofs is None:
+            return False
+        state = self.__cell_dofs[0]
+        if isinstance(self.mesh, LinearQuadtree):
+            return state is self.mesh.keys()
+        else:
+            return state == self.mesh.root_node().modification_count()
+        
+        
+    def cell_dofs(self, flag=None):
+        """
+        Return the table of global dofs of the (flagged) LEAF nodes 
+        
+        Inputs:
+        
+            flag: str/int, marker restricting the mesh
+            
+        Output:
+        
+            cell_dofs: int32, (n_cells, n_dofs) array whose ith row contains
+                the global dofs of the ith node in mesh.nodes(flag=flag).
+        """
+        if flag is None and self.__cell_dofs_current():
+            #
+            # Table computed by vectorized distribution
+            # 
+            return self.__cell_dofs[1]
+        else:
+            assert not isinstance(self.mesh, LinearQuadtree), \
+                'Redistribute dofs after modifying the LinearQuadtree '+\
+                '(no flags).'
+            leaves = self.mesh.nodes(flag=flag)
+            cell_dofs = [self.__global_dofs[leaf] for leaf in leaves]
+            return np.array(cell_dofs, dtype=np.int32).reshape(\
+                len(leaves), self.element.n_dofs())
             
     
     def share_dofs_with_children(self, node):
@@ -1966,7 +2096,7 @@ class DofHandler(object):
             # No node specified, return all dofs of (sub)mesh
             # 
             mesh_dofs = set()
-            for leaf in self.mesh.root_node().find_leaves(flag=flag):
+            for leaf in self.mesh.nodes(flag=flag):
                 mesh_dofs = mesh_dofs.union(self.__global_dofs[leaf])
             return list(mesh_dofs)
             
@@ -1984,7 +2114,7 @@ class DofHandler(object):
             # Count dofs explicitly
             # 
             dof_set = set()
-            for node in self.mesh.root_node().find_leaves(flag=flag):
+            for node in self.mesh.nodes(flag=flag):
                 dof_set.update(self.get_global_dofs(node))
             return len(dof_set)
             
@@ -1999,7 +2129,12 @@ class DofHandler(object):
             'First distribute dofs.'
         rule = GaussRule(1,shape='quadrilateral')
         x_ref = self.element.reference_nodes()
-        if node is not None:
+        if node is None and flag is None and self.__cell_dofs_current():
+            #
+            # Coordinates computed by vectorized distribution
+            # 
+            return self.__dof_coordinates
+        elif node is not None:
             #
             # Vertices corresponding to a single Node->QuadCell
             # 
@@ -2009,14 +2144,95 @@ class DofHandler(object):
             #
             # Vertices over entire mesh
             # 
+            assert not isinstance(self.mesh, LinearQuadtree), \
+                'Redistribute dofs after modifying the LinearQuadtree '+\
+                '(no flags).'
             x = np.empty((self.n_dofs(),2))
             x.fill(np.nan)
             
-            for leaf in self.mesh.root_node().find_leaves(flag=flag):
+            for leaf in self.mesh.nodes(flag=flag):
                 g_dofs = self.get_global_dofs(leaf)
                 x[g_dofs,:] = rule.map(leaf.quadcell(),x=x_ref)
         return x[np.logical_not(np.isnan(x[:,0])),:]
     
+    
+    def eval_matrix(self, x, derivative=(0,), node=None, flag=None, 
+                    tie_break='upper'):
+        """
+        Return the sparse matrix mapping the global dof values of a finite 
+        element function to its values (or those of its partial derivatives)
+        at a set of points.
+        
+        Inputs:
+        
+            x: double, (n_points, 2) array (or list) of points
+            
+            derivative: tuple, (order,i,j) specifying the derivative
+            
+            node: Node, cell containing all points. If None, the points are 
+                located in the (sub)mesh.
+                
+            flag: str/int, marker restricting mesh
+            
+            tie_break: str, rule for points on shared edges, 'upper' or 
+                'lower' (see Mesh.locate_points)
+                
+        Output:
+        
+            E: double, (n_points, n_dofs) sparse CSR matrix, whose ith row
+                contains the (derivatives of the) shape functions of the cell
+                containing the ith point, evaluated at that point. Rows of 
+                points outside of the (sub)mesh are zero.
+                
+        Note: Given the matrix, evaluating (all samples of) a function at the
+            points reduces to the sparse-dense product E.dot(f).
+        """
+        assert hasattr(self, '_DofHandler__dof_count'), \
+            'First distribute dofs.'
+        x = np.array(x, dtype=float).reshape(-1,2)
+        n_points = x.shape[0]
+        #
+        # Locate points
+        # 
+        if node is None:
+            leaves = self.mesh.nodes(flag=flag)
+            cell_index = self.mesh.locate_points(x, flag=flag, 
+                                                 tie_break=tie_break)
+        else:
+            leaves = [node]
+            cell_index = np.zeros(n_points, dtype=int)
+        points = np.nonzero(cell_index >= 0)[0]
+        cells, inverse = np.unique(cell_index[points], return_inverse=True)
+        #
+        # Dofs and boxes of the cells containing points
+        # 
+        n_dofs_loc = self.element.n_dofs()
+        if node is None:
+            cell_dofs = self.cell_dofs(flag=flag)[cells]
+        else:
+            cell_dofs = np.array([self.get_global_dofs(node)], dtype=int)
+        boxes = np.array([leaves[i].quadcell().box() for i in cells], 
+                         dtype=float).reshape(len(cells), 4)[inverse]
+        hx = boxes[:,1] - boxes[:,0]
+        hy = boxes[:,3] - boxes[:,2]
+        #
+        # Evaluate shape functions at the reference points
+        # 
+        x_ref = np.array([(x[points,0]-boxes[:,0])/hx, 
+                          (x[points,1]-boxes[:,2])/hy]).T
+        phi = self.element.shape(x_ref, derivatives=derivative)
+        #
+        # Chain rule
+        # 
+        if derivative[0] in {1,2}:
+            for i in derivative[1:]:
+                phi /= (hx if i==0 else hy)[:,np.newaxis]
+        rows = np.repeat(points, n_dofs_loc)
+        cols = cell_dofs[inverse].ravel()
+        E = sparse.coo_matrix((phi.ravel(), (rows, cols)), 
+                              shape=(n_points, self.n_dofs()))
+        return E.tocsr()
+    
                 
     def set_hanging_nodes(self):
         """
@@ -2077,6 +2293,50 @@ class DofHandler(object):
             return self.__hanging_nodes
         
         
+    def constraint_matrix(self):
+        """
+        Returns the sparse prolongation matrix C, mapping the values of the 
+        free (non-hanging) dofs to those of all dofs, so that u = C*u_free.
+        
+        Outputs:
+        
+            C: double, (n_dofs, n_free) sparse CSR matrix whose rows of free 
+                dofs are those of the identity, and whose rows of hanging 
+                dofs contain the coefficients of their supporting dofs, i.e.
+                
+                u_hn = cs_1*u_{is_1} + ... + cs_k*u_{is_k}.
+                
+            free_dofs: int, (n_free,) array of free dofs, in increasing order.
+                The jth column of C corresponds to free_dofs[j].
+        """
+        hanging_nodes = self.get_hanging_nodes()
+        n_dofs = self.n_dofs()
+        is_hanging = np.zeros(n_dofs, dtype=bool)
+        is_hanging[list(hanging_nodes.keys())] = True
+        free_dofs = np.nonzero(~is_hanging)[0]
+        #
+        # Column index of each free dof
+        #
+        free_index = -np.ones(n_dofs, dtype=int)
+        free_index[free_dofs] = np.arange(len(free_dofs))
+        #
+        # Identity rows for the free dofs, constraint rows for hanging dofs
+        # 
+        rows, cols, vals = [free_dofs], [np.arange(len(free_dofs))], \
+                           [np.ones(len(free_dofs))]
+        for hn, (supports, coefficients) in hanging_nodes.items():
+            supports = np.array(supports, dtype=int)
+            assert all(free_index[supports] >= 0), \
+                'Hanging nodes should be supported by free dofs.'
+            rows.append(hn*np.ones(len(supports), dtype=int))
+            cols.append(free_index[supports])
+            vals.append(np.array(coefficients, dtype=float))
+        C = sparse.coo_matrix((np.concatenate(vals), 
+                               (np.concatenate(rows), np.concatenate(cols))),
+                              shape=(n_dofs, len(free_dofs)))
+        return C.tocsr(), free_dofs
+        
+        
 class GaussRule(object):
     """
     Gaussian Quadrature weights and nodes on reference cell
@@ -2573,7 +2833,12 @@ class System(object):
                  'robin':[m_r,(gamma,g_r)], 'periodic':m_p}
                 where m_i maps a node/edge to a boolean and  
                 
-    
+        Note: A LinearQuadtree mesh is used directly, without constructing
+            Nodes: its cell boxes and dofs are computed from the Morton keys
+            (see cell_arrays). It supports the vectorized assembly (also 
+            by an Assembler) with Dirichlet conditions. Neumann and Robin 
+            conditions, as well as the cellwise methods (assemble without 
+            vectorization, interpolate, restrict, etc.), require a Mesh. 
         """
         self.__mesh = mesh
         self.__element = element
@@ -2590,6 +2855,8 @@ class System(object):
                       ('edge','E'): dict.fromkeys(dlist, None),
                       ('edge','S'): dict.fromkeys(dlist, None),
                       ('edge','N'): dict.fromkeys(dlist, None)}  
+        # Cache of local matrices for constant kernels
+        self.__element_matrices = {}
     
     
     def dofhandler(self):
@@ -2600,7 +2867,7 @@ class System(object):
     
     
     def assemble(self, bilinear_forms=None, linear_forms=None, 
-                 boundary_conditions=None):
+                 boundary_conditions=None, vectorized=False):
         """
         Assembles linear system associated with a weak form and accompanying
         boundary conditions. 
@@ -2628,6 +2895,10 @@ class System(object):
                     'neumann'  : -n.q*nabla(u) = d_bnd(x,y) on bnd
                     'robin'    : d_bnd = (gamma, g_rob), so that 
                                 -n.q*nabla(u) = gamma*(u(x,y)-d_bnd(x,y))
+                                
+            vectorized: bool [False], if True, the cell integrals of all 
+                leaves are computed simultaneously (see assemble_vectorized),
+                otherwise the cells are assembled one at a time.
             
         Outputs:
         
@@ -2640,7 +2911,11 @@ class System(object):
         
         TODO: Include support for tensors. 
         TODO: Include option to assemble multiple matrices     
-        """        
+        """
+        if vectorized:
+            return self.assemble_vectorized(bilinear_forms, linear_forms, 
+                                            boundary_conditions)
+        
         n_nodes = self.__dofhandler.n_dofs()
         n_dofs = self.__element.n_dofs()     
         #
@@ -2676,7 +2951,7 @@ class System(object):
         rows = []
         cols = []
         dir_dofs_encountered = set()
-        for node in self.__mesh.root_node().find_leaves():
+        for node in self.__mesh.nodes():
             node_dofs = self.__dofhandler.get_global_dofs(node)
             cell = node.quadcell()            
             #
@@ -2810,6 +3085,407 @@ class System(object):
             return tuple(out)
     
     
+    def assemble_vectorized(self, bilinear_forms=None, linear_forms=None, 
+                            boundary_conditions=None):
+        """
+        Assembles the linear system associated with a weak form by computing
+        the cell integrals over all leaves of the mesh simultaneously: Cell 
+        boxes and Jacobians are stacked into arrays, the kernels are 
+        evaluated at all quadrature points in a single call, and the local 
+        matrices are formed by a batched contraction over 
+        (cells x quadrature nodes x dofs). The global matrix is constructed 
+        from preallocated index arrays.
+        
+        Inputs: 
+        
+            bilinear_forms, linear_forms, boundary_conditions: see "assemble"
+            
+        Outputs:
+        
+            A: double coo_matrix, system matrix
+            
+            b: double, right hand side vector
+            
+        
+        Notes: 
+        
+            Neumann and Robin conditions only affect boundary cells and are 
+            added edge by edge. Dirichlet conditions are imposed on the 
+            assembled system by replacing the Dirichlet rows by those of the 
+            identity matrix and lifting the Dirichlet columns to the right 
+            hand side.
+        """
+        n_nodes = self.__dofhandler.n_dofs()
+        n_dofs = self.__element.n_dofs()
+        leaves, boxes, cell_dofs = self.cell_arrays()
+        bf_loc, lf_loc = self.assemble_local(bilinear_forms, linear_forms, 
+                                             boundary_conditions, leaves, 
+                                             boxes, cell_dofs)
+        #
+        # Local to global mapping
+        # 
+        rows = np.repeat(cell_dofs, n_dofs, axis=1).ravel()
+        cols = np.tile(cell_dofs, (1,n_dofs)).ravel()
+        A = sparse.coo_matrix((bf_loc.ravel(),(rows,cols)),\
+                              shape=(n_nodes,n_nodes))
+        b = np.bincount(cell_dofs.ravel(), weights=lf_loc.ravel(), \
+                        minlength=n_nodes)
+        
+        if boundary_conditions is not None and \
+        boundary_conditions.get('dirichlet', None) is not None:
+            #
+            # Dirichlet nodes
+            # 
+            is_dirichlet, u_dir = \
+                self.dirichlet_values(boundary_conditions['dirichlet'])
+            #
+            # Lift Dirichlet columns and replace Dirichlet rows 
+            # 
+            A = A.tocsr()
+            b -= A.dot(u_dir)
+            b[is_dirichlet] = u_dir[is_dirichlet]
+            not_dirichlet = sparse.diags(np.logical_not(is_dirichlet)*1.0)
+            A = not_dirichlet.dot(A.dot(not_dirichlet)) + \
+                sparse.diags(is_dirichlet*1.0)
+            A = A.tocoo()
+        #
+        # Return results
+        # 
+        out = []
+        if bilinear_forms is not None:
+            out.append(A) 
+        if linear_forms is not None:
+            out.append(b) 
+        if len(out) == 1:
+            return out[0]
+        elif len(out) == 2:
+            return tuple(out)
+        
+        
+    def assemble_local(self, bilinear_forms, linear_forms, 
+                       boundary_conditions, leaves, boxes, cell_dofs):
+        """
+        Computes the local (bi)linear forms, including Neumann and Robin 
+        boundary terms, over a collection of cells.
+        
+        Inputs:
+        
+            bilinear_forms, linear_forms, boundary_conditions: see "assemble"
+            
+            leaves, boxes, cell_dofs: see "cell_arrays"
+            
+        Outputs:
+        
+            bf_loc: double, (n_cells,n_dofs,n_dofs) local bilinear forms
+            
+            lf_loc: double, (n_cells,n_dofs) local linear forms
+        """
+        n_dofs = self.__element.n_dofs()
+        n_cells = boxes.shape[0]
+        #
+        # Local (bi)linear forms on all cells
+        #
+        bf_loc = np.zeros((n_cells,n_dofs,n_dofs))
+        if bilinear_forms is not None:
+            assert type(bilinear_forms) is list, \
+                'Bilinear form should be passed in list.'
+            for bf in bilinear_forms:
+                bf_loc += self.form_eval_batch(bf, boxes, cell_dofs)
+        
+        lf_loc = np.zeros((n_cells,n_dofs))
+        if linear_forms is not None:
+            for lf in linear_forms:
+                lf_loc += self.form_eval_batch(lf, boxes, cell_dofs)
+        
+        bc_neumann, bc_robin = None, None
+        if boundary_conditions is not None:
+            bc_neumann = boundary_conditions.get('neumann', None)
+            bc_robin = boundary_conditions.get('robin', None)
+        
+        if bc_neumann is not None or bc_robin is not None:
+            #
+            # Neumann and Robin edges
+            # 
+            assert leaves is not None, \
+                'Neumann and Robin conditions require a Mesh.'
+            for i in range(n_cells):
+                node = leaves[i]
+                cell = node.quadcell()
+                for direction in ['W','E','S','N']:
+                    edge = cell.get_edges(direction)
+                    neumann_edge = False
+                    if bc_neumann is not None:
+                        for m_neu, g_neu in bc_neumann:
+                            if m_neu(edge):
+                                neumann_edge = True
+                                lf_loc[i] += self.form_eval((g_neu,'v'), node,\
+                                                            edge_loc=direction)
+                                break
+                    if not neumann_edge and bc_robin is not None:
+                        for m_rob, data_rob in bc_robin:
+                            if m_rob(edge):
+                                gamma_rob, g_rob = data_rob
+                                bf_loc[i] += \
+                                    gamma_rob*self.form_eval((g_rob,'u','v'),\
+                                                             node,\
+                                                             edge_loc=direction)
+                                lf_loc[i] += \
+                                    gamma_rob*self.form_eval((g_rob,'v'),\
+                                                             node,\
+                                                             edge_loc=direction)
+                                break
+        return bf_loc, lf_loc
+    
+    
+    def dirichlet_values(self, bc_dirichlet):
+        """
+        Determine the Dirichlet dofs and their prescribed values
+        
+        Inputs:
+        
+            bc_dirichlet: list of tuples (m_dir, g_dir), see "assemble"
+            
+        Outputs:
+        
+            is_dirichlet: bool, (n_dofs,) vector marking Dirichlet dofs
+            
+            u_dir: double, (n_dofs,) vector, containing the Dirichlet values
+                at the Dirichlet dofs and zeros elsewhere.
+        """
+        n_nodes = self.__dofhandler.n_dofs()
+        x_dofs = self.__dofhandler.dof_vertices()
+        is_dirichlet = np.zeros(n_nodes, dtype=bool)
+        u_dir = np.zeros(n_nodes)
+        for m_dir, g_dir in bc_dirichlet:
+            on_bnd = m_dir(x_dofs[:,0],x_dofs[:,1])
+            if on_bnd.any():
+                u_dir[on_bnd] = g_dir(x_dofs[on_bnd,0],x_dofs[on_bnd,1])
+                is_dirichlet[on_bnd] = True
+        return is_dirichlet, u_dir
+        
+        
+    def constant_kernel(self, f):
+        """
+        Returns the value of a constant kernel, or None if the kernel is not
+        constant.
+        
+        Inputs:
+        
+            f: kernel (see "form_eval")
+        """
+        if isinstance(f, numbers.Real):
+            return f
+        elif isinstance(f, Function) and f.fn_type() == 'constant' \
+        and f.n_samples() is None:
+            return f.fn()
+        else:
+            return None
+        
+        
+    def element_matrix(self, hx, hy, form):
+        """
+        Returns the local (bi)linear form with unit kernel on a cell of 
+        given width and height. Since all cells of the same size have the 
+        same local matrices, these are computed once and cached. 
+        
+        Inputs:
+        
+            hx, hy: double, cell width and height
+            
+            form: str, tuple ('trial_type','test_type') or ('test_type',)
+            
+        Output:
+        
+            (n_dofs,n_dofs) bilinear- or (n_dofs,) linear form 
+        """
+        #
+        # Cells of the same size may differ by round-off (e.g. on 
+        # non-dyadic grids): key on sizes rounded to 12 significant digits
+        # 
+        hx, hy = float('%.12g' % hx), float('%.12g' % hy)
+        key = (hx, hy) + tuple(form)
+        if key not in self.__element_matrices:
+            box = np.array([[0, hx, 0, hy]])
+            kernel = (np.ones(self.__n_gauss_2d),)
+            self.__element_matrices[key] = \
+                self.form_eval_batch((kernel,)+tuple(form), box, None)[0]
+        return self.__element_matrices[key]
+        
+        
+    def cell_arrays(self, flag=None):
+        """
+        Returns the leaves of the mesh, together with arrays of their 
+        bounding boxes and global degrees of freedom.
+        
+        Inputs:
+        
+            flag: str/int, marker restricting the mesh
+            
+        Outputs:
+        
+            leaves: Node, list of LEAF nodes (in the order of find_leaves),
+                or None if the mesh is a LinearQuadtree.
+            
+            boxes: double, (n_cells,4) array whose rows are the cell boxes
+                (x0,x1,y0,y1)
+                
+            cell_dofs: int, (n_cells,n_dofs) array of global dofs, the ith 
+                row of which contains the dofs of the ith leaf.
+        """
+        if isinstance(self.__mesh, LinearQuadtree):
+            #
+            # Boxes from Morton keys
+            # 
+            assert flag is None, 'LinearQuadtree cells cannot be flagged.'
+            leaves, boxes = None, self.__mesh.boxes()
+        else:
+            leaves = self.__mesh.nodes(flag=flag)
+            boxes = np.array([leaf.quadcell().box() for leaf in leaves])
+        cell_dofs = self.__dofhandler.cell_dofs(flag=flag)
+        return leaves, boxes, cell_dofs
+    
+    
+    def f_eval_batch(self, f, boxes, cell_dofs):
+        """
+        Evaluates a kernel function at the quadrature nodes of a collection 
+        of cells.
+        
+        Inputs:
+        
+            f: kernel, either a function, a Function, a constant, a GLOBAL 
+                nodal vector, or a mesh function (one value per cell).
+                
+            boxes: double, (n_cells,4) array of cell boxes (x0,x1,y0,y1)
+            
+            cell_dofs: int, (n_cells,n_dofs) array of cell dofs
+            
+        Output:
+        
+            kernel: double, (n_cells,n_gauss) array of function values
+        """
+        n_cells = boxes.shape[0]
+        x_ref = self.__rule_2d.nodes()
+        n_gauss = x_ref.shape[0]
+        if isinstance(f, numbers.Real):
+            #
+            # f is a constant
+            # 
+            return f*np.ones((n_cells,n_gauss))
+        elif not isinstance(f, Function) and not callable(f) \
+        and len(f) == self.n_dofs():
+            #
+            # f is a global nodal vector
+            #
+            phi = self.shape_eval()
+            return np.dot(np.array(f)[cell_dofs], phi.T)
+        elif not isinstance(f, Function) and not callable(f) \
+        and len(f) == n_cells:
+            #
+            # f is a mesh function
+            # 
+            return np.outer(f, np.ones(n_gauss))
+        #
+        # Map quadrature nodes to all cells 
+        # 
+        x0, x1, y0, y1 = [boxes[:,i][:,np.newaxis] for i in range(4)]
+        x = np.empty((n_cells*n_gauss,2))
+        x[:,0] = (x0 + (x1-x0)*x_ref[:,0]).ravel()
+        x[:,1] = (y0 + (y1-y0)*x_ref[:,1]).ravel()
+        if isinstance(f, Function):
+            #
+            # f is a Function object
+            # 
+            f_vec = f.eval(x)
+        elif callable(f):
+            #
+            # f is a function
+            # 
+            f_vec = f(x[:,0],x[:,1])
+        else:
+            fn_type = str('Function type for {0} not recognized.'.format(f))
+            raise Exception(fn_type)
+        return np.reshape(f_vec, (n_cells,n_gauss))
+        
+        
+    def form_eval_batch(self, form, boxes, cell_dofs):
+        """
+        Evaluates a (bi)linear form on a collection of cells 
+        
+        Inputs:
+        
+            form: (bi)linear form as tuple (f,'trial_type','test_type'), 
+                see "form_eval". A precomputed kernel f = (kernel,) should be
+                an (n_gauss,) or (n_cells,n_gauss) array. 
+                
+            boxes: double, (n_cells,4) array of cell boxes (x0,x1,y0,y1)
+            
+            cell_dofs: int, (n_cells,n_dofs) array of cell dofs
+            
+        Outputs:
+        
+            (Bi)linear forms, as an (n_cells,) array (integrals), an 
+            (n_cells,n_dofs) array (linear forms) or an 
+            (n_cells,n_dofs,n_dofs) array (bilinear forms).
+        """
+        n_cells = boxes.shape[0]
+        hx = boxes[:,1]-boxes[:,0]
+        hy = boxes[:,3]-boxes[:,2]
+        f = form[0]
+        if len(form) > 1:
+            c = self.constant_kernel(f)
+            if c is not None:
+                #
+                # Constant kernel: look up element matrices by cell size 
+                # 
+                h, i_h = np.unique(np.array([hx,hy]).T, axis=0, 
+                                   return_inverse=True)
+                #
+                # Merge sizes that differ only by round-off
+                # 
+                h = np.array([[float('%.12g' % hi) for hi in hh] \
+                              for hh in h])
+                h, i_r = np.unique(h, axis=0, return_inverse=True)
+                i_h = i_r.ravel()[i_h.ravel()]
+                local = np.array([self.element_matrix(hxi, hyi, form[1:]) \
+                                  for hxi, hyi in h])
+                return c*local[i_h]
+        #
+        # Quadrature weights times kernel
+        #  
+        if type(f) is tuple:
+            #
+            # Kernel already specified: f = (kernel,)
+            # 
+            kernel = np.array(f[0])
+            assert kernel.shape[-1]==self.__n_gauss_2d, \
+                'Kernel size not compatible with quadrature rule.'
+        else:
+            kernel = self.f_eval_batch(f, boxes, cell_dofs)
+        wk = np.outer(hx*hy, self.__rule_2d.weights())*kernel
+        if len(form) == 1:
+            return np.sum(wk, axis=1)
+        elif len(form) > 3:
+            raise Exception('Only Linear and Bilinear forms supported.')
+        #
+        # Shape functions and (cellwise) multipliers for derivatives
+        # 
+        phi = []
+        for dstring in form[1:]:
+            drv = self.parse_derivative_info(dstring)
+            c = np.ones(n_cells)
+            if drv[0] in {1,2}:
+                for i in drv[1:]:
+                    c /= hx if i==0 else hy
+            wk = wk*c[:,np.newaxis]
+            phi.append(self.shape_eval(derivatives=drv))
+        if len(form) == 2:
+            test, = phi
+            return np.einsum('cg,gi->ci', wk, test)
+        else:
+            trial, test = phi
+            return np.einsum('cg,gi,gj->cij', wk, test, trial, optimize=True)
+        
+    
     def extract_hanging_nodes(self,A,b, compress=False):
         """
         Incorporate hanging nodes into linear system.
@@ -2820,97 +3496,54 @@ class System(object):
         
         b: double, (n,1) vector of right hand sides
         
-        hanging_nodes: dict, {i_hn:[is_1,...,is_k], [cs_1,...,cs_k]}
-            i_hn: hanging node index
-            is_j: index of jth supporting node
-            cs_j: coefficient of jth supporting basis function, i.e.
-            
-            phi_{i_hn} = cs_1*phi_{is_1} + ... + cs_k*phi_{is_k}     
-            
         compress: bool [False], flag for how the nodes should be accounted for
             True - remove the hanging nodes from the system (the solution 
                 can then be reconstructed using "resolve_hanging_nodes").
             False - keep the size of the system, incorporating hanging nodes
                 implicitly.
-        """
-        # Convert A to a lil matrix
-        A = A.tolil() 
+                
+        Outputs:
         
-        hanging_nodes = self.__dofhandler.get_hanging_nodes()
-        n_rows = A.shape[0]
-        for i in range(n_rows):
-            #
-            # Iterate over all rows
-            #
-            if i in hanging_nodes.keys():
-                #
-                # Row corresponds to hanging node
-                #
-                if not compress:
-                    new_indices = [is_j for is_j in hanging_nodes[i][0]] 
-                    new_indices.append(i)
-                    A.rows[i] = new_indices           
-         
-                    new_values = [-cs_j for cs_j in hanging_nodes[i][1]] 
-                    new_values.append(1)
-                    A.data[i] = new_values
-                    
-                    b[i] = 0
+            A: double, sparse matrix in coo format, either the compressed 
+                system matrix C'AC, or the same matrix embedded in the rows 
+                and columns of the free dofs, supplemented by the constraint
+                rows u_hn - cs_1*u_{is_1} - ... - cs_k*u_{is_k} = 0.
                 
-            else:
-                row = A.rows[i]
-                data = A.data[i]
-                for hn in hanging_nodes.keys():
-                    #
-                    # For each row, determine what hanging nodes are supported
-                    #
-                    if hn in row:    
-                        #
-                        # If hanging node appears in row, modify
-                        #
-                        j_hn = row.index(hn)
-                        for js,vs in zip(*hanging_nodes[hn]):
-                            #
-                            # Loop over supporting indices and coefficients
-                            # 
-                            if js in row:
-                                #
-                                # Index exists: modify entry
-                                #
-                                j_js = row.index(js)
-                                data[j_js] += vs*data[j_hn]
-                            else:
-                                #
-                                # Insert new entry
-                                # 
-                                jj = bisect_left(row,js)
-                                vi = vs*data[j_hn]
-                                row.insert(jj,js)
-                                data.insert(jj,vi)
-                                j_hn = row.index(hn)  # find hn again
-                        #
-                        # Zero out column that contains the hanging node
-                        #
-                        row.pop(j_hn)
-                        data.pop(j_hn)
-                        if compress:
-                            #
-                            # Renumber entries to hanging node's right.
-                            # 
-                            for j in range(j_hn,len(row)):
-                                row[j] -= 1
+            b: double, vector of right hand sides, C'b (padded with zeros in
+                the rows of the hanging nodes if compress=False).
+                
+        Note: The hanging nodes' constraints are represented by the sparse 
+            prolongation matrix C (see DofHandler.constraint_matrix), which
+            maps the values of the free dofs to those of all dofs.
+        """
+        C, free_dofs = self.__dofhandler.constraint_matrix()
+        A = sparse.csr_matrix(A)
+        b = np.asarray(b)
+        #
+        # Compressed system
+        # 
+        A_c = (C.T.dot(A)).dot(C)
+        b_c = C.T.dot(b)
         if compress:
+            return A_c.tocoo(), b_c
+        else:
             #
-            # Delete rows corresponding to hanging nodes
+            # Embed compressed system in full system (P: free dofs -> dofs) 
+            # 
+            n, n_free = C.shape
+            P = sparse.csr_matrix((np.ones(n_free), 
+                                   (free_dofs, np.arange(n_free))), 
+                                  shape=(n, n_free))
             #
-            hn_list = [hn for hn in hanging_nodes.keys()]
-            n_hn = len(hn_list)    
-            A.rows = np.delete(A.rows,hn_list,0)
-            A.data = np.delete(A.data,hn_list,0)
-            b = np.delete(b,hn_list,0)
-            A._shape = (A._shape[0]-n_hn, A._shape[1]-n_hn)
-        
-        return A.tocoo(),b
+            # Constraint rows: (I-PP')(I-CP')
+            # 
+            is_hanging = np.ones(n)
+            is_hanging[free_dofs] = 0
+            H = sparse.diags(is_hanging)
+            I = sparse.identity(n, format='csr')
+            A = P.dot(A_c).dot(P.T) + H.dot(I - C.dot(P.T))
+            b = P.dot(b_c)
+            return A.tocoo(), b
             
      
     def resolve_hanging_nodes(self,u):
@@ -2921,30 +3554,15 @@ class System(object):
         
            u: double, (n,) numpy vector of nodal values, without hanging nodes.
             
-           hanging_nodes: dict, {i_hn:[is_1,...,is_k], [cs_1,...,cs_k]}
-                i_hn: hanging node index
-                is_j: index of jth supporting node
-                cs_j: coefficient of jth supporting basis function, i.e.
-                
-                phi_{i_hn} = cs_1*phi_{is_1} + ... + cs_k*phi_{is_k} 
-    
                 
         Outputs:
             
             uu: double, (n+k,) numpy vector of nodal values which includes 
-                hanging nodes.
+                hanging nodes, uu = C*u, where C is the prolongation matrix 
+                of the hanging nodes' constraints.
         """
-        hanging_nodes = self.__hanging_nodes
-        hang = [hn for hn in hanging_nodes.keys()]
-        n = len(u)
-        not_hang = [i for i in range(n) if i not in hang]
-        k = len(hang)
-        uu = np.zeros((n+k,))
-        uu.flat[not_hang] = u
-        for i in range(k):
-            i_s, c_s = hanging_nodes[hang[i]]
-            uu[hang[i]] = np.dot(uu[i_s],np.array(c_s))
-        return uu   
+        C, _ = self.__dofhandler.constraint_matrix()
+        return C.dot(u)   
     
         
     def n_dofs(self):
@@ -3163,26 +3781,16 @@ class System(object):
             # 
             f_vec = np.empty(x.shape[0])
             f_vec[:] = np.nan
-            count = 0
-            for node in self.__mesh.root_node().find_leaves():
-                cell = node.quadcell()
-                in_cell = cell.contains_point(x)
-                f_vec[in_cell] = f[count]
-                count += 1 
+            cell_index = self.__mesh.locate_points(x)
+            in_mesh = cell_index >= 0
+            f_vec[in_mesh] = np.asarray(f)[cell_index[in_mesh]] 
         elif len(f)==self.n_dofs():
             #
             # Nodal function
             # 
-            f_vec = np.empty(x.shape[0])
-            f_vec[:] = np.nan
-            for node in self.__mesh.root_node().find_leaves():
-                cell = node.quadcell()
-                f_loc = f[self.get_global_dofs(node)]
-                in_cell = cell.contains_point(x)
-                x_loc = x[in_cell,:]
-                f_vec[in_cell] = \
-                    self.f_eval_loc(f_loc, node, derivatives=derivatives,\
-                                    x=x_loc)
+            E = self.__dofhandler.eval_matrix(x, derivative=derivatives)
+            f_vec = E.dot(f)
+            f_vec[self.__mesh.locate_points(x) < 0] = np.nan
         else:
             raise Exception('Function must be explicit, nodal, or cellwise.')
         
@@ -3300,6 +3908,14 @@ class System(object):
         """
         assert node.is_linked(), 'Tree node must be linked to cell.'
         cell = node.quadcell()
+        if edge_loc is None and len(form) > 1:
+            c = self.constant_kernel(form[0])
+            if c is not None:
+                #
+                # Constant kernel: use cached element matrix
+                # 
+                x0, x1, y0, y1 = cell.box()
+                return c*self.element_matrix(x1-x0, y1-y0, form[1:])
         #
         # Quadrature weights
         # 
@@ -3479,7 +4095,7 @@ class System(object):
         #    
         # Construct
         # 
-        for node in self.__mesh.root_node().find_leaves(marker_fine):
+        for node in self.__mesh.nodes(marker_fine):
             if node.has_parent(marker_coarse):
                 parent = node.get_parent(marker_coarse)
                 node_dofs = self.__dofhandler.get_global_dofs(node)
@@ -3554,4 +4170,136 @@ class System(object):
         if u_fine is None:
             return R
         else:
-            return R.dot(u_fine)
\ No newline at end of file
+            return R.dot(u_fine)    
+    
+class Assembler(object):
+    """
+    Compiled assembler: The sparsity pattern of the system matrix and the 
+    map from local cell entries to positions in the CSR data array are 
+    computed once, after which the system can be reassembled repeatedly 
+    (e.g. for different coefficients) by refilling only the data. 
+    
+    Note: The Assembler must be reconstructed whenever the mesh or the 
+        degrees of freedom of the underlying System change. 
+    """
+    def __init__(self, system):
+        """
+        Constructor
+        
+        Inputs:
+        
+            system: System, defining the mesh, element and dofs 
+        """
+        leaves, boxes, cell_dofs = system.cell_arrays()
+        n_nodes = system.n_dofs()
+        n_cells, n_dofs = cell_dofs.shape
+        #
+        # Row/column indices of local entries (64 bit, so that the keys 
+        # row*n_nodes+col don't overflow for more than 46340 dofs)
+        # 
+        rows = np.repeat(cell_dofs, n_dofs, axis=1).ravel().astype(np.int64)
+        cols = np.tile(cell_dofs, (1,n_dofs)).ravel().astype(np.int64)
+        #
+        # Unique (row,col) pairs in row-major order define the CSR pattern
+        # 
+        keys, slots = np.unique(rows*n_nodes+cols, return_inverse=True)
+        indices = (keys % n_nodes).astype(np.int32)
+        indptr = np.zeros(n_nodes+1, dtype=np.int32)
+        indptr[1:] = np.cumsum(np.bincount(keys // n_nodes, 
+                                           minlength=n_nodes))
+        #
+        # Position of diagonal entries in data array
+        # 
+        i_diag = np.arange(n_nodes, dtype=np.int64)
+        diagonal = np.searchsorted(keys, i_diag*n_nodes + i_diag)
+        
+        self.__system = system
+        self.__leaves = leaves
+        self.__boxes = boxes
+        self.__cell_dofs = cell_dofs
+        self.__indptr = indptr
+        self.__indices = indices
+        self.__slots = slots
+        self.__diagonal = diagonal
+        self.__shape = (n_nodes, n_nodes)
+        
+        
+    def system(self):
+        """
+        Returns the underlying System
+        """
+        return self.__system
+    
+    
+    def nnz(self):
+        """
+        Returns the number of structural nonzeros of the system matrix 
+        """
+        return len(self.__indices)
+    
+    
+    def pattern(self):
+        """
+        Returns the CSR sparsity pattern (indptr, indices)
+        """
+        return self.__indptr, self.__indices
+    
+    
+    def assemble(self, bilinear_forms=None, linear_forms=None, 
+                 boundary_conditions=None):
+        """
+        Assembles the linear system associated with a weak form, reusing 
+        the precomputed sparsity pattern.
+        
+        Inputs:
+        
+            bilinear_forms, linear_forms, boundary_conditions: see 
+                System.assemble
+                
+        Outputs:
+        
+            A: double csr_matrix, system matrix 
+            
+            b: double, right hand side vector
+        """
+        system = self.__system
+        bf_loc, lf_loc = system.assemble_local(bilinear_forms, linear_forms,
+                                               boundary_conditions, 
+                                               self.__leaves, self.__boxes, 
+                                               self.__cell_dofs)
+        #
+        # Refill data
+        # 
+        data = np.bincount(self.__slots, weights=bf_loc.ravel(), 
+                           minlength=self.nnz())
+        b = np.bincount(self.__cell_dofs.ravel(), weights=lf_loc.ravel(), 
+                        minlength=self.__shape[0])
+        A = sparse.csr_matrix((data, self.__indices, self.__indptr), 
+                              shape=self.__shape)
+        
+        if boundary_conditions is not None and \
+        boundary_conditions.get('dirichlet', None) is not None:
+            #
+            # Dirichlet nodes: Lift columns, replace rows by identity 
+            # 
+            is_dirichlet, u_dir = \
+                system.dirichlet_values(boundary_conditions['dirichlet'])
+            b -= A.dot(u_dir)
+            b[is_dirichlet] = u_dir[is_dirichlet]
+            row_count = np.diff(self.__indptr)
+            in_row = np.repeat(is_dirichlet, row_count)
+            in_col = is_dirichlet[self.__indices]
+            A.data[np.logical_or(in_row, in_col)] = 0
+            A.data[self.__diagonal[is_dirichlet]] = 1
+        #
+        # Return results
+        # 
+        out = []
+        if bilinear_forms is not None:
+            out.append(A) 
+        if linear_forms is not None:
+            out.append(b) 
+        if len(out) == 1:
+            return out[0]
+        elif len(out) == 2:
+            return tuple(out)
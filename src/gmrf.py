@@ -3,14 +3,19 @@ Created on Feb 8, 2017
 
 @author: hans-werner
 '''
-from fem import System, QuadFE, DofHandler, GaussRule, Function
-from mesh import Mesh
+from fem import System, QuadFE, DofHandler, GaussRule, Function, Assembler
+from mesh import Mesh, LinearQuadtree
 from numbers import Number, Real
 import scipy.sparse as sp
-from sksparse.cholmod import cholesky, cholesky_AAt, Factor  # @UnresolvedImport
+from sksparse.cholmod import cholesky, cholesky_AAt, analyze, analyze_AAt, Factor  # @UnresolvedImport
+from sksparse.cholmod import CholmodNotPositiveDefiniteError  # @UnresolvedImport
 from scipy import linalg
 from scipy.special import kv, gamma
 from scipy.sparse import linalg as spla
+from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+import multiprocessing
 import numpy as np
 
 # =============================================================================
@@ -24,6 +29,40 @@ vectors of length n.
 """
 
          
+# =============================================================================
+# Block Sampling
+# =============================================================================
+#
+# Field shared with forked worker processes (see Gmrf.sample_blocks)
+# 
+_FORKED_GMRF = None
+
+
+def _sample_block(gmrf, seed_seq, size, mode):
+    """
+    Generate a block of samples from its own random number stream
+    
+    Inputs:
+    
+        gmrf: Gmrf, random field
+        
+        seed_seq: numpy.random.SeedSequence, seed of the block 
+        
+        size: int, number of samples in block
+        
+        mode: str, see Gmrf.sample
+    """
+    rng = np.random.default_rng(seed_seq)
+    return gmrf.sample(n_samples=size, mode=mode, rng=rng)
+
+
+def _sample_forked_block(seed_seq, size, mode):
+    """
+    Generate a block of samples from the field shared with a forked worker
+    """
+    return _sample_block(_FORKED_GMRF, seed_seq, size, mode)
+
+
 # =============================================================================
 # Gaussian Markov Random Field Class
 # =============================================================================
@@ -190,6 +229,41 @@ class Gmrf(object):
         return (1/(1+d**2))**a   
     
     
+    @staticmethod
+    def wendland_cov(x, y, theta, k=1, M=None, periodic=False):
+        """
+        Compactly supported Wendland covariance function (positive definite
+        in up to 3 dimensions), used e.g. to taper other covariances
+        
+            C(x,y) = phi_k(|x-y|/theta), where for r = |x-y|/theta < 1
+            
+                phi_0(r) = (1-r)^2
+                phi_1(r) = (1-r)^4*(4r+1)
+                phi_2(r) = (1-r)^6*(35r^2+18r+3)/3
+                
+            and C(x,y) = 0 otherwise.
+            
+        Inputs:
+        
+            x,y: np.array, spatial points
+            
+            theta: double >0, support radius
+            
+            k: int, smoothness (0, 1, or 2), phi_k is 2k times 
+                differentiable at 0.
+        """
+        r = Gmrf.distance(x, y, M, periodic=periodic)/theta
+        s = np.maximum(1-r, 0)
+        if k == 0:
+            return s**2
+        elif k == 1:
+            return s**4*(4*r+1)
+        elif k == 2:
+            return s**6*(35*r**2+18*r+3)/3
+        else:
+            raise Exception('Use k = 0, 1, or 2.')
+        
+    
     @staticmethod
     def distance(x, y, M=None, periodic=False, box=None):
         """
@@ -265,10 +339,508 @@ class Gmrf(object):
             
     
     
+    @staticmethod
+    def kernel_block(cov_fn, cov_par, x, y, M=None, periodic=False):
+        """
+        Evaluate a covariance kernel at all pairs of points from two sets
+        
+        Inputs:
+        
+            cov_fn: function, covariance kernel (e.g. Gmrf.gaussian_cov)
+            
+            cov_par: dict, parameter name/value pairs
+            
+            x: double, (m,) or (m,d) array of points
+            
+            y: double, (n,) or (n,d) array of points
+            
+            M: double, anisotropy tensor
+            
+            periodic: bool, indicates a toroidal domain
+            
+        Output:
+        
+            C: double, (m,n) array with entries C[i,j] = cov(x[i],y[j])
+        """
+        m, n = x.shape[0], y.shape[0]
+        X = np.repeat(x, n, axis=0)
+        Y = np.tile(y, (m,) + (1,)*(y.ndim-1))
+        return cov_fn(X, Y, **cov_par, M=M, periodic=periodic).reshape(m,n)
+    
+    
+    @staticmethod
+    def kernel_matrix(cov_fn, cov_par, x, M=None, periodic=False, 
+                      dtype=np.float64, out=None, max_memory=2**28, 
+                      n_threads=1):
+        """
+        Assemble the (symmetric) matrix of kernel values at all pairs of 
+        points tile by tile, so that the memory used by temporary arrays is 
+        bounded.
+        
+        Inputs:
+        
+            cov_fn: function, covariance kernel
+            
+            cov_par: dict, parameter name/value pairs
+            
+            x: double, (n,) or (n,d) array of points
+            
+            M: double, anisotropy tensor
+            
+            periodic: bool, indicates a toroidal domain
+            
+            dtype: data type of the output, np.float64 (default) or 
+                np.float32. Kernels are evaluated in this precision.
+            
+            out: double, (n,n) array to hold the result, e.g. an np.memmap
+                (a new array is allocated if None).
+            
+            max_memory: int, approximate number of bytes used by temporary 
+                arrays at any given time (default 256MB).
+            
+            n_threads: int, number of threads evaluating tiles concurrently.
+            
+        Output:
+        
+            Sigma: double, (n,n) matrix of kernel values
+            
+        Note: Only tiles on or above the diagonal are evaluated. Each tile 
+            is written to its own rows and columns and to those of its 
+            reflection, so that threads never write to the same entries.
+        """
+        n = x.shape[0]
+        x = np.asarray(x, dtype=dtype)
+        if out is None:
+            out = np.empty((n,n), dtype=dtype)
+        else:
+            assert out.shape == (n,n), 'Output array has incorrect shape.'
+        #
+        # Tile size (about 16 temporary entries per kernel value)
+        # 
+        n_threads = max(1, n_threads)
+        itemsize = np.dtype(dtype).itemsize
+        block_size = int(np.sqrt(max_memory/(16*itemsize*n_threads)))
+        block_size = min(max(block_size, 1), n)
+        starts = range(0, n, block_size)
+        tiles = [(i, j) for i in starts for j in starts if j >= i]
+        
+        def fill(tile):
+            """
+            Evaluate the kernel on a tile and store it and its reflection
+            """
+            i, j = tile
+            ii, jj = slice(i, i+block_size), slice(j, j+block_size)
+            C = Gmrf.kernel_block(cov_fn, cov_par, x[ii], x[jj], M=M, 
+                                  periodic=periodic)
+            out[ii,jj] = C
+            if j > i:
+                out[jj,ii] = C.T
+                
+        if n_threads == 1:
+            for tile in tiles:
+                fill(tile)
+        else:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                list(executor.map(fill, tiles))
+        return out
+    
+    
+    @staticmethod
+    def tapered_covariance(cov_fn, cov_par, x, theta, k=1, M=None):
+        """
+        Evaluate a covariance kernel, tapered by a Wendland function with 
+        support radius theta (see Gmrf.wendland_cov), at all pairs of points.
+        The tapered kernel is positive definite (as the product of positive 
+        definite kernels) and vanishes for pairs further apart than theta,
+        which are never evaluated: the pairs within range are found by a 
+        k-d tree.
+        
+        Inputs:
+        
+            cov_fn: function, covariance kernel (e.g. Gmrf.matern_cov)
+            
+            cov_par: dict, parameter name/value pairs
+            
+            x: double, (n,2) array of points
+            
+            theta: double >0, support radius of the taper
+            
+            k: int, smoothness of the taper (0, 1, or 2)
+            
+            M: double, anisotropy tensor (applies to kernel and taper)
+            
+        Output:
+        
+            Sigma: double, (n,n) sparse (csc) covariance matrix
+        """
+        x = np.asarray(x, dtype=float)
+        assert len(x.shape)==2 and x.shape[1]==2, \
+            'Points should be passed as an (n,2) array.'
+        n = x.shape[0]
+        #
+        # Euclidean search radius containing the M-ball of radius theta
+        # 
+        if M is None:
+            radius = theta
+        else:
+            radius = theta/np.sqrt(np.min(np.linalg.eigvalsh(M)))
+        #
+        # Pairs (i<j) within range
+        # 
+        tree = cKDTree(x)
+        pairs = tree.query_pairs(radius, output_type='ndarray')
+        i, j = pairs[:,0], pairs[:,1]
+        xi, xj = x[i], x[j]
+        c = cov_fn(xi, xj, **cov_par, M=M)*\
+            Gmrf.wendland_cov(xi, xj, theta, k=k, M=M)
+        keep = c != 0
+        i, j, c = i[keep], j[keep], c[keep]
+        #
+        # Diagonal
+        # 
+        c_diag = cov_fn(x, x, **cov_par, M=M)*np.ones(n)
+        rows = np.hstack([np.arange(n), i, j])
+        cols = np.hstack([np.arange(n), j, i])
+        vals = np.hstack([c_diag, c, c])
+        return sp.coo_matrix((vals, (rows, cols)), shape=(n,n)).tocsc()
+    
+    
+    @staticmethod
+    def lanczos(A_dot, b, fn, tol=1e-8, max_iter=100, return_info=False,
+                block_size=10, check_every=5):
+        """
+        Approximate f(A)*b for a symmetric positive (semi-)definite matrix A,
+        given only by its action, by the Lanczos method, i.e.
+        
+            f(A)*b ~ |b|*V_k*f(T_k)*e_1,
+            
+        where the columns of V_k form an orthonormal basis of the Krylov
+        space K_k(A,b) and T_k = V_k'*A*V_k is tridiagonal.
+        
+        The columns of b are processed in blocks: each column has its own 
+        Krylov space, but the products with A are computed for all active
+        columns of a block at once.  
+        
+        Inputs:
+        
+            A_dot: function, computing the product A*v for (n,) or (n,m) v
+            
+            b: double, (n,) vector or (n,m) array
+            
+            fn: function, applied to the eigenvalues of T_k, e.g. np.sqrt
+            
+            tol: double, relative change in the approximation (between 
+                two convergence checks) at which the iteration stops.
+            
+            max_iter: int, maximum dimension of the Krylov space
+            
+            return_info: bool, also return convergence information
+            
+            block_size: int, number of columns iterated on simultaneously
+            
+            check_every: int, number of iterations between convergence 
+                checks, each of which requires the eigendecomposition of T_k
+            
+        Output:
+        
+            y: double, approximation of f(A)*b
+            
+            *info: dict, with keys 'n_iter' (dimension of the Krylov space) 
+                and 'error' (relative change since the previous check, 0 if 
+                an invariant subspace was found), (m,) arrays if b is 2D.
+        """
+        b_is_a_vector = len(b.shape) == 1
+        if b_is_a_vector:
+            b = b[:,None]
+        n, m = b.shape
+        n_iter = min(max_iter, n)
+        beta_0 = np.linalg.norm(b, axis=0)
+        y = np.zeros((n,m))
+        iters = np.zeros(m, dtype=int)
+        errors = np.zeros(m)
+        for j0 in range(0, m, block_size):
+            #
+            # Block of columns 
+            # 
+            cols = np.arange(j0, min(j0+block_size, m))
+            nb = len(cols)
+            active = cols[beta_0[cols] > 0] - j0
+            #
+            # Lanczos vectors V[j,k] (rows), storage grows as needed 
+            # 
+            V = np.zeros((nb, min(n_iter+1, 2*check_every), n))
+            V[active,0] = (b[:,j0+active]/beta_0[j0+active]).T
+            alpha, beta = np.zeros((n_iter, nb)), np.zeros((n_iter, nb))
+            y_old = np.zeros((n, nb))
+            for k in range(n_iter):
+                if len(active) == 0:
+                    break
+                if k+1 == V.shape[1]:
+                    V = np.concatenate([V, np.zeros(V.shape)], axis=1)
+                w = np.asarray(A_dot(V[active,k].T)).reshape(n, len(active))
+                if k > 0:
+                    w -= beta[k-1,active]*V[active,k-1].T
+                alpha[k,active] = np.sum(V[active,k].T*w, axis=0)
+                #
+                # Full reorthogonalization (twice), column by column
+                # 
+                for a, j in enumerate(active):
+                    V_j = V[j,:k+1]
+                    for _ in range(2):
+                        w[:,a] -= V_j.T.dot(V_j.dot(w[:,a]))
+                beta_k = np.linalg.norm(w, axis=0)
+                beta[k,active] = beta_k
+                #
+                # Invariant subspace: approximation is exact
+                # 
+                exact = beta_k <= \
+                    1e-12*np.sqrt(np.sum(np.square(alpha[:k+1,active]),axis=0))
+                check = (k+1) % check_every == 0 or k+1 == n_iter
+                done = np.zeros(len(active), dtype=bool)
+                for a, j in enumerate(active):
+                    if not (exact[a] or check):
+                        continue
+                    #
+                    # Approximation from the current Krylov space
+                    # 
+                    lmd, S = linalg.eigh_tridiagonal(alpha[:k+1,j], 
+                                                     beta[:k,j])
+                    y_j = beta_0[j0+j]*V[j,:k+1].T.dot(S.dot(fn(lmd)*S[0,:]))
+                    if exact[a]:
+                        error = 0.0
+                    elif k+1 > check_every:
+                        error = np.linalg.norm(y_j-y_old[:,j])/ \
+                                np.linalg.norm(y_j)
+                    else:
+                        error = np.inf
+                    if exact[a] or error <= tol or k+1 == n_iter:
+                        y[:,j0+j] = y_j
+                        iters[j0+j], errors[j0+j] = k+1, error
+                        done[a] = True
+                    else:
+                        y_old[:,j] = y_j
+                #
+                # Next Lanczos vectors for the remaining columns
+                # 
+                V[active[~done],k+1] = (w[:,~done]/beta_k[~done]).T
+                active = active[~done]
+        if b_is_a_vector:
+            y, iters, errors = y[:,0], iters[0], errors[0]
+        if return_info:
+            return y, {'n_iter': iters, 'error': errors}
+        else:
+            return y
+    
+    
+    @staticmethod
+    def pivoted_cholesky(S, tol=1e-12, max_rank=None):
+        """
+        Compute a low rank factorization S ~ L*L' of a symmetric positive 
+        semidefinite matrix by the pivoted (incomplete) Cholesky 
+        decomposition. Only the diagonal and the r pivot columns of S are 
+        accessed, so that the cost is O(n*r^2).
+        
+        Inputs:
+        
+            S: double, (n,n) symmetric positive semidefinite (full) matrix
+            
+            tol: double, relative tolerance: the factorization stops once 
+                trace(S-L*L') <= tol*trace(S)
+                
+            max_rank: int, maximum rank r of the factor
+            
+        Output:
+        
+            L: double, (n,r) factor
+        """
+        n = S.shape[0]
+        if max_rank is None:
+            max_rank = n
+        d = np.array(np.diag(S), dtype=float)
+        trace = d.sum()
+        L = np.zeros((n, max_rank))
+        r = 0
+        while r < max_rank and d.sum() > tol*trace:
+            #
+            # Pivot: largest remaining diagonal entry
+            # 
+            i = np.argmax(d)
+            l = S[:,i] - L[:,:r].dot(L[i,:r])
+            L[:,r] = l/np.sqrt(d[i])
+            d -= L[:,r]**2
+            d[d < 0] = 0
+            d[i] = 0
+            r += 1
+        return L[:,:r]
+    
+    
+    @staticmethod
+    def takahashi(L, d):
+        """
+        Selected inversion: compute the entries of S = (L*D*L')^{-1} on the 
+        sparsity pattern of L by the Takahashi recursion 
+        
+            S[i,i] = 1/d[i] - sum_{k>i} L[k,i]*S[k,i]
+            S[j,i] = -sum_{k>i} L[k,i]*S[k,j],  j > i, L[j,i] != 0,
+            
+        working from the last column to the first. Since the pattern of a 
+        Cholesky factor is closed under this recursion, only entries on the 
+        pattern are ever needed. 
+        
+        Inputs:
+        
+            L: double, (n,n) sparse unit lower triangular factor
+            
+            d: double, (n,) diagonal of D
+            
+        Output:
+        
+            S: double, (n,n) sparse lower triangular matrix (csc) with the 
+                pattern of L, containing the entries of the inverse. 
+        """
+        L = sp.csc_matrix(L, copy=True)
+        L.sort_indices()
+        indptr, indices, data = L.indptr, L.indices, L.data
+        n = L.shape[0]
+        s = np.zeros(len(data))
+        #
+        # Keys col*n + row of the stored entries (sorted, since L is csc 
+        # with sorted indices), used to locate entries (row,col) by search
+        # 
+        keys = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr))*n \
+             + indices
+        triu = dict()
+        for i in range(n-1,-1,-1):
+            i0, i1 = indptr[i], indptr[i+1]
+            assert indices[i0] == i, 'Diagonal entries should be stored.'
+            K, l = indices[i0+1:i1], data[i0+1:i1]
+            #
+            # Gather the dense block S[K,K] from the stored lower part 
+            # (one search per column), then y = S[K,K]*l
+            #
+            m = len(K)
+            if m not in triu:
+                triu[m] = np.triu_indices(m)
+            a, b = triu[m]
+            pos = np.searchsorted(keys, K[a].astype(np.int64)*n + K[b])
+            S_KK = np.empty((m,m))
+            S_KK[a,b] = s[pos]
+            S_KK[b,a] = s[pos]
+            y = S_KK.dot(l)
+            s[i0+1:i1] = -y
+            s[i0] = 1/d[i] + l.dot(y)
+        return sp.csc_matrix((s, indices, indptr), shape=(n,n))
+    
+    
+    @staticmethod
+    def galerkin_covariance(cov_fn, cov_par, mesh, element, M=None, 
+                            periodic=False, n_gauss=9, max_memory=2**28):
+        """
+        Assemble the finite element (Galerkin) discretization of a covariance
+        kernel, i.e. the matrix of double integrals
+        
+            Sigma[i,j] = II phi_i(x) cov(x,y) phi_j(y) dx dy,
+            
+        together with the mass matrix.
+        
+        Inputs:
+        
+            cov_fn: function, covariance kernel
+            
+            cov_par: dict, parameter name/value pairs
+            
+            mesh: Mesh, computational mesh
+            
+            element: QuadFE, finite element
+            
+            M: double, anisotropy tensor
+            
+            periodic: bool, indicates a toroidal domain
+            
+            n_gauss: int, number of Gauss points per cell
+            
+            max_memory: int, approximate bound on the bytes used by the 
+                kernel values (and temporaries) of a tile of Gauss points
+                
+        Outputs:
+        
+            Sigma: double, (n_dofs,n_dofs) covariance matrix
+            
+            M_mass: double, (n_dofs,n_dofs) sparse mass matrix 
+            
+        Note: Let X be the Gauss points of all cells, K the kernel matrix 
+            K[g,h] = cov(X[g],X[h]) and P_w the sparse matrix of weighted 
+            shape functions P_w[g,i] = w[g]*phi_i(X[g]). Then Sigma = P_w'KP_w,
+            which is accumulated over tiles of Gauss points on or above the 
+            diagonal, so that K is never stored in full.
+        """
+        dofhandler = DofHandler(mesh, element)
+        dofhandler.distribute_dofs()
+        n_dofs = dofhandler.n_dofs()
+        cell_dofs = dofhandler.cell_dofs()
+        boxes = mesh.linear_quadtree().boxes()
+        n_cells, n_dofs_loc = cell_dofs.shape
+        #
+        # Gauss points and weights of all cells 
+        # 
+        rule = GaussRule(n_gauss, element=element)
+        x_ref = rule.nodes()
+        hx = boxes[:,1] - boxes[:,0]
+        hy = boxes[:,3] - boxes[:,2]
+        x = np.empty((n_cells, n_gauss, 2))
+        x[:,:,0] = boxes[:,[0]] + hx[:,np.newaxis]*x_ref[:,0]
+        x[:,:,1] = boxes[:,[2]] + hy[:,np.newaxis]*x_ref[:,1]
+        x = x.reshape(-1,2)
+        w = (hx*hy)[:,np.newaxis]*rule.weights()
+        #
+        # Shape functions and weighted shape functions at Gauss points
+        #
+        phi = element.shape(x_ref)
+        rows = np.repeat(np.arange(n_cells*n_gauss), n_dofs_loc)
+        cols = np.repeat(cell_dofs, n_gauss, axis=0).ravel()
+        shape = (n_cells*n_gauss, n_dofs)
+        P = sp.csr_matrix((np.tile(phi, (n_cells,1)).ravel(), (rows, cols)),
+                          shape=shape)
+        P_w = sp.csr_matrix(((w.reshape(-1,1)*np.tile(phi, (n_cells,1))).ravel(),
+                             (rows, cols)), shape=shape)
+        M_mass = (P_w.T).dot(P).tocsr()
+        #
+        # Tiles of Gauss points, aligned with cells
+        # 
+        block_size = int(np.sqrt(max_memory/(16*8)))
+        block_size = max(n_gauss, block_size - block_size % n_gauss)
+        starts = range(0, n_cells*n_gauss, block_size)
+        Sigma = np.zeros((n_dofs, n_dofs))
+        for i in starts:
+            ii = slice(i, i+block_size)
+            P_i = P_w[ii]
+            dofs_i = np.unique(P_i.indices)
+            P_i = P_i[:,dofs_i]
+            for j in starts:
+                if j < i:
+                    continue
+                jj = slice(j, j+block_size)
+                P_j = P_w[jj]
+                dofs_j = np.unique(P_j.indices)
+                P_j = P_j[:,dofs_j]
+                #
+                # Kernel on tile and contribution P_i'KP_j
+                # 
+                K = Gmrf.kernel_block(cov_fn, cov_par, x[ii], x[jj], M=M, 
+                                      periodic=periodic)
+                C = (P_i.T).dot((P_j.T).dot(K.T).T)
+                Sigma[np.ix_(dofs_i, dofs_j)] += C
+                if j > i:
+                    Sigma[np.ix_(dofs_j, dofs_i)] += C.T
+        return Sigma, M_mass
+    
+    
     @staticmethod
     def covariance_matrix(cov_name, cov_par, mesh, element=None, M=None, 
                           assembly_type='finite_differences', n_gauss=9, 
-                          lumped=False, periodic=False):
+                          lumped=False, periodic=False, dtype=np.float64,
+                          out=None, max_memory=2**28, n_threads=1, 
+                          taper=None, taper_k=1):
         """
         Construct a covariance matrix from the specified covariance kernel
         
@@ -296,6 +868,23 @@ class Gmrf(object):
             
             periodic [False]: Is the domain a torus? Currently only
                 implemented for assembly_type='finite_differences'
+                
+            dtype [np.float64]: data type of the covariance matrix, e.g. 
+                np.float32 to halve its memory.
+                
+            out [None]: double, (n,n) array to hold the covariance matrix, 
+                e.g. an np.memmap (for assembly_type='finite_differences').
+                
+            max_memory [2**28]: int, bound on the bytes used by temporary 
+                arrays during assembly (see Gmrf.kernel_matrix).
+                
+            n_threads [1]: int, number of threads used to evaluate tiles.
+            
+            taper [None]: double, support radius of a Wendland taper. If 
+                specified, the (finite difference) covariance matrix is 
+                sparse, see Gmrf.tapered_covariance.
+                
+            taper_k [1]: int, smoothness of the Wendland taper.
                          
         """
         #
@@ -323,94 +912,24 @@ class Gmrf(object):
             'Specify "element" if "assembly_type" is '+\
             '"finite_elements" is used.'
             
-            dofhandler = DofHandler(mesh, element)
-            dofhandler.distribute_dofs()
-                 
             #
             # Assemble double integral
             #
             #  C(pi,pj) = II pi(xi) pj(xj) cov(xi,xj) dx 
-            
-            # Initialize 
-            n_dofs = dofhandler.n_dofs()
-            Sigma = np.zeros((n_dofs,n_dofs))
-            m_row = []
-            m_col = []
-            m_val = []
-            
-            # Gauss rule on reference domain
-            rule = GaussRule(9, element=element)
-            xg_ref = rule.nodes()
-            w_xg_ref = rule.weights()
-            n_gauss = rule.n_nodes()
-            
-            # Iterate over mesh nodes: outer loop
-            leaves = mesh.root_node().find_leaves()
-            n_nodes = len(leaves)
-            for i in range(n_nodes):
-                # Local Gauss nodes and weights
-                xnode = leaves[i]
-                xcell = xnode.quadcell()
-                xdofs = dofhandler.get_global_dofs(xnode)
-                n_dofs_loc = len(xdofs)
-                xg = xcell.map(xg_ref) 
-                w_xg = rule.jacobian(xcell)*w_xg_ref
-                
-                # Evaluate shape functions and local mass matrix 
-                xphi = element.shape(xg_ref)
-                w_xphi = np.diag(w_xg).dot(xphi)
-                m_loc = np.dot(xphi.T, np.dot(w_xphi))
-                
-                # Iterate over mesh nodes: inner loop
-                for j in range(i,n_nodes):
-                    ynode = leaves[j]
-                    ycell = ynode.quadcell()
-                    ydofs = dofhandler.get_global_dofs(ynode)
-                    yg = xcell.map(xg_ref)
-                    w_yg = rule.jacobian(ycell)*w_xg_ref
-                    if i == j: 
-                        yphi = xphi
-                    else:
-                        yphi = element.shape(xg_ref)
-                    w_yphi = np.diag(w_yg).dot(yphi)
-                    
-                #
-                # Evaluate covariance function at the local Gauss points
-                # 
-                ii,jj = np.meshgrid(np.arange(n_gauss),np.arange(n_gauss))
-                if mesh.dim == 1:
-                    x1, x2 = xg[ii.ravel()], yg[jj.ravel()]
-                elif mesh.dim == 2:
-                    x1, x2 = xg[ii.ravel(),:],yg[jj.ravel(),:]
-                    
-                C_loc = cov_fn(x1,x2,**cov_par).reshape(n_gauss,n_gauss)
-                CC_loc = np.dot(w_yphi.T,C_loc.dot(w_xphi))
-                    
-            # Local to global mapping     
-            for ii in range(n_dofs_loc):
-                for jj in range(n_dofs_loc):
-                    # Covariance 
-                    Sigma[xdofs[ii],ydofs[jj]] += CC_loc[i,j]
-                    Sigma[ydofs[jj],xdofs[ii]] += CC_loc[i,j]
-                    
-                    # Mass Matrix
-                    m_row.append(ii)
-                    m_col.append(jj)
-                    m_val.append(m_loc[i,j])
-                    
-            
-            # Define global mass matrix
-            M = sp.coo_matrix((m_val,(m_row,m_col)))
-            
+            Sigma, M_mass = Gmrf.galerkin_covariance(cov_fn, cov_par, mesh, 
+                                                     element, M=M, 
+                                                     periodic=periodic, 
+                                                     n_gauss=n_gauss,
+                                                     max_memory=max_memory)
             if lumped: 
-                M_lumped = np.array(M.tocsr().sum(axis=1)).squeeze()
+                M_lumped = np.array(M_mass.sum(axis=1)).squeeze()
                 #
                 # Adjust covariance
                 #
                 Sigma = sp.diags(1/M_lumped)*Sigma
                 return Sigma
             else:
-                return Sigma, M
+                return Sigma, M_mass
             
             
         elif assembly_type=='finite_differences':
@@ -422,20 +941,20 @@ class Gmrf(object):
             dofhandler = DofHandler(mesh, element)
             dofhandler.distribute_dofs()
             x = dofhandler.dof_vertices()
-            n = dofhandler.n_dofs()
-            Sigma = np.empty((n,n))
-            i,j = np.triu_indices(n)
-            if dim == 1:
-                Sigma[i,j] = cov_fn(x[i],x[j], **cov_par, \
-                                    periodic=periodic, M=M)
-            if dim == 2:
-                Sigma[i,j] = cov_fn(x[i,:],x[j,:], **cov_par, \
-                                    periodic=periodic, M=M)
+            if taper is not None:
+                #
+                # Sparse, tapered covariance 
+                # 
+                assert not periodic, 'Tapering not implemented for tori.'
+                return Gmrf.tapered_covariance(cov_fn, cov_par, x, taper, 
+                                               k=taper_k, M=M)
             #
-            # Reflect upper triangular part onto lower triangular part
+            # Evaluate the kernel tile by tile
             # 
-            i,j = np.tril_indices(n,-1)
-            Sigma[i,j] = Sigma[j,i]
+            Sigma = Gmrf.kernel_matrix(cov_fn, cov_par, x, M=M, 
+                                       periodic=periodic, dtype=dtype, 
+                                       out=out, max_memory=max_memory, 
+                                       n_threads=n_threads)
             return Sigma
         else:
             raise Exception('Use "finite_elements" or '+\
@@ -472,62 +991,14 @@ class Gmrf(object):
             Q: sparse matrix, in CSC format
             
         """
-        system = System(mesh, element)
-        
-        #
-        # Assemble (kappa * M + K)
-        #
-        bf = [(kappa,'u','v')]
-        if tau is not None:
-            #
-            # Test whether tau is a symmetric tensor
-            # 
-            if type(tau) is tuple:
-                assert len(tau)==3, 'Symmetric tensor should have length 3.'
-                axx,axy,ayy = tau
-                bf += [(axx,'ux','vx'),(axy,'uy','vx'),
-                       (axy,'ux','vy'),(ayy,'uy','vy')]
-            else:
-                assert callable(tau) or isinstance(tau, Number)
-                bf += [(tau,'ux','vx'),(tau,'uy','vy')]
-        else:
-            bf += [(1,'ux','vx'),(1,'uy','vy')]
-        G = system.assemble(bilinear_forms=bf, 
-                            boundary_conditions=boundary_conditions)
-        G = G.tocsr()
-        
-        #
-        # Lumped mass matrix
-        # 
-        M = system.assemble(bilinear_forms=[(1,'u','v')]).tocsr()
-        m_lumped = np.array(M.sum(axis=1)).squeeze()
-        
-            
-        if np.mod(alpha,2) == 0:
-            #
-            # Even power alpha
-            # 
-            Q = cholesky(G.tocsc())
-            count = 1
-        else:
-            #
-            # Odd power alpha
-            # 
-            Q = cholesky_AAt((G*sp.diags(1/np.sqrt(m_lumped))).tocsc())
-            count = 2
-        
-        while count < alpha:
-            #
-            # Update Q
-            #
-            Q = cholesky_AAt((G*sp.diags(1/m_lumped)*Q.apply_Pt(Q.L())).tocsc()) 
-            count += 2
-        
-        return Q
+        builder = MaternPrecision(mesh, element, alpha, 
+                                  boundary_conditions=boundary_conditions)
+        return builder.factor(kappa, tau)
  
  
     def __init__(self, mu=None, precision=None, covariance=None, 
-                 mesh=None, element=None, discretization='finite_elements'):
+                 mesh=None, element=None, discretization='finite_elements',
+                 rank_tol=1e-12, max_rank=None, null_space=None):
         """
         Constructor
         
@@ -536,7 +1007,10 @@ class Gmrf(object):
         
             mu: double, (n,) vector of expectations (default=0)
             
-            precision: double, (n,n) sparse/full precision matrix
+            precision: double, (n,n) sparse/full precision matrix, its 
+                CHOLMOD Factor, or a LinearOperator (e.g. 
+                MaternPrecision.operator) for fields too large to factorize,
+                which can then only be sampled in mode 'krylov'. 
                     
             covariance: double, (n,n) sparse/full covariance matrix
             
@@ -547,6 +1021,16 @@ class Gmrf(object):
             discretization: str, 'finite_elements' (default), or
                 'finite_differences'.
                 
+            rank_tol: double, relative tolerance of the low rank factor of a 
+                (full) covariance matrix that is not positive definite.
+                
+            max_rank: int, maximum rank of this low rank factor.
+            
+            null_space: double, (n,k) matrix whose columns span the null 
+                space of an intrinsic (singular) precision matrix, e.g. 
+                np.ones((n,1)) for a first order random walk. The density
+                is then evaluated w.r.t. the pseudo-determinant of Q.
+                
             
         Attributes:
         
@@ -556,13 +1040,22 @@ class Gmrf(object):
             
             __mu: double, expected value
             
-            __b: double, Q\mu (useful for sampling)
+            __b: double, Q\mu (useful for sampling, computed on first use)
             
             __f_prec: double, lower triangular left cholesky factor of precision
-                If Q is sparse, then use CHOLMOD.
+                If Q is sparse, then use CHOLMOD (computed on first use).
                 
             __f_cov: double, lower triangular left cholesky factor of covariance
-                If Sigma is sparse, we use CHOLMOD.
+                If Sigma is sparse, we use CHOLMOD (computed on first use).
+                
+            __f_cov_lowrank: double, (n,r) pivoted Cholesky factor of a
+                rank deficient (full) covariance matrix, Sigma ~ L*L'.
+                
+            __null_space: double, (n,k) orthonormal basis for the null space
+                of an intrinsic precision matrix.
+                
+            __log_pdet: double, log pseudo-determinant of an intrinsic 
+                precision matrix (computed on first use).
                 
             __dim: int, effective dimension
             
@@ -576,7 +1069,17 @@ class Gmrf(object):
         """   
         n = None
         #
-        # Need at least one
+        # Factors (computed on first use, see __prec_factor, __cov_factor)
+        # 
+        self.__f_prec = None
+        self.__f_cov = None
+        self.__f_cov_lowrank = None
+        self.__factorized = set()
+        self.__L = dict()
+        self.__rank_tol = rank_tol
+        self.__max_rank = max_rank
+        #
+        # Need at least one
         #
         if precision is None and covariance is None:
             raise Exception('Specify precision or covariance (or both).')  
@@ -585,27 +1088,22 @@ class Gmrf(object):
         # 
         Q = None
         if precision is not None:    
-            if sp.isspmatrix(precision):
-                #
-                # Precision is sparse matrix
-                # 
-                n = precision.shape[0]
-                Q = precision
-                self.__f_prec = cholesky(Q.tocsc())
+            if type(precision) is Factor:
                 #
-                # Precision is cholesky factor
+                # Precision is cholesky factor: L*L' = Q[P,P]
                 # 
-            elif type(precision) is Factor:
                 n = len(precision.P())
-                Q = (precision.L()*precision.L().transpose())
+                LLt = (precision.L()*precision.L().transpose()).tocsr()
+                P_inv = np.argsort(precision.P())
+                Q = LLt[P_inv][:,P_inv].tocsc()
                 self.__f_prec = precision
+                self.__factorized.add('precision')
             else:
                 #
-                # Precision is full matrix
+                # Precision is sparse/full matrix, or LinearOperator 
                 #
                 n = precision.shape[0]
                 Q = precision 
-                self.__f_prec = np.linalg.cholesky(precision)
         self.__Q = Q
         #
         # Covariance matrix
@@ -613,38 +1111,22 @@ class Gmrf(object):
         self.__Sigma = covariance
         if covariance is not None:
             n = covariance.shape[0]
-            if sp.isspmatrix(covariance):
-                try:
-                    self.__f_cov = cholesky(covariance.tocsc())
-                except np.linalg.linalg.LinAlgError:
-                    print('It seems a linalg error occured') 
-            else:
-                # Most likely
-                try:
-                    self.__f_cov = np.linalg.cholesky(covariance)
-                except np.linalg.linalg.LinAlgError as ex:
-                    if ex.__str__() == 'Matrix is not positive definite':
-                        #
-                        # Rank deficient covariance
-                        # 
-                        # TODO: Pivoted Cholesky
-                        self.__f_cov = None
-                        self.__svd = np.linalg.svd(covariance)  
-                    else:
-                        raise Exception('I give up.')
         #
-        # Check compatibility
+        # Check compatibility 
         # 
-        if covariance is not None and precision is not None:
-            n_cov = covariance.shape[0]
-            n_prc = precision.shape[0]
-            assert n_prc == n_cov, \
+        if covariance is not None and precision is not None \
+        and not isinstance(covariance, (HMatrix, CirculantEmbedding)) \
+        and not isinstance(Q, spla.LinearOperator):
+            assert Q.shape == covariance.shape, \
                 'Incompatibly shaped precision and covariance.'
-            isI = precision.dot(covariance)
-            if sp.isspmatrix(isI):
-                isI = isI.toarray()
-                assert np.allclose(isI, np.eye(n_prc),rtol=1e-10),\
-               'Covariance and precision are not inverses.' 
+            #
+            # Randomized test Q*Sigma*v = v, for a few random probes v 
+            # (with a local random stream, leaving the global one intact)
+            # 
+            V = np.random.default_rng(0).normal(size=(n, 3))
+            R = Q.dot(covariance.dot(V)) - V
+            assert np.linalg.norm(R) <= 1e-8*np.linalg.norm(V), \
+                'Covariance and precision are not inverses.'
         #
         # Mean
         # 
@@ -654,19 +1136,32 @@ class Gmrf(object):
             mu = np.zeros(n)
         self.__mu = mu
         # 
-        # b = Q\mu
+        # b = Q\mu (computed on first use, see b)
         # 
-        if not np.allclose(mu, np.zeros(n), 1e-10):
-            # mu is not zero
-            b = self.Q_solve(mu)
-        else:
-            b = np.zeros(n)
-        self.__b = b
+        self.__b = None
         #
         # Store size of matrix
         # 
         self.__n = n    
         #
+        # Karhunen-Loeve expansion (computed on demand, see KL)
+        # 
+        self.__kl = None
+        #
+        # Null space of intrinsic precision (orthonormalized)
+        # 
+        if null_space is not None:
+            assert precision is not None, \
+                'Null space only applies to (intrinsic) precision matrices.'
+            null_space = np.asarray(null_space, dtype=float)
+            if null_space.ndim == 1:
+                null_space = null_space[:,None]
+            assert null_space.shape[0] == n, \
+                'Null space incompatible with precision.'
+            null_space = linalg.qr(null_space, mode='economic')[0]
+        self.__null_space = null_space
+        self.__log_pdet = None
+        #
         # Store mesh and elements if available
         #
         if mesh is not None:
@@ -674,9 +1169,98 @@ class Gmrf(object):
         if element is not None:
             self.element = element
         
+    def __prec_factor(self):
+        """
+        Return the Cholesky factor of the precision matrix (CHOLMOD Factor 
+        if Q is sparse, lower triangular array otherwise), which is computed 
+        on first use. 
+        """
+        if 'precision' not in self.__factorized:
+            Q = self.__Q
+            if Q is None or isinstance(Q, spla.LinearOperator):
+                self.__f_prec = None
+            elif sp.isspmatrix(Q):
+                self.__f_prec = cholesky(Q.tocsc())
+            else:
+                self.__f_prec = np.linalg.cholesky(Q)
+            self.__factorized.add('precision')
+        return self.__f_prec
+    
+    
+    def __prec_log_pdet(self):
+        """
+        Return the log pseudo-determinant of an intrinsic precision matrix Q
+        with orthonormal null space basis V (n,k), computed on first use 
+        from the nonsingular block obtained by deleting k rows/columns s, 
+        
+            det*(Q) = det(Q[c,c])/det(V[s,:])^2,  c = complement of s,
+        
+        where s are chosen by pivoted QR of V' so that V[s,:] is well 
+        conditioned. Only Q[c,c] is factorized, so sparsity is preserved. 
+        """
+        if self.__log_pdet is None:
+            V, Q = self.__null_space, self.__Q
+            k = V.shape[1]
+            dummy, R, pivots = linalg.qr(V.T, mode='economic', pivoting=True)
+            s = pivots[:k]
+            is_c = np.ones(self.n(), dtype=bool)
+            is_c[s] = False
+            if sp.isspmatrix(Q):
+                Q_cc = Q.tocsc()[is_c][:,is_c].tocsc()
+                log_det_cc = cholesky(Q_cc).logdet()
+            else:
+                L_cc = np.linalg.cholesky(Q[np.ix_(is_c,is_c)])
+                log_det_cc = 2*np.sum(np.log(np.diag(L_cc)))
+            #
+            # |det(V[s,:])| = |det(R[:,:k])| 
+            # 
+            log_det_Vs = np.sum(np.log(np.abs(np.diag(R[:,:k]))))
+            self.__log_pdet = log_det_cc - 2*log_det_Vs
+        return self.__log_pdet
+    
+    
+    def __cov_factor(self):
+        """
+        Return the Cholesky factor of the covariance matrix (CHOLMOD Factor
+        if Sigma is sparse, lower triangular array otherwise), which is 
+        computed on first use. If the (full) covariance is rank deficient, 
+        the factor is None and a pivoted Cholesky factor is stored instead. 
+        """
+        if 'covariance' not in self.__factorized:
+            Sigma = self.__Sigma
+            if Sigma is None or isinstance(Sigma, (HMatrix, 
+                                                   CirculantEmbedding)):
+                #
+                # Compressed covariance: no factorization, sample by 
+                # Lanczos (HMatrix) or FFT (CirculantEmbedding)
+                # 
+                pass
+            elif sp.isspmatrix(Sigma):
+                try:
+                    self.__f_cov = cholesky(Sigma.tocsc())
+                except CholmodNotPositiveDefiniteError:
+                    raise Exception('Sparse covariance matrix is not '+\
+                                    '(numerically) positive definite. '+\
+                                    'For rank deficient covariances, '+\
+                                    'use a full matrix (low rank factor).')
+            else:
+                try:
+                    self.__f_cov = np.linalg.cholesky(Sigma)
+                except np.linalg.LinAlgError:
+                    #
+                    # Rank deficient covariance: pivoted Cholesky
+                    # 
+                    self.__f_cov_lowrank = \
+                        Gmrf.pivoted_cholesky(Sigma, tol=self.__rank_tol, 
+                                              max_rank=self.__max_rank)
+            self.__factorized.add('covariance')
+        return self.__f_cov
+    
+    
     @classmethod
     def from_covariance_kernel(cls, cov_name, cov_par, mesh, \
-                               mu=None, element=None):
+                               mu=None, element=None, hierarchical=False,
+                               circulant=False, taper=None):
         """
         Initialize Gmrf from covariance function
         
@@ -695,17 +1279,56 @@ class Gmrf(object):
             mu: double, expectation vector
             
             element: QuadFE, element (necessary for finite element discretization).
+            
+            hierarchical: bool, approximate the (finite difference) covariance 
+                matrix by an HMatrix, rather than storing it in full.
+                
+            circulant: bool, represent the (finite difference) covariance 
+                matrix of a stationary kernel on a uniform grid by its 
+                circulant embedding and sample by FFT. If None, the 
+                embedding is used whenever the mesh is a uniform grid and 
+                the kernel is stationary. 
+                
+            taper: double, support radius of a Wendland taper, yielding a 
+                sparse (finite difference) covariance matrix (see 
+                Gmrf.tapered_covariance). 
              
                      
         Note: In the case of finite element discretization, mass lumping is used. 
         """
         # Convert covariance name to function 
-        #cov_fn = globals()['Gmrf.'+cov_name+'_cov']
-        cov_fn = locals()[cov_name+'_cov']
+        cov_fn = getattr(Gmrf, cov_name+'_cov')
+        if circulant is None:
+            #
+            # Detect stationary kernel on uniform grid
+            # 
+            circulant = element is None and not hierarchical and \
+                taper is None and \
+                cov_name in ['gaussian', 'exponential', 'matern'] and \
+                CirculantEmbedding.lattice(mesh) is not None
         #
         # Discretize the covariance function
         # 
-        if element is None:
+        if element is None and circulant:
+            #
+            # Circulant embedding of the pointwise kernel matrix
+            # 
+            Sigma = CirculantEmbedding(cov_fn, cov_par, mesh)
+            discretization = 'finite_differences'
+        elif element is None and taper is not None:
+            #
+            # Tapered pointwise evaluation of the kernel (sparse)
+            # 
+            Sigma = Gmrf.covariance_matrix(cov_name, cov_par, mesh, 
+                                           taper=taper)
+            discretization = 'finite_differences'
+        elif element is None and hierarchical:
+            #
+            # Compressed pointwise evaluation of the kernel
+            # 
+            Sigma = HMatrix(cov_fn, cov_par, mesh)
+            discretization = 'finite_differences'
+        elif element is None:
             #
             # Pointwise evaluation of the kernel
             #
@@ -723,49 +1346,11 @@ class Gmrf(object):
             #
             # Assemble double integral
             #
-
-            system = System(mesh, element) 
-            n_dofs = system.n_dofs()
-            Sigma = np.zeros((n_dofs,n_dofs))
-            
-            # Gauss points
-            rule = system.cell_rule()
-            n_gauss = rule.n_nodes()                  
-            for node_1 in mesh.root_node().find_leaves():
-                node_dofs_1 = system.get_global_dofs(node_1)
-                n_dofs_1 = len(node_dofs_1)
-                cell_1 = node_1.quadcell()
-                
-                
-                weights_1 = rule.jacobian(cell_1)*rule.weights()
-                x_gauss_1 = rule.map(cell_1, x=rule.nodes())
-                phi_1 = system.shape_eval(cell=cell_1)    
-                WPhi_1 = np.diag(weights_1).dot(phi_1)
-                for node_2 in mesh.root_node().find_leaves():
-                    node_dofs_2 = system.get_global_dofs(node_2)
-                    n_dofs_2 = len(node_dofs_2)
-                    cell_2 = node_2.quadcell()
-                    
-                    x_gauss_2 = rule.map(cell_2, x=rule.nodes())
-                    weights_2 = rule.jacobian(cell_2)*rule.weights()
-                    phi_2 = system.shape_eval(cell=cell_2)
-                    WPhi_2 = np.diag(weights_2).dot(phi_2)
-                    
-                    i,j = np.meshgrid(np.arange(n_gauss),np.arange(n_gauss))
-                    x1, x2 = x_gauss_1[i.ravel(),:],x_gauss_2[j.ravel(),:]
-                    C_loc = cov_fn(x1,x2,**cov_par).reshape(n_gauss,n_gauss)
-                
-                    CC_loc = np.dot(WPhi_2.T,C_loc.dot(WPhi_1))
-                    for i in range(n_dofs_1):
-                        for j in range(n_dofs_2):
-                            Sigma[node_dofs_1[i],node_dofs_2[j]] += CC_loc[i,j]
-                        
-                        
-            
+            Sigma, M = Gmrf.galerkin_covariance(cov_fn, cov_par, mesh, 
+                                                element)
             #
             # Lumped mass matrix (not necessary!)
             #
-            M = system.assemble(bilinear_forms=[(1,'u','v')]).tocsr()
             m_lumped = np.array(M.sum(axis=1)).squeeze()
             #
             # Adjust covariance
@@ -843,41 +1428,47 @@ class Gmrf(object):
         #
         assert self.mode_supported(mode), \
             'Mode "'+mode+'" not supported by this random field.' 
-        if mode == 'precision':
+        if mode in self.__L:
+            #
+            # Cached 
+            # 
+            L = self.__L[mode]
+        elif mode == 'precision':
             #
             # Precision Matrix
             # 
-            assert self.__f_prec is not None, \
-                'Precision matrix not specified.'
+            f = self.__prec_factor()
+            assert f is not None, 'Precision matrix not specified.'
             if sp.isspmatrix(self.__Q):
                 #
                 # Sparse matrix, use CHOLMOD
                 #  
-                P = self.__f_prec.P()
-                L = self.__f_prec.L()[P,:][:,P]
+                P = f.P()
+                L = f.L()[P,:][:,P]
             else:
                 #
                 # Cholesky Factor stored as full matrix
                 # 
-                L = self.__f_prec
-
+                L = f
+            self.__L[mode] = L
         elif mode == 'covariance':
             #
             # Covariance Matrix
             # 
-            assert self.__f_cov is not None, \
-                'Covariance matrix not specified.'
+            f = self.__cov_factor()
+            assert f is not None, 'Covariance matrix not specified.'
             if sp.isspmatrix(self.__Sigma):
                 #
                 # Sparse Covariance matrix, use CHOLMOD
                 # 
-                P = self.__f_cov.P()
-                L = self.__f_cov.L()[P,:][:,P]
+                P = f.P()
+                L = f.L()[P,:][:,P]
             else:
                 #
                 # Cholesky Factor stored as full matrix
                 # 
-                L = self.__f_cov
+                L = f
+            self.__L[mode] = L
         else:
             raise Exception('Mode not recognized. Use either' + \
                             '"precision" or "covariance".')
@@ -915,8 +1506,15 @@ class Gmrf(object):
     
     def b(self):
         """
-        Return Q\mu
+        Return Q\mu (computed on first use)
         """
+        if self.__b is None and self.mode_supported('precision'):
+            mu = self.__mu
+            if not np.allclose(mu, np.zeros(self.n()), 1e-10):
+                # mu is not zero
+                self.__b = self.Q_solve(mu)
+            else:
+                self.__b = np.zeros(self.n())
         return self.__b
     
     
@@ -931,10 +1529,87 @@ class Gmrf(object):
         """
         Return the rank of the covariance/precision matrix
         
-        Note: If the matrix is degenerate, we must use the covariance's
-            or precision's eigendecomposition.
+        Note: A precision matrix (or full rank covariance) that could be 
+            factorized is positive definite. Degenerate covariances are
+            stored by their (n,r) pivoted Cholesky factor, whose number of
+            columns is the numerical rank. An intrinsic precision with a 
+            k-dimensional null space has rank n-k.
+        """
+        if self.__null_space is not None:
+            return self.n() - self.__null_space.shape[1]
+        if self.__Q is None:
+            self.__cov_factor()
+        if self.__f_cov_lowrank is not None and self.__Q is None:
+            return self.__f_cov_lowrank.shape[1]
+        else:
+            return self.n()
+        
+        
+    def log_pdf(self, x, mode='precision'):
+        """
+        Evaluate the log of the Gaussian density at one or more points
+        
+            log p(x) = -r/2 log(2pi) - 1/2 log det(Sigma) 
+                       -1/2 (x-mu)' Sigma^{-1} (x-mu),  
+        
+        where r is the rank, Sigma^{-1} = Q, and det and inverse are 
+        replaced by the pseudo-determinant and pseudo-inverse for 
+        degenerate covariances (density on the support of the field).
+        For intrinsic precisions (see null_space in the constructor), 
+        det(Sigma)^{-1} is the pseudo-determinant of Q (improper density).
+        
+        Inputs:
+        
+            x: double, (n,) vector or (n,m) array of points
+            
+            mode: str, 'precision' (default), or 'covariance'
+            
+        Output:
+        
+            log_p: double, log density (number, or (m,) vector)
         """
-        pass
+        assert self.mode_supported(mode), \
+            'Mode "'+ mode + '" not supported for this random field.'
+        x_is_a_vector = len(x.shape) == 1
+        r = x - self.mu() if x_is_a_vector else x - self.mu()[:,None]
+        if mode in ['precision', 'canonical']:
+            #
+            # Precision: all quadratic forms with one matrix product 
+            # 
+            Q = self.__Q
+            if self.__null_space is not None:
+                log_det = -self.__prec_log_pdet()
+            elif sp.isspmatrix(Q):
+                log_det = -self.__prec_factor().logdet()
+            else:
+                log_det = -2*np.sum(np.log(np.diag(self.__prec_factor())))
+            qform = np.sum(r*Q.dot(r), axis=0)
+        elif mode == 'covariance':
+            assert not isinstance(self.__Sigma, 
+                                  (HMatrix, CirculantEmbedding)), \
+                'Log density not available for compressed covariances.'
+            self.__cov_factor()
+            if self.__f_cov_lowrank is not None:
+                #
+                # Degenerate covariance Sigma = L*L'
+                # 
+                L = self.__f_cov_lowrank
+                LtL = L.T.dot(L)
+                c = linalg.cho_factor(LtL)
+                log_det = 2*np.sum(np.log(np.diag(c[0])))
+                w = linalg.cho_solve(c, L.T.dot(r))
+                qform = np.sum(w**2, axis=0)
+            elif sp.isspmatrix(self.__Sigma):
+                log_det = self.__cov_factor().logdet()
+                qform = np.sum(r*self.__cov_factor()(r), axis=0)
+            else:
+                L = self.__cov_factor()
+                log_det = 2*np.sum(np.log(np.diag(L)))
+                w = linalg.solve_triangular(L, r, lower=True)
+                qform = np.sum(w**2, axis=0)
+        else:
+            raise Exception('For mode, use "precision" or "covariance".')
+        return -0.5*self.rank()*np.log(2*np.pi) - 0.5*log_det - 0.5*qform
     
     
     def Q_solve(self, b):
@@ -944,10 +1619,10 @@ class Gmrf(object):
         
         """
         if sp.isspmatrix(self.__Q):
-            return self.__f_prec(b)
+            return self.__prec_factor()(b)
         else:
-            y = np.linalg.solve(self.__f_prec, b)
-            return np.linalg.solve(self.__f_prec.transpose(),y)
+            y = np.linalg.solve(self.__prec_factor(), b)
+            return np.linalg.solve(self.__prec_factor().transpose(),y)
     
     
     
@@ -964,21 +1639,21 @@ class Gmrf(object):
         if mode == 'precision':
             if sp.isspmatrix(self.__Q):
                 # Sparse
-                f = self.__f_prec
+                f = self.__prec_factor()
                 sqrtDinv = sp.diags(1/np.sqrt(f.D()))
                 return f.apply_Pt(sqrtDinv*f.solve_L(f.apply_P(b))) 
             else: 
                 # Full
-                return np.linalg.solve(self.__f_prec,b)
+                return np.linalg.solve(self.__prec_factor(),b)
         elif mode == 'covariance':
             if sp.isspmatrix(self.__Sigma):
                 # Sparse
-                f = self.__f_cov
+                f = self.__cov_factor()
                 sqrtDinv = sp.diags(1/np.sqrt(f.D()))
                 return f.apply_Pt(sqrtDinv*f.solve_L(f.apply_P(b)))
             else:
                 # Full
-                return np.linalg.solve(self.__f_cov,b)
+                return np.linalg.solve(self.__cov_factor(),b)
     
     
     def Lt_solve(self, b, mode='precision'):
@@ -997,40 +1672,163 @@ class Gmrf(object):
             # 
             if sp.isspmatrix(self.__Q):
                 # Sparse
-                f = self.__f_prec
+                f = self.__prec_factor()
                 sqrtDinv = sp.diags(1/np.sqrt(f.D()))
                 return f.apply_Pt(f.solve_Lt(sqrtDinv*(f.apply_P(b))))
             else:
                 # Full
-                return np.linalg.solve(self.__f_prec.transpose(),b)
+                return np.linalg.solve(self.__prec_factor().transpose(),b)
         elif mode == 'covariance':
             #
             # Covariance matrix
             # 
             if sp.isspmatrix(self.__Sigma):
                 # Sparse
-                f = self.__f_cov
+                f = self.__cov_factor()
                 sqrtDinv = sp.diags(1/np.sqrt(f.D()))
                 return f.apply_Pt(f.solve_Lt(sqrtDinv*(f.apply_P(b))))
             else:
                 # Full
-                return np.linalg.solve(self.__f_cov.transpose(),b)
+                return np.linalg.solve(self.__cov_factor().transpose(),b)
         else:
             raise Exception('For mode, use "precision" or "covariance".')
     
     
-    def KL(self, precision=None, k=None):
+    def marginal_variance(self, selected=False):
+        """
+        Compute the marginal variances diag(Sigma) of the field. 
+        
+        For sparse precision matrices, the entries of Sigma = Q^{-1} on the 
+        sparsity pattern of the Cholesky factor (which includes that of Q) 
+        are computed from the existing CHOLMOD factor by selected inversion
+        (see Gmrf.takahashi), without forming Q^{-1}. 
+        
+        Inputs:
+        
+            selected: bool, also return the selected entries of Sigma 
+                (sparse precision only).
+                
+        Outputs:
+        
+            var: double, (n,) vector of marginal variances
+            
+            *S: double, (n,n) sparse symmetric matrix containing the entries
+                of Sigma on the pattern of L+L' (if selected is True). 
+        """
+        if self.__Q is not None and sp.isspmatrix(self.__Q):
+            #
+            # Selected inversion of P*Q*P' = L*D*L' 
+            #
+            f = self.__prec_factor()
+            L, D = f.L_D()
+            S_low = Gmrf.takahashi(L, D.diagonal()).tocoo()
+            P = f.P()
+            var = np.empty(self.n())
+            var[P] = S_low.diagonal()
+            if not selected:
+                return var
+            rows, cols = P[S_low.row], P[S_low.col]
+            off = S_low.row != S_low.col
+            S = sp.coo_matrix((np.hstack([S_low.data, S_low.data[off]]),
+                               (np.hstack([rows, cols[off]]), 
+                                np.hstack([cols, rows[off]]))), 
+                              shape=(self.n(),self.n())).tocsc()
+            return var, S
+        assert not selected, \
+            'Selected inversion only available for sparse precisions.'
+        if self.mode_supported('precision'):
+            #
+            # Full precision Q = LL' => Sigma = L^{-T} L^{-1}
+            # 
+            L_inv = linalg.solve_triangular(self.__prec_factor(), np.eye(self.n()), 
+                                            lower=True)
+            return np.sum(L_inv**2, axis=0)
+        else:
+            #
+            # Covariance
+            # 
+            Sigma = self.__Sigma
+            if isinstance(Sigma, (HMatrix, CirculantEmbedding)):
+                return Sigma.diagonal()
+            elif sp.isspmatrix(Sigma):
+                return Sigma.diagonal()
+            else:
+                return np.diag(Sigma).copy()
+            
+    
+    def KL(self, k, covariance=None, mass=None, tol=0):
         """
+        Compute the leading k terms of the Karhunen-Loeve expansion 
+        
+            X = mu + sum_i sqrt(lmd_i)*phi_i*z_i,  z_i ~ N(0,1) iid,
+            
+        i.e. the k largest eigenpairs of the generalized eigenproblem 
+        
+            C*phi = lmd*M*phi,  phi'*M*phi = 1, 
+            
+        where C is the Galerkin matrix of the covariance operator and M the 
+        mass matrix, by the implicitly restarted Lanczos method (ARPACK), 
+        so that only matrix-vector products with C and solves with M are 
+        required. The eigenpairs are cached for sampling in mode 'kl'.
+        
         Inputs:
         
+            k: int, number of terms
+            
+            covariance: double, (n,n) Galerkin covariance matrix C (e.g. 
+                from Gmrf.galerkin_covariance). If None, C = M*Sigma*M, 
+                where Sigma is the covariance of the field (or Q^{-1}). 
+            
+            mass: double, (n,n) sparse mass matrix M. If None, it is 
+                assembled from the Gmrf's mesh and element, and taken to be
+                the identity if no element is available.
+                
+            tol: double, relative accuracy of the eigenvalues (0 = machine 
+                precision)
+        
         Outputs:
         
+            lmd: double, (k,) eigenvalues in decreasing order
+            
+            V: double, (n,k) M-orthonormal eigenvectors
         """
-        mesh = self.mesh()
+        n = self.n()
+        assert k < n, 'Number of terms should be smaller than n.'
+        #
+        # Mass matrix
+        # 
+        if mass is None and hasattr(self, 'element'):
+            system = System(self.mesh, self.element)
+            mass = system.assemble(bilinear_forms=[(1,'u','v')]).tocsc()
+        #
+        # Covariance operator
+        # 
+        if covariance is not None:
+            C_dot = covariance.dot
+        else:
+            if self.mode_supported('covariance'):
+                S_dot = self.__Sigma.dot
+            else:
+                S_dot = self.Q_solve
+            if mass is None:
+                C_dot = S_dot
+            else:
+                C_dot = lambda b: mass.dot(S_dot(mass.dot(b)))
+        C = spla.LinearOperator((n,n), matvec=C_dot, dtype=float)
+        #
+        # Leading eigenpairs
+        # 
+        lmd, V = spla.eigsh(C, k=k, M=mass, which='LA', tol=tol)
+        i_sort = np.argsort(lmd)[::-1]
+        lmd, V = lmd[i_sort], V[:,i_sort]
+        lmd[lmd < 0] = 0
+        self.__kl = (lmd, V)
+        return lmd, V
         
     
     
-    def sample(self, n_samples=None, z=None, mode='precision'):
+    
+    def sample(self, n_samples=None, z=None, mode='precision', rng=None):
         """
         Generate sample realizations from Gaussian random field.
         
@@ -1038,10 +1836,16 @@ class Gmrf(object):
         
             n_samples: int, number of samples to generate
             
-            z: (n,n_samples) random vector ~N(0,I).
+            z: (n,n_samples) random vector ~N(0,I), or (k,n_samples) in 
+                mode 'kl'.
             
             mode: str, specify parameters used to simulate random field
-                ['precision', 'covariance', 'canonical']
+                ['precision', 'covariance', 'canonical', 'kl', 'krylov'], 
+                where 'kl' uses the truncated Karhunen-Loeve expansion (see
+                KL) and 'krylov' the Lanczos method (see krylov_sample).
+                
+            rng: numpy.random.Generator, used to generate z (default: the
+                global numpy random state).
             
             
         Outputs:
@@ -1058,13 +1862,26 @@ class Gmrf(object):
         """
         assert self.mode_supported(mode), \
             'Mode "'+ mode + '" not supported for this random field.'
+        if mode == 'covariance' and \
+        isinstance(self.__Sigma, CirculantEmbedding):
+            #
+            # FFT sampling draws its own (complex) random numbers
+            # 
+            assert z is None, \
+                'Circulant embedding: specify sample size, not random array.'
+            assert n_samples is not None, 'Specify sample size.'
+            v = self.__Sigma.sample(n_samples, rng=rng)
+            return v + self.mu()[:,None]
         #
         # Preprocess z   
         # 
         if z is None:
             assert n_samples is not None, \
                 'Specify either random array or sample size.'
-            z = np.random.normal(size=(self.n(), n_samples))
+            n_z = self.__kl[0].size if mode == 'kl' else self.n()
+            if rng is None:
+                rng = np.random
+            z = rng.normal(size=(n_z, n_samples))
             z_is_a_vector = False
         else:
             #
@@ -1084,34 +1901,165 @@ class Gmrf(object):
         # 
         if mode in ['precision','canonical']:
             v = self.Lt_solve(z, mode='precision')
+        elif mode == 'krylov':
+            v, dummy = self.krylov_sample(z=z)
+        elif mode == 'kl':
+            lmd, V = self.__kl
+            if z_is_a_vector:
+                v = V.dot(np.sqrt(lmd)*z)
+            else:
+                v = V.dot(np.sqrt(lmd)[:,None]*z)
         elif mode == 'covariance':
-            if self.__f_cov is not None:
+            if isinstance(self.__Sigma, HMatrix):
+                v = self.__Sigma.sqrt_dot(z)
+            elif self.__cov_factor() is not None:
                 v = self.L(z, mode='covariance')
-            elif self.__svd is not None:
-                U,s,_ = self.__svd
-                v = U.dot(np.dot(np.sqrt(np.diag(s)), z))  
+            elif self.__f_cov_lowrank is not None:
+                #
+                # Low rank factor only needs the first r random numbers
+                # 
+                L = self.__f_cov_lowrank
+                v = L.dot(z[:L.shape[1]])
         #
-        # Add mean
+        # Add mean (broadcast)
         # 
         if z_is_a_vector:
             return v + self.mu()
         else:
-            return v + self.mu(n_samples)
+            return v + self.mu()[:,None]
         
     
+    def krylov_sample(self, n_samples=None, z=None, tol=1e-6, max_iter=500,
+                      rng=None):
+        """
+        Generate centered samples Q^{-1/2}*z ~ N(0,Q^{-1}) without factorizing
+        the precision matrix, by the Lanczos method (see Gmrf.lanczos), 
+        which requires only products with Q.
+        
+        Inputs:
+        
+            n_samples: int, number of samples
+            
+            z: double, (n,n_samples) array of N(0,1) random numbers
+            
+            tol: double, relative tolerance of the Lanczos iteration 
+            
+            max_iter: int, maximum dimension of the Krylov spaces
+            
+            rng: numpy.random.Generator, used to generate z
+            
+        Outputs:
+        
+            v: double, (n,n_samples) centered samples
+            
+            info: dict, with keys 'n_iter', and 'error', the maximum number 
+                of iterations and the maximum (estimated) relative error of
+                the samples in the block.  
+        """
+        assert self.mode_supported('krylov'), \
+            'Krylov sampling requires the precision matrix.'
+        if z is None:
+            assert n_samples is not None, \
+                'Specify either random array or sample size.'
+            if rng is None:
+                rng = np.random
+            z = rng.normal(size=(self.n(), n_samples))
+        inv_sqrt = lambda lmd: 1/np.sqrt(lmd)
+        v, info = Gmrf.lanczos(self.__Q.dot, z, inv_sqrt, tol=tol, 
+                               max_iter=max_iter, return_info=True)
+        info = {key: np.max(value) for key, value in info.items()}
+        return v, info
+    
+    
+    def sample_blocks(self, n_samples, block_size=100, seed=None, 
+                      mode='precision', n_workers=None):
+        """
+        Generate samples in blocks (generator), so that at most a few 
+        blocks are held in memory at any time. 
+        
+        Each block is drawn from its own numpy.random.Generator, seeded by
+        a child of numpy.random.SeedSequence(seed), so that the samples 
+        only depend on the seed and block size, and not on whether the 
+        blocks are computed serially or in parallel.
+        
+        Inputs:
+        
+            n_samples: int, total number of samples 
+            
+            block_size: int, number of samples per block
+            
+            seed: int, entropy of the seed sequence (None: fresh entropy)
+            
+            mode: str, see sample
+            
+            n_workers: int, number of worker processes. The workers are 
+                forked, so that they share the field (and its factors) with 
+                the parent process (POSIX only).
+                
+        Yields:
+        
+            x: double, (n,b) block of samples, b <= block_size
+        """
+        assert self.mode_supported(mode), \
+            'Mode "'+ mode + '" not supported for this random field.'
+        n_blocks = -(-n_samples//block_size)
+        seeds = np.random.SeedSequence(seed).spawn(n_blocks)
+        sizes = [min(block_size, n_samples-i*block_size) \
+                 for i in range(n_blocks)]
+        if n_workers is None or n_workers == 1:
+            #
+            # Serial
+            # 
+            for seed_seq, size in zip(seeds, sizes):
+                yield _sample_block(self, seed_seq, size, mode)
+        else:
+            #
+            # Parallel: keep at most 2*n_workers blocks in flight
+            #
+            # Factorize in the parent, so that forked workers inherit the
+            # factor instead of each recomputing it.
+            #
+            if mode in ['precision', 'canonical']:
+                self.__prec_factor()
+            elif mode == 'covariance':
+                if self.__cov_factor() is not None:
+                    self.L(mode='covariance')
+            global _FORKED_GMRF
+            _FORKED_GMRF = self
+            context = multiprocessing.get_context('fork')
+            try:
+                with ProcessPoolExecutor(max_workers=n_workers, 
+                                         mp_context=context) as executor:
+                    futures = deque()
+                    for seed_seq, size in zip(seeds, sizes):
+                        futures.append(executor.submit(_sample_forked_block, 
+                                                       seed_seq, size, mode))
+                        if len(futures) >= 2*n_workers:
+                            yield futures.popleft().result()
+                    while futures:
+                        yield futures.popleft().result()
+            finally:
+                _FORKED_GMRF = None
+                
+                
     def mode_supported(self, mode):
         """
         Determine whether enough information is available to process given mode
         """
         if mode == 'precision':
+            return self.__Q is not None and \
+                not isinstance(self.__Q, spla.LinearOperator)
+        elif mode == 'krylov':
             return self.__Q is not None
         elif mode == 'covariance':
             return self.__Sigma is not None
         elif mode == 'canonical':
-            return self.__Q is not None
+            return self.mode_supported('precision')
+        elif mode == 'kl':
+            return self.__kl is not None
         else:
-            raise Exception('For modes, use "precision", ' + \
-                            '"covariance", or "canonical".')
+            raise Exception('For modes, use "precision", "krylov", ' + \
+                            '"covariance", "canonical", or "kl".')
             
     
     def condition(self, constraint=None, constraint_type='pointwise',
@@ -1128,7 +2076,10 @@ class Gmrf(object):
                 'hard': (A, b), where A is the (k,n) constraint matrix and 
                     b is the (k,m) array of realizations (usually m is None).
                 
-                'soft': (A, Q)
+                'soft': (A, e, R), where A is the (k,n) sparse observation
+                    matrix (e.g. DofHandler.eval_matrix), e the (k,) vector 
+                    of observations and R the noise variance, either a 
+                    number or a (k,) vector (independent noise).
         
             constraint_type: str, 'pointwise' (default), 'hard', 'soft'.
             
@@ -1136,27 +2087,67 @@ class Gmrf(object):
             
             output: str, type of output 'gmrf', 'sample', 'log_pdf' 
             
+            n_samples: int, number of samples (output='sample')
+            
+            z: double, (n_free,n_samples) array of N(0,1) random numbers 
+                (pointwise constraints, output='sample')
+            
         Output:
         
-            X: Gmrf, conditioned random field. 
+            X: Gmrf, conditioned random field. For pointwise constraints, 
+                the field of the free (unconstrained) entries, or the 
+                (n,n_samples) conditional samples of the entire field.
             
         TODO: Unfinished
         """
         if constraint_type == 'pointwise':
-            i_b, x_b = constraint
-            i_a = [i not in i_b for i in range(self.n())]
-            mu_a, mu_b = self.mu()[i_a], self.mu()[i_b]
-            Q_aa = self.Q().tocsc()[np.ix_(i_a,i_a)]
-            Q_ab = self.Q().tocsc()[np.ix_(i_a,i_b)]
-            
             #
-            # Conditional random field
+            # Conditional field on the free indices: 
             # 
-            mu_agb = mu_a - spla.spsolve(Q_aa, Q_ab.dot(x_b-mu_b))
-            if n_samples is None:
-                return Gmrf(mu=mu_agb, precision=Q_aa)
-            else: 
-                pass
+            #   X_a | X_b = x_b ~ N(mu_a - Q_aa^{-1} Q_ab (x_b-mu_b), Q_aa^{-1})
+            # 
+            i_b, x_b = constraint
+            i_b = np.asarray(i_b)
+            is_a = np.ones(self.n(), dtype=bool)
+            is_a[i_b] = False
+            mu = self.mu()
+            mu_a, mu_b = mu[is_a], mu[i_b]
+            Q = self.Q()
+            if sp.isspmatrix(Q):
+                #
+                # Sparse precision: factorize Q_aa once by CHOLMOD
+                # 
+                Q_a = Q.tocsr()[is_a]
+                Q_aa = Q_a[:,is_a].tocsc()
+                Q_ab = Q_a[:,i_b]
+                f_aa = cholesky(Q_aa)
+                X_a = Gmrf(mu=f_aa(-Q_ab.dot(x_b-mu_b)) + mu_a, 
+                           precision=f_aa)
+            else:
+                #
+                # Full precision
+                # 
+                Q_aa = Q[np.ix_(is_a,is_a)]
+                Q_ab = Q[np.ix_(is_a,i_b)]
+                X_a = Gmrf(mu=mu_a - linalg.solve(Q_aa, Q_ab.dot(x_b-mu_b),
+                                                  assume_a='pos'), 
+                           precision=Q_aa)
+            if output == 'gmrf':
+                return X_a
+            elif output == 'sample':
+                #
+                # Conditional samples (one block solve), with X_b = x_b
+                # 
+                if z is None:
+                    z = np.random.normal(size=(X_a.n(), n_samples))
+                x_a = X_a.sample(z=z, mode='precision')
+                x = np.empty((self.n(),) + x_a.shape[1:])
+                x[is_a] = x_a
+                x[i_b] = x_b if x_a.ndim==1 else np.asarray(x_b)[:,None]
+                return x
+            else:
+                raise Exception('Variable "output" should be: '+\
+                                '"gmrf" or "sample".')
             
         elif constraint_type == 'hard':
             A, e  = constraint
@@ -1216,7 +2207,59 @@ class Gmrf(object):
                 raise Exception('Variable "output" should be: '+\
                                 '"gmrf","sample",or "log_pdf".')
         elif constraint_type == 'soft':
-            pass
+            #
+            # Noisy observations e = A*x + eps, eps ~ N(0,R), R diagonal: 
+            # 
+            #   X | e ~ N(mu + Q_post^{-1} A' R^{-1}(e-A*mu), Q_post^{-1}),
+            #   
+            #   Q_post = Q + A' R^{-1} A = Q + W*W',  W = A' R^{-1/2}
+            # 
+            A, e, R = constraint
+            assert self.mode_supported('precision'), \
+                'Soft constraints require the precision matrix.'
+            A = sp.csr_matrix(A)
+            k = A.shape[0]
+            r_inv = 1/np.asarray(R, dtype=float)*np.ones(k)
+            W = (A.T*sp.diags(np.sqrt(r_inv))).tocsc()
+            Q = self.Q()
+            if sp.isspmatrix(Q):
+                Q = Q.tocsc()
+                WWt = (W*W.T).tocsc()
+                f = self.__prec_factor()
+                if k <= 16:
+                    #
+                    # Few observations: low rank update of the factor
+                    # 
+                    f_post = f.copy()
+                    f_post.update_inplace(W)
+                elif (abs(Q) + abs(WWt)).nnz == Q.nnz:
+                    #
+                    # Same sparsity pattern: reuse symbolic analysis of Q
+                    # 
+                    f_post = f.cholesky(Q + WWt)
+                else:
+                    f_post = cholesky(Q + WWt)
+                Q_post_solve = f_post
+                precision = f_post
+            else:
+                #
+                # Full precision
+                # 
+                Q_post = Q + (W*W.T).toarray()
+                Q_post_solve = lambda b: linalg.solve(Q_post, b, 
+                                                      assume_a='pos')
+                precision = Q_post
+            mu = self.mu()
+            mu_post = mu + Q_post_solve(A.T.dot(r_inv*(e - A.dot(mu))))
+            X_post = Gmrf(mu=mu_post, precision=precision)
+            if output == 'gmrf':
+                return X_post
+            elif output == 'sample':
+                return X_post.sample(n_samples=None if z is not None \
+                                     else n_samples, z=z)
+            else:
+                raise Exception('Variable "output" should be: '+\
+                                '"gmrf" or "sample".')
         else:
             raise Exception('Input "constraint_type" should be:' + \
                             ' "pointwise", "hard", or "soft"')
@@ -1230,4 +2273,739 @@ class Gmrf(object):
             return np.random.normal(self.n())
         elif n_samples > 1:
             return np.random.normal(size=(self.n(),n_samples)) 
-        
\ No newline at end of file
+                
+        
+# =============================================================================
+# Matern Precision
+# =============================================================================
+class MaternPrecision(object):
+    """
+    Builder for the (Cholesky factor of the) precision matrix of the Matern 
+    field (see Gmrf.matern_precision), for repeated use with different 
+    parameters kappa and tau, e.g. in parameter sweeps. 
+    
+    Since the sparsity pattern of the system is independent of kappa and tau,
+    
+        - the mass and stiffness matrices are assembled once (constant 
+          coefficients), or reassembled on the fixed pattern of an Assembler
+          (variable coefficients or boundary conditions);
+          
+        - the symbolic analysis (fill-reducing ordering and elimination 
+          tree) of each of the products factorized in the recursion for 
+          alpha is computed once, after which only numeric factorizations
+          are performed.   
+    """
+    def __init__(self, mesh, element, alpha, boundary_conditions=None):
+        """
+        Constructor
+        
+        Inputs:
+        
+            mesh: Mesh, finite element mesh on which the field is defined
+                (or LinearQuadtree, see fem.System)
+            
+            element: QuadFE, finite element space of piecewise polynomials
+            
+            alpha: int, positive integer 
+            
+            boundary_conditions: dict, boundary conditions (viz. 
+                fem.System.assemble)
+        """
+        system = System(mesh, element)
+        assembler = Assembler(system)
+        #
+        # Mass matrix and stiffness matrices with unit coefficients
+        # 
+        M = assembler.assemble(bilinear_forms=[(1,'u','v')])
+        K = dict()
+        for (du,dv) in [('ux','vx'),('uy','vx'),('ux','vy'),('uy','vy')]:
+            K[(du,dv)] = assembler.assemble(bilinear_forms=[(1,du,dv)])
+        #
+        # Lumped mass matrix
+        # 
+        m_lumped = np.array(M.sum(axis=1)).squeeze()
+        
+        self.__assembler = assembler
+        self.__boundary_conditions = boundary_conditions
+        self.__alpha = alpha
+        self.__M = M
+        self.__K = K
+        self.__m_lumped = m_lumped
+        self.__symbolic = []
+        
+        
+    def stiffness(self, kappa, tau=None):
+        """
+        Return the matrix G = kappa*M + K(tau) 
+        
+        Inputs:
+        
+            kappa: double, positive regularization parameter.
+            
+            tau: (Axx,Axy,Ayy) symmetric tensor or diffusion coefficient 
+                function.
+                
+        Output:
+        
+            G: double, csr_matrix
+        """
+        if tau is None:
+            tau = 1
+        if type(tau) is tuple:
+            assert len(tau)==3, 'Symmetric tensor should have length 3.'
+            axx, axy, ayy = tau
+        else:
+            assert callable(tau) or isinstance(tau, Number)
+            axx, axy, ayy = tau, 0, tau 
+        coefficients = [kappa, axx, axy, ayy]
+        if self.__boundary_conditions is None and \
+        all(isinstance(c, Number) for c in coefficients):
+            #
+            # Constant coefficients: combine precomputed matrices
+            # 
+            K = self.__K
+            return kappa*self.__M + axx*K[('ux','vx')] + \
+                axy*(K[('uy','vx')] + K[('ux','vy')]) + ayy*K[('uy','vy')]
+        else:
+            #
+            # Reassemble on the fixed sparsity pattern
+            # 
+            bf = [(kappa,'u','v'), (axx,'ux','vx'), (ayy,'uy','vy')]
+            if type(tau) is tuple:
+                bf += [(axy,'uy','vx'), (axy,'ux','vy')]
+            return self.__assembler.assemble(bilinear_forms=bf, 
+                        boundary_conditions=self.__boundary_conditions)
+        
+        
+    def operator(self, kappa, tau=None):
+        """
+        Return the Matern precision matrix 
+        
+            Q = (G*M^{-1})^{alpha-1}*G,  G = kappa*M + K(tau) 
+            
+        (with lumped mass matrix M) as a LinearOperator, whose products 
+        only require sparse products with G, e.g. for Krylov sampling of 
+        fields whose precision is too large to factorize. 
+        
+        Inputs:
+        
+            kappa, tau: see stiffness
+            
+        Output:
+        
+            Q: LinearOperator, precision matrix
+        """
+        G = self.stiffness(kappa, tau).tocsr()
+        m_inv = 1/self.__m_lumped
+        alpha = self.__alpha
+        def Q_dot(b):
+            y = G.dot(b)
+            for dummy in range(alpha-1):
+                y = G.dot(m_inv.reshape((-1,)+(1,)*(y.ndim-1))*y)
+            return y
+        return spla.LinearOperator(G.shape, matvec=Q_dot, matmat=Q_dot,
+                                   dtype=float)
+    
+    
+    def factor(self, kappa, tau=None):
+        """
+        Return the Cholesky factor of the Matern precision matrix 
+        
+            Q = (G*M^{-1})^{alpha-1}*G,  G = kappa*M + K(tau) 
+            
+        (with lumped mass matrix M), reusing the symbolic analyses of 
+        previous calls.
+        
+        Inputs:
+        
+            kappa, tau: see stiffness
+            
+        Output:
+        
+            Q: Factor, CHOLMOD Cholesky factor of the precision matrix
+        """
+        G = self.stiffness(kappa, tau).tocsc()
+        m_lumped = self.__m_lumped
+        symbolic = self.__symbolic
+        
+        if np.mod(self.__alpha,2) == 1:
+            #
+            # Odd power alpha: Q1 = G
+            # 
+            A = G
+            if not symbolic:
+                symbolic.append(analyze(A))
+            Q = symbolic[0].cholesky(A)
+            count = 1
+        else:
+            #
+            # Even power alpha: Q2 = G*M^{-1}*G
+            # 
+            A = (G*sp.diags(1/np.sqrt(m_lumped))).tocsc()
+            if not symbolic:
+                symbolic.append(analyze_AAt(A))
+            Q = symbolic[0].cholesky_AAt(A)
+            count = 2
+        stage = 1
+        while count < self.__alpha:
+            #
+            # Update Q <- G*M^{-1}*Q*M^{-1}*G
+            #
+            A = (G*sp.diags(1/m_lumped)*Q.apply_Pt(Q.L())).tocsc()
+            if len(symbolic) == stage:
+                symbolic.append(analyze_AAt(A))
+            Q = symbolic[stage].cholesky_AAt(A)
+            count += 2
+            stage += 1
+        return Q
+    
+    
+# =============================================================================
+# Hierarchical Matrices
+# =============================================================================
+class HMatrix(object):
+    """
+    Hierarchical (H-) matrix approximation of a covariance matrix 
+    
+        Sigma[i,j] = cov(x[i],x[j])
+        
+    The points are clustered by the quadtree of the mesh: they are sorted
+    by the Morton keys (cf. LinearQuadtree) of the fine level cells that 
+    contain them, so that the points in each quadtree cell form a contiguous
+    range (cluster). Pairs of clusters that are far apart relative to their
+    size (admissible blocks) are approximated by low rank factors U*V', 
+    computed by adaptive cross approximation (ACA), all others are either
+    subdivided or stored as dense blocks.
+    
+    Attributes:
+    
+        shape: int, (n,n) shape of the matrix
+    
+        __x: double, (n,2) array of points, in cluster order
+        
+        __perm: int, (n,) permutation, such that __x = x[__perm]
+        
+        __dense_blocks: list, of (i0,i1,j0,j1,D) with D = Sigma[i0:i1,j0:j1]
+        
+        __lowrank_blocks: list, of (i0,i1,j0,j1,U,V) with Sigma[i0:i1,j0:j1]
+            approximately U*V' 
+            
+    Note: Only blocks on or above the (block) diagonal are stored, those 
+        below follow by symmetry.
+    """
+    def __init__(self, cov_fn, cov_par, mesh, x=None, M=None, tol=1e-6, 
+                 eta=1.0, leaf_size=32, max_rank=None):
+        """
+        Constructor
+        
+        Inputs:
+        
+            cov_fn: function, covariance kernel (e.g. Gmrf.exponential_cov)
+            
+            cov_par: dict, parameter name/value pairs
+            
+            mesh: Mesh, quadtree mesh whose box and coarse grid define the 
+                cluster tree 
+                
+            x: double, (n,2) array of points in the mesh's box. If None, the
+                vertices of the mesh are used (cf. assembly_type=
+                'finite_differences' in Gmrf.covariance_matrix).
+                
+            M: double, anisotropy tensor
+            
+            tol: double, relative accuracy of the low rank blocks
+            
+            eta: double, admissibility parameter: a block is admissible 
+                if min(diam(s),diam(t)) <= eta*dist(s,t).
+                
+            leaf_size: int, blocks with a cluster of at most this many 
+                points are stored as dense blocks.
+                
+            max_rank: int, maximum rank of low rank blocks
+        """
+        if x is None:
+            dofhandler = DofHandler(mesh, QuadFE(2,'Q1'))
+            dofhandler.distribute_dofs()
+            x = dofhandler.dof_vertices()
+        x = np.asarray(x, dtype=float)
+        assert len(x.shape)==2 and x.shape[1]==2, \
+            'Points should be passed as an (n,2) array.'
+        n = x.shape[0]
+        #
+        # Integer coordinates of the points' cells on a fine level 
+        # 
+        grid_size = (1,1) if mesh.grid_size() is None else mesh.grid_size()
+        nx, ny = grid_size
+        x0, x1, y0, y1 = mesh.box()
+        grid_depth = int(np.ceil(np.log2(max(nx, ny))))
+        level = min(20, 30 - grid_depth)
+        i = np.floor((x[:,0]-x0)/(x1-x0)*(nx << level)).astype(np.int64)
+        j = np.floor((x[:,1]-y0)/(y1-y0)*(ny << level)).astype(np.int64)
+        i = np.clip(i, 0, (nx << level)-1)
+        j = np.clip(j, 0, (ny << level)-1)
+        #
+        # Morton keys, the coarse grid being embedded in a square grid of 
+        # 2^grid_depth cells per side, so that clusters are split in four 
+        # on every level (including those of the coarse grid)
+        # 
+        keys = LinearQuadtree.interleave(i, j)
+        depth = grid_depth + level
+        perm = np.argsort(keys, kind='mergesort')
+        
+        self.shape = (n, n)
+        self.__cov_fn = cov_fn
+        self.__cov_par = cov_par
+        self.__M = M
+        self.__n = n
+        self.__x = x[perm]
+        self.__perm = perm
+        self.__keys = keys[perm]
+        self.__depth = depth
+        self.__tol = tol
+        self.__eta = eta
+        self.__leaf_size = leaf_size
+        self.__max_rank = max_rank
+        self.__dense_blocks = []
+        self.__lowrank_blocks = []
+        #
+        # Build block tree, starting from the root cluster
+        # 
+        root = (0, 0, n)
+        self.build(root, root)
+        
+        
+    def entries(self, i0, i1, j0, j1):
+        """
+        Evaluate the kernel at all pairs of points in two (ordered) ranges
+        """
+        return Gmrf.kernel_block(self.__cov_fn, self.__cov_par, 
+                                 self.__x[i0:i1], self.__x[j0:j1], M=self.__M)
+        
+        
+    def children(self, cluster):
+        """
+        Return the non-empty sub-clusters of a cluster (level, start, stop),
+        i.e. the sets of points in the children of its quadtree cell.
+        """
+        level, start, stop = cluster
+        if level == self.__depth:
+            return []
+        shift = 2*(self.__depth - (level+1))
+        _, first = np.unique(self.__keys[start:stop] >> shift, 
+                             return_index=True)
+        bounds = list(first + start) + [stop]
+        return [(level+1, bounds[k], bounds[k+1]) for k in range(len(first))]
+    
+    
+    def admissible(self, s, t):
+        """
+        Determine whether clusters s and t are well separated, i.e.
+        min(diam(s),diam(t)) <= eta*dist(s,t), where diameters and distances
+        are those of the bounding boxes of the points.
+        """
+        xs = self.__x[s[1]:s[2]]
+        xt = self.__x[t[1]:t[2]]
+        s_min, s_max = xs.min(axis=0), xs.max(axis=0)
+        t_min, t_max = xt.min(axis=0), xt.max(axis=0)
+        diam = min(np.linalg.norm(s_max-s_min), np.linalg.norm(t_max-t_min))
+        gap = np.maximum(0, np.maximum(s_min-t_max, t_min-s_max))
+        return diam <= self.__eta*np.linalg.norm(gap)
+        
+        
+    def build(self, s, t):
+        """
+        Recursively approximate the block of clusters s and t 
+        """
+        _, i0, i1 = s
+        _, j0, j1 = t
+        if s != t and (i1-i0)*(j1-j0) > self.__leaf_size**2 \
+        and self.admissible(s, t):
+            #
+            # Far field: try a low rank approximation (unless the block is
+            # cheaper to store in full)
+            # 
+            UV = self.aca(i0, i1, j0, j1)
+            if UV is not None:
+                self.__lowrank_blocks.append((i0, i1, j0, j1) + UV)
+                return
+        s_children, t_children = self.children(s), self.children(t)
+        if i1-i0 <= self.__leaf_size or j1-j0 <= self.__leaf_size \
+        or len(s_children)==0 or len(t_children)==0:
+            #
+            # Near field: dense block
+            # 
+            self.__dense_blocks.append((i0, i1, j0, j1, 
+                                        self.entries(i0, i1, j0, j1)))
+        else:
+            #
+            # Subdivide (blocks on or above the diagonal)
+            # 
+            for cs in s_children:
+                for ct in t_children:
+                    if s != t or ct[1] >= cs[1]:
+                        self.build(cs, ct)
+    
+    
+    def aca(self, i0, i1, j0, j1):
+        """
+        Adaptive cross approximation (with partial pivoting) of the block 
+        Sigma[i0:i1,j0:j1] 
+        
+        Outputs:
+        
+            U, V: double, (m,k) and (n,k) factors, so that U*V' approximates 
+                the block to within the relative tolerance, or None if the 
+                low rank factors would require more storage than the block.
+        """
+        m, n = i1-i0, j1-j0
+        max_rank = min(m, n)//2
+        if self.__max_rank is not None:
+            max_rank = min(max_rank, self.__max_rank)
+        U, V = [], []
+        used = np.zeros(m, dtype=bool)
+        norm2 = 0
+        i = 0
+        for _ in range(m):
+            if len(U) >= max_rank:
+                return None
+            #
+            # Residual of the pivot row
+            # 
+            used[i] = True
+            r = self.entries(i0+i, i0+i+1, j0, j1).ravel()
+            for u, v in zip(U, V):
+                r -= u[i]*v
+            j = np.argmax(np.abs(r))
+            if np.abs(r[j]) <= 1e-14*np.sqrt(norm2) or r[j] == 0:
+                #
+                # Row is (numerically) reproduced: try another one
+                # 
+                if all(used):
+                    break
+                i = np.argmin(used)
+                continue
+            v = r/r[j]
+            #
+            # Residual of the pivot column
+            # 
+            u = self.entries(i0, i1, j0+j, j0+j+1).ravel()
+            for uk, vk in zip(U, V):
+                u -= uk*vk[j]
+            #
+            # Update estimate of the approximation's Frobenius norm 
+            # 
+            for uk, vk in zip(U, V):
+                norm2 += 2*np.dot(uk, u)*np.dot(vk, v)
+            norm2 += np.dot(u, u)*np.dot(v, v)
+            U.append(u)
+            V.append(v)
+            if np.linalg.norm(u)*np.linalg.norm(v) <= \
+            self.__tol*np.sqrt(abs(norm2)):
+                break
+            #
+            # Next pivot row 
+            # 
+            u_abs = np.abs(u)
+            u_abs[used] = -1
+            i = np.argmax(u_abs)
+            if u_abs[i] < 0:
+                break
+        if len(U) == 0:
+            return np.zeros((m,1)), np.zeros((n,1))
+        return np.array(U).T, np.array(V).T
+    
+    
+    def n_entries(self):
+        """
+        Return the number of stored entries 
+        """
+        n_entries = 0
+        for block in self.__dense_blocks:
+            n_entries += block[4].size
+        for block in self.__lowrank_blocks:
+            n_entries += block[4].size + block[5].size
+        return n_entries
+    
+    
+    def dot(self, b):
+        """
+        Compute the matrix-vector product Sigma*b
+        
+        Inputs:
+        
+            b: double, (n,) vector or (n,k) array
+        """
+        b = np.asarray(b)
+        bp = b[self.__perm]
+        y = np.zeros(bp.shape)
+        for i0, i1, j0, j1, D in self.__dense_blocks:
+            y[i0:i1] += D.dot(bp[j0:j1])
+            if i0 != j0:
+                y[j0:j1] += D.T.dot(bp[i0:i1])
+        for i0, i1, j0, j1, U, V in self.__lowrank_blocks:
+            y[i0:i1] += U.dot(V.T.dot(bp[j0:j1]))
+            y[j0:j1] += V.dot(U.T.dot(bp[i0:i1]))
+        Sb = np.empty(y.shape)
+        Sb[self.__perm] = y
+        return Sb
+    
+    
+    def diagonal(self):
+        """
+        Return the diagonal of the matrix
+        """
+        d = np.empty(self.__n)
+        for i0, i1, j0, _, D in self.__dense_blocks:
+            if i0 == j0:
+                d[self.__perm[i0:i1]] = np.diag(D)
+        return d
+    
+    
+    def toarray(self):
+        """
+        Return the matrix as a dense array
+        """
+        return self.dot(np.eye(self.__n))
+    
+    
+    def solve(self, b, tol=1e-8, max_iter=None):
+        """
+        Approximately solve Sigma*x = b by the conjugate gradient method, 
+        preconditioned by the inverse of the diagonal.
+        
+        Inputs:
+        
+            b: double, (n,) vector or (n,k) array of right hand sides
+            
+            tol: double, relative tolerance of the residual
+            
+            max_iter: int, maximum number of iterations
+        """
+        A = spla.LinearOperator(self.shape, matvec=self.dot)
+        P = sp.diags(1/self.diagonal())
+        if len(b.shape) == 1:
+            x, _ = spla.cg(A, b, tol=tol, maxiter=max_iter, M=P)
+        else:
+            x = np.empty(b.shape)
+            for k in range(b.shape[1]):
+                x[:,k], _ = spla.cg(A, b[:,k], tol=tol, maxiter=max_iter, 
+                                    M=P)
+        return x
+    
+    
+    def sqrt_dot(self, z, tol=1e-8, max_iter=100):
+        """
+        Approximate Sigma^{1/2}*z by the Lanczos method, e.g. to sample 
+        from N(0,Sigma). 
+        
+        Inputs:
+        
+            z: double, (n,) vector or (n,k) array
+            
+            tol, max_iter: see Gmrf.lanczos
+        """
+        sqrt = lambda lmd: np.sqrt(np.maximum(lmd, 0))
+        return Gmrf.lanczos(self.dot, z, sqrt, tol=tol, max_iter=max_iter)
+    
+    
+# =============================================================================
+# Circulant Embedding
+# =============================================================================
+class CirculantEmbedding(object):
+    """
+    Circulant embedding of the covariance matrix of a stationary kernel on 
+    a uniform grid
+    
+        Sigma[i,j] = cov(x[i]-x[j]), 
+        
+    where the points x lie on an (m1 x m2) lattice with spacings hx, hy. 
+    Sigma is block Toeplitz, with Toeplitz blocks, and can be embedded in a 
+    block circulant matrix with circulant blocks on an (N1 x N2) torus, 
+    N1 >= 2(m1-1), N2 >= 2(m2-1), whose eigenvalues are given by the 2D 
+    discrete Fourier transform of its first row. If these are nonnegative, 
+    samples are generated in O(N log N) by the FFT, two at a time (the real 
+    and imaginary parts of one complex sample).
+    
+    Attributes:
+    
+        shape: int, (n,n) shape of the covariance matrix
+        
+        __lattice: int, (n,2) lattice indices (i,j) of the Q1 dofs 
+        
+        __m: int, (m1,m2) number of lattice points in each direction
+        
+        __N: int, (N1,N2) size of the embedding torus
+        
+        __eig: double, (N1,N2) eigenvalues of the circulant matrix
+        
+    Note: If the eigenvalues are still negative after max_padding 
+        enlargements of the torus, they are set to zero (approximate 
+        embedding), see the attribute 'exact'.
+    """
+    def __init__(self, cov_fn, cov_par, mesh, M=None, max_padding=3,
+                 tol=1e-10):
+        """
+        Constructor
+        
+        Inputs: 
+        
+            cov_fn: function, stationary covariance kernel (e.g. 
+                Gmrf.exponential_cov)
+            
+            cov_par: dict, parameter name/value pairs
+            
+            mesh: Mesh, uniformly refined quadtree mesh 
+            
+            M: double, anisotropy tensor
+            
+            max_padding: int, maximum number of times the embedding torus
+                is doubled in order to obtain nonnegative eigenvalues.
+            
+            tol: double, relative tolerance below which negative eigenvalues
+                are considered to be zero. 
+        """
+        lattice = CirculantEmbedding.lattice(mesh)
+        assert lattice is not None, \
+            'The Q1 dof vertices of the mesh do not form a uniform grid.'
+        ij, (m1, m2), (hx, hy) = lattice
+        n = ij.shape[0]
+        #
+        # Enlarge the torus until the embedding is nonnegative definite
+        # 
+        N1, N2 = max(2*(m1-1),1), max(2*(m2-1),1)
+        for dummy in range(max_padding+1):
+            #
+            # First row: kernel at the (signed) lags of the torus
+            # 
+            k1, k2 = np.arange(N1), np.arange(N2)
+            k1[k1 > N1//2] -= N1
+            k2[k2 > N2//2] -= N2
+            K1, K2 = np.meshgrid(k1*hx, k2*hy, indexing='ij')
+            lags = np.array([K1.ravel(), K2.ravel()]).T
+            c = Gmrf.kernel_block(cov_fn, cov_par, lags, np.zeros((1,2)), M)
+            eig = np.fft.fft2(c.reshape(N1,N2)).real
+            exact = eig.min() >= -tol*eig.max()
+            if exact:
+                break
+            N1, N2 = 2*N1, 2*N2
+        eig[eig < 0] = 0
+        
+        self.shape = (n,n)
+        self.exact = exact
+        self.__lattice = ij
+        self.__m = (m1, m2)
+        self.__N = (N1, N2)
+        self.__eig = eig
+        
+        
+    @staticmethod
+    def lattice(mesh):
+        """
+        Determine whether the Q1 dof vertices of a mesh form a uniform grid 
+        and if so, compute their lattice indices.
+        
+        Input:
+        
+            mesh: Mesh, quadtree mesh
+            
+        Output:
+        
+            lattice: tuple (ij, (m1,m2), (hx,hy)), where ij is the (n,2) 
+                integer array of lattice indices of the dofs (in DofHandler 
+                order), m1, m2 are the numbers of grid points, and hx, hy 
+                the grid spacings in the x- and y-directions, or None if the
+                vertices do not form a uniform grid (e.g. if the mesh has 
+                hanging nodes). 
+        """
+        dofhandler = DofHandler(mesh, QuadFE(2,'Q1'))
+        dofhandler.distribute_dofs()
+        x = dofhandler.dof_vertices()
+        n = x.shape[0]
+        ij, m, h = [], [], []
+        for k in range(2):
+            x_unique = np.unique(np.round(x[:,k], 12))
+            if len(x_unique) < 2:
+                return None
+            hk = np.diff(x_unique).min()
+            mk = int(np.rint((x_unique[-1]-x_unique[0])/hk)) + 1
+            ik = np.rint((x[:,k]-x_unique[0])/hk).astype(int)
+            if not np.allclose(x_unique[0] + ik*hk, x[:,k]):
+                return None
+            ij.append(ik)
+            m.append(mk)
+            h.append(hk)
+        if n != m[0]*m[1]:
+            return None
+        return np.array(ij).T, tuple(m), tuple(h)
+    
+    
+    def embed(self, b):
+        """
+        Place vector(s) in DofHandler order on the embedding torus
+        
+        Inputs:
+        
+            b: double, (n,) vector or (n,k) array
+            
+        Output:
+        
+            B: double, (N1,N2) or (N1,N2,k) array, zero outside the lattice
+        """
+        B = np.zeros(self.__N + b.shape[1:], dtype=b.dtype)
+        B[self.__lattice[:,0], self.__lattice[:,1]] = b
+        return B
+    
+    
+    def dot(self, b):
+        """
+        Compute the matrix-vector product Sigma*b in O(N log N) operations
+        
+        Inputs:
+        
+            b: double, (n,) vector or (n,k) array
+        """
+        b = np.asarray(b, dtype=float)
+        B = self.embed(b)
+        eig = self.__eig.reshape(self.__N + (1,)*(b.ndim-1))
+        SB = np.fft.ifft2(eig*np.fft.fft2(B, axes=(0,1)), axes=(0,1)).real
+        return SB[self.__lattice[:,0], self.__lattice[:,1]]
+    
+    
+    def toarray(self):
+        """
+        Return the covariance matrix as a dense array
+        """
+        return self.dot(np.eye(self.shape[0]))
+    
+    
+    def diagonal(self):
+        """
+        Return the diagonal of the covariance matrix
+        """
+        return np.ones(self.shape[0])*self.__eig.mean()
+        
+        
+    def sample(self, n_samples=1, rng=None):
+        """
+        Generate centered samples ~N(0,Sigma) by the FFT
+        
+        Inputs: 
+        
+            n_samples: int, number of samples
+            
+            rng: numpy.random.Generator (default: global numpy random state)
+            
+        Output:
+        
+            v: double, (n,n_samples) array of samples in DofHandler order
+        """
+        N1, N2 = self.__N
+        n_complex = (n_samples+1)//2
+        if rng is None:
+            rng = np.random
+        z = rng.normal(size=(N1,N2,n_complex)) \
+          + 1j*rng.normal(size=(N1,N2,n_complex))
+        sqrt_eig = np.sqrt(self.__eig/(N1*N2))[:,:,None]
+        V = np.fft.fft2(sqrt_eig*z, axes=(0,1))
+        V = V[self.__lattice[:,0], self.__lattice[:,1]]
+        return np.hstack([V.real, V.imag])[:,:n_samples]
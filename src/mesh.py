@@ -31,6 +31,8 @@ class Mesh(object):
         self.__triangulated = False 
         self.__mesh_count = 0
         self.__dim = 2  # TODO: Change this in the case of 1D
+        self.__leaves = {}
+        self.__quadtrees = {}
         
     @classmethod 
     def copymesh(cls, mesh):
@@ -94,11 +96,7 @@ class Mesh(object):
         """
         Return the number of cells
         """
-        if hasattr(self, '__n_quadcells'):
-            return self.__n_quadcells
-        else:
-            self.__n_quadcells = len(self.__root_node.find_leaves(flag=flag))
-            return self.__n_quadcells
+        return len(self.nodes(flag=flag))
     
             
     def root_node(self):
@@ -145,23 +143,68 @@ class Mesh(object):
         return boundary
                         
 
-    def node_containing_points(self, x, flag=None):
+    def node_containing_points(self, x, flag=None, tie_break='upper'):
         """
         Locate the node corresponding to the smallest cell that contains point
         x. If x has multiple points, return a list of nodes.
         
         Inputs:
         
-            x: double, array of points
+            x: double, point (x,y), list of points, or (n,2) array
             
             flag: str, marker specifying subclass of nodes.
             
+            tie_break: str, 'upper' or 'lower', rule for points on shared 
+                edges (see LinearQuadtree.locate).
+            
         Outputs: 
         
-            nodes: Node, list of of Nodes
+            nodes: Node, list of of Nodes (None for points outside the mesh)
         """
-        pass
+        index = self.locate_points(x, flag=flag, tie_break=tie_break)
+        leaves = self.nodes(flag=flag)
+        nodes = [leaves[i] if i >= 0 else None for i in index]
+        if np.ndim(x) == 1:
+            return nodes[0]
+        else:
+            return nodes
+    
     
+    def locate_points(self, x, flag=None, tie_break='upper'):
+        """
+        Locate the LEAF nodes containing a set of points
+        
+        Inputs:
+        
+            x: double, point (x,y), list of points, or (n,2) array 
+            
+            flag: str/int, marker specifying subclass of nodes.
+            
+            tie_break: str, 'upper' or 'lower', see LinearQuadtree.locate
+            
+        Outputs:
+        
+            index: int, (n,) array of positions of the containing nodes in 
+                the list self.nodes(flag=flag), or -1 for points not 
+                contained in any node.
+        """
+        return self.linear_quadtree(flag=flag).locate(x, tie_break=tie_break)
+    
+    
+    def linear_quadtree(self, flag=None):
+        """
+        Return the LinearQuadtree of the (flagged) LEAF nodes, whose cells 
+        are ordered as the list self.nodes(flag=flag). 
+        
+        Note: As the node lists, linear quadtrees are cached for each flag and 
+            recomputed only when the tree has been modified since. 
+        """
+        count = self.__root_node.modification_count()
+        if flag not in self.__quadtrees or \
+        self.__quadtrees[flag][0] != count:
+            self.__quadtrees[flag] = (count, 
+                                      LinearQuadtree.from_mesh(self, flag))
+        return self.__quadtrees[flag][1]
         
         
     def unmark(self, nodes=False, quadcells=False, quadedges=False, quadvertices=False,
@@ -278,8 +321,16 @@ class Mesh(object):
         Outputs: 
             
             nodes: list, of (marked/unmarked) tree nodes.
-        """
-        return self.root_node().find_leaves(flag=flag, nested=nested)
+            
+        Note: The lists of nodes are cached for each (flag, nested) pair and
+            recomputed only when the tree has been modified since.
+        """
+        count = self.__root_node.modification_count()
+        key = (flag, nested)
+        if key not in self.__leaves or self.__leaves[key][0] != count:
+            leaves = self.__root_node.find_leaves(flag=flag, nested=nested)
+            self.__leaves[key] = (count, leaves)
+        return list(self.__leaves[key][1])
          
     
     def iter_quadcells(self, flag=None, nested=False):
@@ -545,6 +596,559 @@ class Mesh(object):
         return ax
     
     
+class LinearQuadtree(object):
+    """
+    Description: Compact (linear) quadtree, in which the LEAF cells of a 
+        mesh are stored as numpy arrays of Morton (Z-order) keys and levels, 
+        rather than as a linked structure of Node objects. 
+        
+        Cells are indexed relative to a coarse grid of nx-by-ny cells 
+        (level 0) covering the bounding box. The key of a cell at level l is
+        
+            key = (j0*nx + i0) << 2*l | morton(i_loc, j_loc), 
+        
+        where (i0,j0) is the position of its coarse ancestor in the grid, and
+        the l lowest bit pairs interleave the bits of its local position 
+        (i_loc, j_loc) within that ancestor, x-bits first. The 2 lowest bits
+        of a key are therefore the position of the cell within its parent 
+        (0->SW, 1->SE, 2->NW, 3->NE, cf. Node.pos2id), parents are obtained 
+        by shifting 2 bits to the right, and leaves sorted by their keys 
+        (extended to a common level) are in the same order as that of 
+        Node.find_leaves().
+        
+    Attributes:
+    
+        __box: double, bounding box [x0,x1,y0,y1]
+        
+        __grid_size: int, tuple (nx,ny) of the coarse grid (or None)
+        
+        __keys: int, (n_cells,) array of Morton keys of the LEAF cells
+        
+        __levels: int, (n_cells,) array of levels of the LEAF cells
+        
+    Note: Keys are stored as 64 bit integers, so that the maximum level is 
+        (62 - log2(nx*ny))/2.
+    """
+    def __init__(self, box=[0.,1.,0.,1.], grid_size=None, keys=None, 
+                 levels=None):
+        """
+        Constructor
+        
+        Inputs:
+        
+            box: double, bounding box [x0,x1,y0,y1]
+            
+            grid_size: int, tuple (nx,ny) specifying the coarse grid  
+            
+            keys: int, (n_cells,) array of LEAF keys, sorted in Z-order. 
+                If None, the leaves are the cells of the coarse grid.
+            
+            levels: int, (n_cells,) array of LEAF levels
+        """
+        if grid_size is not None:
+            assert type(grid_size) is tuple \
+            and all(type(i) is int for i in grid_size), \
+            'Grid size should be a tuple of integers'
+            nx, ny = grid_size
+        else:
+            nx, ny = 1, 1
+        if keys is None:
+            keys = np.arange(nx*ny, dtype=np.int64)
+            levels = np.zeros(nx*ny, dtype=np.int64)
+        else:
+            assert levels is not None and len(keys)==len(levels), \
+            'Specify the level of each key.'
+        self.__box = list(box)
+        self.__grid_size = grid_size
+        self.__nx = nx
+        self.__ny = ny
+        self.__keys = np.asarray(keys, dtype=np.int64)
+        self.__levels = np.asarray(levels, dtype=np.int64)
+        
+    
+    @classmethod
+    def from_mesh(cls, mesh, flag=None):
+        """
+        Construct a linear quadtree from the (flagged) LEAF nodes of a Mesh
+        
+        Inputs:
+        
+            mesh: Mesh, quadtree mesh 
+            
+            flag: str/int, marker of the LEAF nodes to be included
+        """
+        grid_size = mesh.grid_size()
+        nx = 1 if grid_size is None else grid_size[0]
+        offset = 0 if grid_size is None else 1
+        leaves = mesh.nodes(flag=flag)
+        keys = np.empty(len(leaves), dtype=np.int64)
+        levels = np.empty(len(leaves), dtype=np.int64)
+        for n in range(len(leaves)):
+            address = leaves[n].address
+            if offset == 1:
+                i0, j0 = address[0]
+                key = j0*nx + i0
+            else:
+                key = 0
+            for idx in address[offset:]:
+                key = (key << 2) | idx
+            keys[n] = key
+            levels[n] = len(address) - offset
+        return cls(box=mesh.box(), grid_size=grid_size, keys=keys, 
+                   levels=levels)
+        
+        
+    def to_mesh(self):
+        """
+        Construct the equivalent Mesh (Node tree linked to a QuadCell), to 
+        be used with System, DofHandler, Plot, etc. 
+        """
+        mesh = Mesh.newmesh(box=self.__box, grid_size=self.__grid_size)
+        root = mesh.root_node()
+        nx = self.__nx
+        #
+        # Keys of all BRANCH nodes, by level
+        # 
+        branches = []
+        for level in range(self.max_level()):
+            on_level = self.__levels > level
+            shift = 2*(self.__levels[on_level] - level)
+            branches.append(set((self.__keys[on_level] >> shift).tolist()))
+        #
+        # Level 0
+        # 
+        if self.__grid_size is not None:
+            root.split()
+            frontier = {}
+            for (i0,j0), child in root.children.items():
+                frontier[j0*nx + i0] = child
+        else:
+            frontier = {0: root}
+        #
+        # Split BRANCH nodes, level by level
+        # 
+        for level in range(self.max_level()):
+            new_frontier = {}
+            for key, node in frontier.items():
+                if key in branches[level]:
+                    node.split()
+                    for pos, child in node.children.items():
+                        new_frontier[(key << 2) | node.pos2id(pos)] = child
+            frontier = new_frontier
+        return mesh 
+                     
+    
+    @staticmethod
+    def interleave(i, j):
+        """
+        Compute the Morton code of integer coordinates (i,j), i.e. the 
+        integer whose even bits are those of i and whose odd bits are those 
+        of j. 
+        
+        Inputs:
+        
+            i, j: int, arrays of nonnegative integers less than 2**31
+            
+        Output:
+        
+            keys: int, array of Morton codes
+        """
+        keys = np.zeros(np.shape(i), dtype=np.int64)
+        for k, v in enumerate([i, j]):
+            v = np.asarray(v, dtype=np.int64) & 0x7FFFFFFF
+            v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+            v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+            v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+            v = (v | (v << 2)) & 0x3333333333333333
+            v = (v | (v << 1)) & 0x5555555555555555
+            keys |= v << k
+        return keys
+    
+    
+    @staticmethod
+    def deinterleave(keys):
+        """
+        Recover the integer coordinates (i,j) from their Morton code 
+        (inverse of interleave). 
+        """
+        ij = []
+        for k in range(2):
+            v = (np.asarray(keys, dtype=np.int64) >> k) & 0x5555555555555555
+            v = (v | (v >> 1)) & 0x3333333333333333
+            v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+            v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+            v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+            v = (v | (v >> 16)) & 0x00000000FFFFFFFF
+            ij.append(v)
+        return ij[0], ij[1]
+    
+    
+    def encode(self, i, j, levels):
+        """
+        Compute the keys of cells from their integer coordinates
+        
+        Inputs: 
+        
+            i, j: int, arrays of cell coordinates at the given levels, i.e. 
+                0 <= i < nx*2**level, 0 <= j < ny*2**level.
+                
+            levels: int, array of cell levels
+            
+        Output:
+        
+            keys: int, array of Morton keys
+        """
+        i = np.asarray(i, dtype=np.int64)
+        j = np.asarray(j, dtype=np.int64)
+        levels = np.asarray(levels, dtype=np.int64)
+        mask = (np.int64(1) << levels) - 1
+        coarse = (j >> levels)*self.__nx + (i >> levels)
+        return (coarse << 2*levels) | self.interleave(i & mask, j & mask)
+        
+    
+    def decode(self, keys, levels):
+        """
+        Compute the integer coordinates (i,j) of cells from their keys and 
+        levels (inverse of encode).
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        levels = np.asarray(levels, dtype=np.int64)
+        coarse = keys >> 2*levels
+        i_loc, j_loc = self.deinterleave(keys & ((np.int64(1) << 2*levels)-1))
+        i = ((coarse % self.__nx) << levels) | i_loc
+        j = ((coarse // self.__nx) << levels) | j_loc
+        return i, j
+    
+    
+    @staticmethod
+    def parent(keys):
+        """
+        Return the keys of the parents (at level-1) of the given cells
+        """
+        return np.asarray(keys, dtype=np.int64) >> 2
+    
+    
+    @staticmethod
+    def children(keys):
+        """
+        Return the (n,4) array of keys of the children (SW,SE,NW,NE) of 
+        the given cells.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        return (keys[...,np.newaxis] << 2) | np.arange(4)
+    
+    
+    def box(self):
+        """
+        Return the bounding box of the domain
+        """
+        return self.__box
+    
+    
+    def grid_size(self):
+        """
+        Return the grid size on the coarsest level
+        """
+        return self.__grid_size
+    
+    
+    def n_cells(self):
+        """
+        Return the number of LEAF cells
+        """
+        return len(self.__keys)
+    
+    
+    def keys(self):
+        """
+        Return the Morton keys of the LEAF cells (in Z-order)
+        """
+        return self.__keys
+    
+    
+    def levels(self):
+        """
+        Return the levels of the LEAF cells
+        """
+        return self.__levels
+        
+    
+    def max_level(self):
+        """
+        Return the maximum refinement level
+        """
+        return int(self.__levels.max())
+    
+    
+    def depths(self):
+        """
+        Return the depths of the LEAF cells in the equivalent Node tree
+        """
+        offset = 0 if self.__grid_size is None else 1
+        return self.__levels + offset
+    
+    
+    def anchors(self, level=None):
+        """
+        Return the keys of the LEAF cells extended to a common level, i.e. 
+        the keys of their SW-most descendants at that level. The anchors are
+        sorted, which allows for binary search.
+        
+        Inputs:
+        
+            level: int, common level (at least the maximum level)
+        """
+        if level is None:
+            level = self.max_level()
+        return self.__keys << 2*(level-self.__levels)
+    
+    
+    def boxes(self):
+        """
+        Return the (n_cells,4) array of LEAF cell boxes (x0,x1,y0,y1)
+        """
+        x0, x1, y0, y1 = self.__box
+        i, j = self.decode(self.__keys, self.__levels)
+        hx = (x1-x0)/(self.__nx*2.0**self.__levels)
+        hy = (y1-y0)/(self.__ny*2.0**self.__levels)
+        return np.array([x0 + i*hx, x0 + (i+1)*hx, 
+                         y0 + j*hy, y0 + (j+1)*hy]).T
+        
+    
+    def refine(self, marked=None):
+        """
+        Refine the tree by splitting (marked) LEAF cells 
+        
+        Inputs:
+        
+            marked: bool, (n_cells,) array of cells to be split. If None, 
+                all cells are split.
+        """
+        n_cells = self.n_cells()
+        if marked is None:
+            marked = np.ones(n_cells, dtype=bool)
+        counts = np.where(marked, 4, 1)
+        i_old = np.repeat(np.arange(n_cells), counts)
+        offset = np.arange(len(i_old)) - np.repeat(np.cumsum(counts)-counts, 
+                                                   counts)
+        is_child = marked[i_old]
+        keys, levels = self.__keys[i_old], self.__levels[i_old]
+        self.__keys = np.where(is_child, (keys << 2) | offset, keys)
+        self.__levels = levels + is_child
+        
+        
+    def coarsen(self, marked):
+        """
+        Coarsen the tree by merging all (complete) groups of 4 marked sibling 
+        LEAF cells into their parent.
+        
+        Inputs:
+        
+            marked: bool, (n_cells,) array of cells to be merged
+        """
+        keys, levels = self.__keys, self.__levels
+        n_cells = self.n_cells()
+        #
+        # Marked SW children, followed by 3 marked siblings 
+        # 
+        first = np.zeros(n_cells, dtype=bool)
+        if n_cells >= 4:
+            i = np.arange(n_cells-3)
+            first[i] = (keys[i] & 3 == 0) & (levels[i] > 0)
+            for k in range(4):
+                first[i] &= marked[i+k] & (levels[i+k] == levels[i]) & \
+                            (keys[i+k] == keys[i] + k)
+        remove = np.zeros(n_cells, dtype=bool)
+        for k in range(1,4):
+            remove[np.nonzero(first)[0]+k] = True
+        self.__keys = np.where(first, keys >> 2, keys)[~remove]
+        self.__levels = (levels - first)[~remove]
+        
+        
+    def find_leaf(self, i, j, levels):
+        """
+        Find the LEAF cells containing given cells (or the cells' SW-most 
+        descendants, if the latter are refined).
+        
+        Inputs:
+        
+            i, j: int, arrays of cell coordinates at the given levels
+            
+            levels: int, array of cell levels
+            
+        Output:
+        
+            index: int, array of indices of the LEAF cells  
+        """
+        max_level = max(self.max_level(), int(np.max(levels, initial=0)))
+        anchors = self.anchors(level=max_level)
+        keys = self.encode(i, j, levels) << 2*(max_level-np.asarray(levels))
+        return np.searchsorted(anchors, keys, side='right') - 1
+    
+    
+    def locate(self, x, tie_break='upper'):
+        """
+        Find the LEAF cells containing a set of points
+        
+        Inputs:
+        
+            x: double, point (x,y), list of points, or (n,2) array
+            
+            tie_break: str, rule for points on edges shared by two or more 
+                cells. 'upper' assigns them to the cell to the right of/above
+                the edge, 'lower' to the cell to the left of/below it. Points 
+                on the domain boundary are assigned to the adjacent cell.
+                
+        Output:
+        
+            index: int, (n,) array of indices of the LEAF cells containing 
+                the points, or -1 if a point lies outside of all cells.
+                
+        Note: Points are mapped onto the integer coordinates of the cells on 
+            the finest level, whose keys are then located among the leaves' 
+            anchors by binary search.
+        """
+        assert tie_break in ['upper', 'lower'], \
+            'Tie break should be "upper" or "lower".'
+        x = np.array(x, dtype=float).reshape(-1,2)
+        level = self.max_level()
+        n_cells = self.n_cells()
+        x0, x1, y0, y1 = self.__box
+        n_i, n_j = self.__nx << level, self.__ny << level
+        #
+        # Coordinates in units of the finest cells (snap to nearby edges)
+        # 
+        s = (x[:,0]-x0)/(x1-x0)*n_i
+        t = (x[:,1]-y0)/(y1-y0)*n_j
+        for v in [s, t]:
+            v_round = np.round(v)
+            on_edge = np.abs(v - v_round) < 1e-10*max(n_i, n_j)
+            v[on_edge] = v_round[on_edge]
+        inside = (s >= 0) & (s <= n_i) & (t >= 0) & (t <= n_j)
+        index = -np.ones(len(x), dtype=np.int64)
+        levels = level*np.ones(np.sum(inside), dtype=np.int64)
+        anchors = self.anchors(level=level)
+        size = np.int64(1) << 2*(level - self.__levels)
+        for rule in [tie_break, 'lower' if tie_break=='upper' else 'upper']:
+            #
+            # Cell coordinates on the finest level 
+            # 
+            if rule == 'upper':
+                i, j = np.floor(s[inside]), np.floor(t[inside])
+            else:
+                i, j = np.ceil(s[inside])-1, np.ceil(t[inside])-1
+            i = np.clip(i, 0, n_i-1).astype(np.int64)
+            j = np.clip(j, 0, n_j-1).astype(np.int64)
+            idx = self.find_leaf(i, j, levels)
+            #
+            # Check whether the cells are contained in the leaves (the 
+            # leaves need not cover the domain).
+            # 
+            keys = self.encode(i, j, levels)
+            found = (idx >= 0) & (idx < n_cells)
+            found[found] = keys[found] < anchors[idx[found]] + \
+                                         size[idx[found]]
+            unassigned = index[inside] == -1
+            index[np.nonzero(inside)[0][unassigned & found]] = \
+                idx[unassigned & found]
+        return index
+        
+        
+    def neighbors(self, direction):
+        """
+        Returns the LEAF neighbors of all LEAF cells in a given direction 
+        (cf. Node.find_neighbor).
+        
+        Inputs:
+        
+            direction: str, 'N', 'S', 'E', 'W', 'SW', 'SE', 'NW', or 'NE' 
+            
+        Output:
+        
+            nb: int, (n_cells,) array whose ith entry is the index of the 
+                LEAF cell adjacent to cell i in the given direction, whose 
+                level is at most that of cell i. The entry is -1 if there is 
+                no such cell, i.e. if cell i lies on the boundary, or if the 
+                neighboring region is refined (in which case cell i is a 
+                neighbor of the finer cells).
+        """
+        offsets = {'N': (0,1), 'S': (0,-1), 'E': (1,0), 'W': (-1,0), 
+                   'SW': (-1,-1), 'SE': (1,-1), 'NW': (-1,1), 'NE': (1,1)}
+        assert direction in offsets, 'Direction not recognized.'
+        di, dj = offsets[direction]
+        keys, levels = self.__keys, self.__levels
+        i, j = self.decode(keys, levels)
+        i_nb, j_nb = i + di, j + dj
+        nb = -np.ones(self.n_cells(), dtype=np.int64)
+        #
+        # Neighbors within the domain
+        # 
+        inside = (i_nb >= 0) & (i_nb < self.__nx << levels) & \
+                 (j_nb >= 0) & (j_nb < self.__ny << levels)
+        idx = self.find_leaf(i_nb[inside], j_nb[inside], levels[inside])
+        #
+        # Discard finer cells
+        # 
+        shift = levels[inside] - self.__levels[idx]
+        is_nb = shift >= 0
+        if di != 0 and dj != 0:
+            #
+            # Coarser diagonal neighbors should share only a corner
+            # 
+            is_nb &= ((i_nb[inside] >> shift) != (i[inside] >> shift)) & \
+                     ((j_nb[inside] >> shift) != (j[inside] >> shift))
+        nb[np.nonzero(inside)[0][is_nb]] = idx[is_nb]
+        return nb
+    
+    
+    def is_balanced(self):
+        """
+        Check whether the tree is (2:1) balanced, i.e. whether the levels
+        of LEAF cells sharing an edge differ by at most one (cf.
+        Node.is_balanced).
+        
+        Note: Each coarser neighbor across an edge is found by looking
+            from the finer cell (see neighbors).
+        """
+        for direction in ['N','S','E','W']:
+            nb = self.neighbors(direction)
+            i = nb >= 0
+            if np.any(self.__levels[i] - self.__levels[nb[i]] > 1):
+                return False
+        return True
+    
+    
+    def adjacency(self, corners=False):
+        """
+        Returns the adjacency of LEAF cells in the form of arrays
+        
+        Inputs:
+        
+            corners: bool, if True, include cells sharing only a corner. 
+            
+        Outputs:
+        
+            rows, cols: int, arrays of indices of adjacent cell pairs. Each 
+                pair is listed in both orders. 
+        """
+        directions = ['W','E','S','N']
+        if corners:
+            directions += ['SW','SE','NW','NE']
+        rows, cols = [], []
+        for direction in directions:
+            nb = self.neighbors(direction)
+            i = np.nonzero(nb >= 0)[0]
+            rows.extend([i, nb[i]])
+            cols.extend([nb[i], i])
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        #
+        # Remove duplicates
+        # 
+        pairs = np.unique(rows*self.n_cells() + cols)
+        return pairs // self.n_cells(), pairs % self.n_cells() 
+    
+    
 class Grid(object):
     """
     Description: Structure used for storing Nodes on coarsest refinement level
@@ -676,6 +1280,16 @@ class Node(object):
             else:
                 node_children = {'SW':None, 'SE':None, 'NW':None, 'NE':None}
             self.__grid_size = grid_size
+            #
+            # Index of all nodes in the tree: (depth,i,j) -> node
+            # 
+            root = self
+            self.__index = {}
+            node_coordinates = (0,0)
+            #
+            # Number of modifications (split, merge, mark,...) of the tree
+            # 
+            self.__modification_count = 0
         else:
             #
             # LEAF node
@@ -686,6 +1300,17 @@ class Node(object):
             node_children = {'SW': None, 'SE': None, 'NW': None, 'NE': None}
             if parent.type == 'LEAF':
                 parent.type = 'BRANCH'  # modify parent to branch
+            #
+            # Integer coordinates (i,j) of the node among those at its depth
+            # 
+            root = parent.__root
+            if type(position) is tuple:
+                node_coordinates = position
+            else:
+                idx = self.pos2id(position)
+                pi, pj = parent.__coordinates
+                node_coordinates = (2*pi + idx % 2, 2*pj + idx // 2)
+            root.__index[(node_depth,)+node_coordinates] = self
             
         #
         # Record Attributes
@@ -700,6 +1325,8 @@ class Node(object):
         self.__tricells = None
         self.__flags  = set()
         self.__support = False
+        self.__root = root
+        self.__coordinates = node_coordinates
     
     
     def info(self):
@@ -769,6 +1396,16 @@ class Node(object):
         return node_copy
             
         
+    def modification_count(self):
+        """
+        Return the number of times the tree has been modified, i.e. nodes
+        have been split, merged, removed, marked, or unmarked. This can be
+        used to determine whether quantities derived from the tree are 
+        up to date.
+        """
+        return self.__root.__modification_count
+    
+    
     def grid_size(self):
         """
         Return the grid size of root node
@@ -785,133 +1422,71 @@ class Node(object):
          
         Inputs: 
          
-            direction: char, 'N'(north), 'S'(south), 'E'(east), or 'W'(west)
+            direction: char, 'N'(north), 'S'(south), 'E'(east), or 'W'(west),
+                or diagonal 'SW', 'SE', 'NW', 'NE'
              
         Output: 
          
             neighboring cell
-         
-        TODO: move to subclass   
-        """
+            
+        Note: Neighbors are looked up in the tree's index of nodes, keyed by 
+            depth and integer coordinates, rather than by traversing the 
+            tree. The cost is O(1) when the neighbor is at most one level 
+            coarser (as in a balanced tree). Diagonal neighbors must share 
+            only a corner vertex.   
+        """
+        offsets = {'N': (0,1), 'S': (0,-1), 'E': (1,0), 'W': (-1,0), 
+                   'SW': (-1,-1), 'SE': (1,-1), 'NW': (-1,1), 'NE': (1,1)}
+        assert direction in offsets, \
+            "Invalid direction. Use 'N', 'S', 'E', 'NE','SE','NW, 'SW', or 'W'."
         if self.type == 'ROOT':
             #
             # ROOT Cells have no neighbors
             # 
             return None
         #
-        # For a node in a grid, do a brute force search (comparing vertices)
-        #
-        elif self.in_grid():
-            p = self.parent
-            nx, ny = p.grid_size()
-
-            i,j = self.address[0]
-            if direction == 'N':
-                if j < ny-1:
-                    return p.children[i,j+1]
-                else:
-                    return None
-            elif direction == 'S':
-                if j > 0:
-                    return p.children[i,j-1]
-                else:
-                    return None
-            elif direction == 'E':
-                if i < nx-1:
-                    return p.children[i+1,j]
-                else:
-                    return None
-            elif direction == 'W':
-                if i > 0:
-                    return p.children[i-1,j]
-                else:
-                    return None
-            elif direction == 'SW':
-                if i > 0 and j > 0:
-                    return p.children[i-1,j-1]
-                else:
-                    return None
-            elif direction == 'SE':
-                if i < nx-1 and j > 0:
-                    return p.children[i+1,j-1]
-                else:
-                    return None
-            elif direction == 'NW':
-                if i > 0 and j < ny-1:
-                    return p.children[i-1,j+1]
-                else: 
-                    return None
-            elif direction == 'NE':
-                if i < nx-1 and j < ny-1:
-                    return p.children[i+1,j+1]
-                else:
-                    return None 
-        #
-        # Non-ROOT cells 
+        # Number of cells at given depth
         # 
+        root = self.__root
+        depth = self.depth
+        if root.grid_size() is None:
+            nx, ny = 2**depth, 2**depth
+            min_depth = 0
         else:
+            nx, ny = root.grid_size()
+            nx, ny = nx*2**(depth-1), ny*2**(depth-1)
+            min_depth = 1
+        #
+        # Coordinates of neighbor 
+        # 
+        di, dj = offsets[direction]
+        i, j = self.__coordinates
+        i_nb, j_nb = i + di, j + dj
+        if not (0 <= i_nb < nx and 0 <= j_nb < ny):
             #
-            # Check for neighbors interior to parent cell
+            # Neighbor outside domain
             # 
-            if direction == 'N':
-                interior_neighbors_dict = {'SW': 'NW', 'SE': 'NE'}
-            elif direction == 'S':
-                interior_neighbors_dict = {'NW': 'SW', 'NE': 'SE'}
-            elif direction == 'E':
-                interior_neighbors_dict = {'SW': 'SE', 'NW': 'NE'}
-            elif direction == 'W':
-                interior_neighbors_dict = {'SE': 'SW', 'NE': 'NW'}
-            elif direction == 'SW':
-                interior_neighbors_dict = {'NE': 'SW'}
-            elif direction == 'SE':
-                interior_neighbors_dict = {'NW': 'SE'}
-            elif direction == 'NW':
-                interior_neighbors_dict = {'SE': 'NW'}
-            elif direction == 'NE':
-                interior_neighbors_dict = {'SW': 'NE'}
-            else:
-                print("Invalid direction. Use 'N', 'S', 'E', 'NE','SE','NW, 'SW', or 'W'.")
-            
-            if self.position in interior_neighbors_dict:
-                neighbor_pos = interior_neighbors_dict[self.position]
-                return self.parent.children[neighbor_pos]
-            #
-            # Check for (children of) parental neighbors
-            #
-            else:
-                if direction in ['SW','SE','NW','NE'] and direction != self.position:
-                    # Special case
-                    for c1,c2 in zip(self.position,direction):
-                        if c1 == c2:
-                            here = c1
-                    mu = self.parent.find_neighbor(here)
-                    if mu != None and mu.depth == self.depth-1 and mu.has_children():
-                        #
-                        # Diagonal neighbors must share corner vertex
-                        # 
-                        opposite = {'N':'S', 'S':'N', 'W':'E', 'E':'W'}
-                        nb_pos = direction
-                        for i in range(len(direction)):
-                            if direction[i] == here:
-                                nb_pos = nb_pos.replace(here,opposite[here])
-                        child = mu.children[nb_pos]
-                        return child
-                    else:
-                        return None
-                else:
-                    mu = self.parent.find_neighbor(direction)
-                    if mu == None or mu.type == 'LEAF':
-                        return mu
-                    else:
-                        #
-                        # Reverse dictionary to get exterior neighbors
-                        # 
-                        exterior_neighbors_dict = \
-                           {v: k for k, v in interior_neighbors_dict.items()}
-                            
-                        if self.position in exterior_neighbors_dict:
-                            neighbor_pos = exterior_neighbors_dict[self.position]
-                            return mu.children[neighbor_pos] 
+            return None
+        #
+        # Look up neighbor (or its ancestors)
+        # 
+        while depth >= min_depth:
+            if i_nb == i and j_nb == j:
+                #
+                # Neighbor lies within own ancestor 
+                # 
+                return None
+            elif di != 0 and dj != 0 and (i_nb == i or j_nb == j):
+                #
+                # Diagonal neighbor shares an edge 
+                # 
+                return None
+            nb = root.__index.get((depth, i_nb, j_nb))
+            if nb is not None:
+                return nb
+            depth -= 1
+            i, j, i_nb, j_nb = i >> 1, j >> 1, i_nb >> 1, j_nb >> 1
+        return None
     
     
     def tree_depth(self, flag=None):
@@ -1310,6 +1885,7 @@ class Node(object):
             self.__flags.add(True)
         else:
             self.__flags.add(flag)
+        self.__root.__modification_count += 1
         
         #
         # Mark children as well
@@ -1335,6 +1911,7 @@ class Node(object):
             self.__flags.clear()
         else:
             self.__flags.remove(flag)
+        self.__root.__modification_count += 1
         # Remove tag from children
         if recursive and self.has_children():
             for child in self.children.values():
@@ -1450,7 +2027,8 @@ class Node(object):
         Delete all sub-nodes of given node
         """
         for key in self.children.keys():
-            self.children[key] = None
+            if self.children[key] is not None:
+                self.children[key].remove()
         self.type = 'LEAF'
     
     
@@ -1459,7 +2037,14 @@ class Node(object):
         Remove node from parent's list of children
         """
         assert self.type != 'ROOT', 'Cannot delete ROOT node.'
+        #
+        # Remove node and its progeny from the tree's index
+        # 
+        index = self.__root.__index
+        for node in self.traverse():
+            index.pop((node.depth,)+node.__coordinates, None)
         self.parent.children[self.position] = None
+        self.__root.__modification_count += 1
         
         
     def split(self):
@@ -1483,6 +2068,7 @@ class Node(object):
         else:
             for pos in self.children.keys():
                 self.children[pos] = Node(parent=self, position=pos)
+        self.__root.__modification_count += 1
             
                     
     def is_balanced(self):
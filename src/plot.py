@@ -11,6 +11,7 @@ from mpl_toolkits.mplot3d.art3d import Line3DCollection  # @UnresolvedImport
 from mpl_toolkits.mplot3d import axes3d # @UnresolvedImport
 import numpy as np
 from fem import DofHandler, System, Function
+from mesh import LinearQuadtree
 
 
 class Plot(object):
@@ -55,7 +56,31 @@ class Plot(object):
         
             ax: axis, 
             
+        Note: A LinearQuadtree mesh is plotted directly from its cell boxes,
+            unless the plot requires tree nodes, in which case it is first 
+            converted to a Mesh.
         """
+        if isinstance(mesh, LinearQuadtree):
+            if color_marked is None and not (vertex_numbers or edge_numbers \
+                                             or cell_numbers or dofs):
+                #
+                # Plot cell boxes
+                #  
+                x0, x1, y0, y1 = mesh.box()
+                hx = x1 - x0
+                hy = y1 - y0
+                ax.set_xlim(x0-0.1*hx, x1+0.1*hx)
+                ax.set_ylim(y0-0.1*hy, y1+0.1*hy)
+                rects = [Rectangle((bx0,by0), bx1-bx0, by1-by0) \
+                         for bx0, bx1, by0, by1 in mesh.boxes()]
+                ax.add_collection(PatchCollection(rects, facecolor='w', 
+                                                  edgecolor='k'))
+                if not show_axis:
+                    ax.axis('off')
+                return ax
+            else:
+                mesh = mesh.to_mesh()
+                
         node = mesh.root_node()
         
         x0, x1, y0, y1 = node.quadcell().box()          
@@ -72,7 +97,7 @@ class Plot(object):
         # Plot QuadCells
         # 
         color_list = ['gold', 'darkorange','r']                      
-        for node in mesh.root_node().find_leaves(flag=node_flag, \
+        for node in mesh.nodes(flag=node_flag, \
                                                  nested=nested):
             cell = node.quadcell()
             x0, x1, y0, y1 = cell.box()
@@ -165,7 +190,7 @@ class Plot(object):
             n_dofs = element.n_dofs()
             dofhandler = DofHandler(mesh, element)
             dofhandler.distribute_dofs(nested=nested)
-            for node in mesh.root_node().find_leaves(nested=nested,\
+            for node in mesh.nodes(nested=nested,\
                                                      flag=node_flag):
                 cell = node.quadcell()
                 x0,x1,y0,y1 = cell.box()
@@ -235,7 +260,7 @@ class Plot(object):
             z = f(x,y)  
             cm = ax.contourf(x,y,z.reshape(ny,nx),100)
         elif isinstance(f, Function):
-            xy = [(xi,yi) for xi,yi in zip(x.ravel(),y.ravel())]
+            xy = np.array([x.ravel(), y.ravel()]).transpose()
             z = f.eval(xy)
             cm = ax.contourf(x,y,z.reshape(ny,nx),100)
         else:
@@ -247,7 +272,7 @@ class Plot(object):
                 # Mesh function 
                 #
                 patches = []
-                for node in mesh.root_node().find_leaves(flag=flag):
+                for node in mesh.nodes(flag=flag):
                     cell = node.quadcell()
                     x0,x1,y0,y1 = cell.box()
                     rectangle = Rectangle((x0,y0), x1-x0, y1-y0)
@@ -349,7 +374,7 @@ class Plot(object):
             lines = []
             node_count = 0
             initialize_min_max = True
-            for node in mesh.root_node().find_leaves():                
+            for node in mesh.nodes():                
                 #
                 # Function type  
                 # 
@@ -6,8 +6,8 @@ Created 11/22/2016
 # Imports
 # =============================================================================
 import unittest
-from fem import QuadFE, Function, DofHandler, GaussRule, System
-from mesh import Mesh, Edge, Vertex
+from fem import QuadFE, Function, DofHandler, GaussRule, System, Assembler
+from mesh import Mesh, Edge, Vertex, LinearQuadtree
 #import scipy.sparse as sp
 import numpy as np
 import numpy.linalg as la
@@ -451,6 +451,43 @@ class TestFunction(unittest.TestCase):
                         'Function value assignment incorrect.')
         
 
+    def test_eval_matrix(self):
+        #
+        # Locally refined mesh 
+        # 
+        mesh = Mesh.newmesh(box=[0,2,0,1], grid_size=(2,1))
+        mesh.refine()
+        mesh.root_node().children[0,0].split()
+        element = QuadFE(2,'Q2')
+        dofhandler = DofHandler(mesh, element)
+        dofhandler.distribute_dofs()
+        x = dofhandler.dof_vertices()
+        #
+        # Quadratic functions (two samples) are reproduced exactly
+        #
+        f_nodes = np.array([x[:,0]**2 + x[:,0]*x[:,1], x[:,1]**2]).T
+        f = Function(f_nodes, 'nodal', dofhandler=dofhandler)
+        xy = np.random.rand(50,2)*np.array([2,1])
+        E = f.eval_matrix(xy)
+        self.assertEqual(E.shape, (50, dofhandler.n_dofs()))
+        self.assertTrue(np.allclose(E.dot(f.fn()), f.eval(xy)))
+        self.assertTrue(np.allclose(f.eval(xy)[:,0],
+                                    xy[:,0]**2 + xy[:,0]*xy[:,1]))
+        #
+        # Selected samples (integer or array)
+        #
+        self.assertTrue(np.allclose(f.eval(xy, samples=1), xy[:,1]**2))
+        self.assertTrue(np.allclose(f.eval(xy, samples=np.array([1,0])),
+                                    f.eval(xy)[:,[1,0]]))
+        #
+        # Derivatives
+        # 
+        Ex = f.eval_matrix(xy, derivative=(1,0))
+        self.assertTrue(np.allclose(Ex.dot(f.fn()[:,0]), 2*xy[:,0]+xy[:,1]))
+        Ey = f.eval_matrix(xy, derivative=(1,1))
+        self.assertTrue(np.allclose(Ey.dot(f.fn()[:,1]), 2*xy[:,1]))
+        
+        
     def test_global_dofs(self):
         #
         # Check that global dofs are returned
@@ -592,6 +629,39 @@ class TestDofHandler(unittest.TestCase):
                          'Discrepancy in number of dofs.')
         
         
+    def test_distribute_dofs_vectorized(self):
+        #
+        # Locally refined, balanced meshes
+        # 
+        for grid_size in [None, (2,3)]:
+            mesh = Mesh.newmesh(grid_size=grid_size)
+            mesh.refine()
+            mesh.refine()
+            mesh.nodes()[0].split()
+            mesh.nodes()[5].split()
+            mesh.balance()
+            for etype in ['Q1','Q2','Q3','DQ0','DQ1']:
+                element = QuadFE(2,etype)
+                dh = DofHandler(mesh, element)
+                dh.distribute_dofs()
+                dh_vec = DofHandler(mesh, element)
+                dh_vec.distribute_dofs(vectorized=True)
+                #
+                # Same numbering as the recursive distribution
+                # 
+                self.assertEqual(dh.n_dofs(), dh_vec.n_dofs())
+                cell_dofs = dh_vec.cell_dofs()
+                self.assertEqual(cell_dofs.dtype, np.int32)
+                self.assertEqual(cell_dofs.shape, 
+                                 (mesh.n_cells(), element.n_dofs()))
+                self.assertTrue(np.all(dh.cell_dofs()==cell_dofs))
+                for leaf, dofs in zip(mesh.nodes(), cell_dofs):
+                    self.assertEqual(dh_vec.get_global_dofs(leaf), 
+                                     list(dofs))
+                self.assertTrue(np.allclose(dh.dof_vertices(), 
+                                            dh_vec.dof_vertices()))
+        
+        
     def test_share_dofs_with_children(self):
         mesh = Mesh.newmesh()
         mesh.refine()
@@ -1212,22 +1282,196 @@ class TestSystem(unittest.TestCase):
         #plt.show()
         
         
-    def test_extract_hanging_nodes(self):
-        """
-        A = np.array([[1,1,1,1],[0,-2,1,0],[1,3,1,0],[0,0,-1,3]])
-        b = np.array([2,4,0,-2])
-        xe = np.array([1,-1,2,0])
-        hanging_nodes = {2:([0,1],[1,-1])}
+    def test_assemble_vectorized(self):
+        #
+        # Compare with cellwise assembly 
+        # 
+        mesh = Mesh.newmesh(grid_size=(2,2))
+        mesh.refine()
+        mesh.refine()
+        q = lambda x,y: 1 + x*y
+        f = lambda x,y: x + y
+        bf = [(q,'ux','vx'),(1,'uy','vy'),(2,'u','v'),(1,'ux','vy')]
+        lf = [(f,'v'),(Function(1.5,'constant'),'vx')]
+        for etype in ['Q1','Q2','Q3']:
+            element = QuadFE(2,etype)
+            system = System(mesh, element)
+            A,b = system.assemble(bf,lf)
+            Av,bv = system.assemble(bf,lf,vectorized=True)
+            self.assertTrue(np.allclose(A.toarray(),Av.toarray()),\
+                            'Vectorized system matrix incorrect.')
+            self.assertTrue(np.allclose(b,bv),\
+                            'Vectorized right hand side incorrect.')
+            #
+            # Nodal kernel
+            # 
+            qn = q(*system.dof_vertices().T)
+            qf = Function(qn, 'nodal', mesh, element)
+            Av = system.assemble([(qn,'u','v')], vectorized=True)
+            A = system.assemble([(qf,'u','v')])
+            self.assertTrue(np.allclose(A.toarray(),Av.toarray()),\
+                            'Nodal kernel incorrectly assembled.')
+        #
+        # Boundary conditions
+        # 
+        def m_dirichlet(x,y):
+            return np.abs(x)<1e-9
         
-        A1 = sp.lil_matrix(A)
-        A1,b1 = self.extract_hanging_nodes(A1,b)
+        def m_neumann(edge):
+            x = np.array(edge.vertex_coordinates())
+            return (np.abs(x[:,0]-1)<1e-9).all()
+        
+        bc = {'dirichlet': [(m_dirichlet, lambda x,y: 1+y)], 
+              'neumann': [(m_neumann, lambda x,y: y)]}
+        element = QuadFE(2,'Q2')
+        system = System(mesh, element)
+        A,b = system.assemble(bf[:3],lf[:1],bc)
+        Av,bv = system.assemble(bf[:3],lf[:1],bc,vectorized=True)
+        u = la.solve(A.toarray(),b)
+        uv = la.solve(Av.toarray(),bv)
+        self.assertTrue(np.allclose(u,uv), 'Solutions not close.')
+        
+        
+    def test_linear_quadtree(self):
+        #
+        # Locally refined, balanced mesh and its linear quadtree
+        # 
+        mesh = Mesh.newmesh(grid_size=(2,3))
+        mesh.refine()
+        mesh.nodes()[0].split()
+        mesh.nodes()[5].split()
+        mesh.balance()
+        tree = LinearQuadtree.from_mesh(mesh)
+        q = lambda x,y: 1 + x*y
+        bf = [(q,'ux','vx'),(1,'uy','vy'),(2,'u','v')]
+        lf = [(lambda x,y: x + y,'v')]
+        bc = {'dirichlet': [(lambda x,y: np.abs(x)<1e-9, lambda x,y: 1+y)]}
+        for etype in ['Q1','Q2','DQ1']:
+            element = QuadFE(2,etype)
+            #
+            # Dofs are distributed without constructing Nodes 
+            # 
+            dh_mesh = DofHandler(mesh, element)
+            dh_mesh.distribute_dofs(vectorized=True)
+            dh_tree = DofHandler(tree, element)
+            dh_tree.distribute_dofs()
+            self.assertEqual(dh_mesh.n_dofs(), dh_tree.n_dofs())
+            self.assertTrue(np.all(dh_mesh.cell_dofs()==dh_tree.cell_dofs()))
+            self.assertTrue(np.allclose(dh_mesh.dof_vertices(), 
+                                        dh_tree.dof_vertices()))
+            #
+            # Same (vectorized) systems
+            # 
+            system_mesh = System(mesh, element)
+            system_tree = System(tree, element)
+            leaves, boxes, cell_dofs = system_tree.cell_arrays()
+            self.assertTrue(leaves is None)
+            self.assertTrue(np.allclose(boxes, tree.boxes()))
+            A,b = system_mesh.assemble(bf,lf,bc,vectorized=True)
+            At,bt = system_tree.assemble(bf,lf,bc,vectorized=True)
+            self.assertTrue(np.allclose(A.toarray(),At.toarray()))
+            self.assertTrue(np.allclose(b,bt))
+            Ac,bc_ = Assembler(system_tree).assemble(bf,lf,bc)
+            self.assertTrue(np.allclose(A.toarray(),Ac.toarray()))
+            self.assertTrue(np.allclose(b,bc_))
+        #
+        # Table of cell dofs is outdated once the tree is refined 
+        # 
+        tree.refine()
+        self.assertRaises(AssertionError, dh_tree.cell_dofs)
         
-        A2 = sp.lil_matrix(A)
-        A2,b2 = self.incporate_hanging_nodes(A2,b)
-        """
+    
+    def test_element_matrix(self):
+        element = QuadFE(2,'Q1')
+        system = System(Mesh.newmesh(), element, n_gauss=(3,9))
+        hx, hy = 0.5, 0.25
+        M = system.element_matrix(hx, hy, ('u','v'))
+        MM = hx*hy/36.0*np.array([[4,2,2,1],[2,4,1,2],[2,1,4,2],[1,2,2,4]])
+        self.assertTrue(np.allclose(M,MM), 'Incorrect mass matrix.')
+        Ax = system.element_matrix(hx, hy, ('ux','vx'))
+        AAx = hy/hx/6.0*np.array([[2,-2,1,-1],[-2,2,-1,1],
+                                  [1,-1,2,-2],[-1,1,-2,2]])
+        self.assertTrue(np.allclose(Ax,AAx), 'Incorrect stiffness matrix.')
+        b = system.element_matrix(hx, hy, ('v',))
+        self.assertTrue(np.allclose(b,0.25*hx*hy), 'Incorrect linear form.')
+        #
+        # Matrices are cached 
+        # 
+        self.assertTrue(system.element_matrix(hx, hy, ('u','v')) is M)
+        #
+        # Sizes differing by round-off share the same cached matrix
+        # 
+        mesh = Mesh.newmesh(grid_size=(3,3))
+        for dummy in range(4):
+            mesh.refine()
+        system = System(mesh, element)
+        boxes = np.array([leaf.quadcell().box() for leaf in mesh.nodes()])
+        h = np.unique(np.array([boxes[:,1]-boxes[:,0],
+                                boxes[:,3]-boxes[:,2]]).T, axis=0)
+        self.assertTrue(len(h) > 1, 'Sizes should differ by round-off.')
+        M = system.element_matrix(h[0,0], h[0,1], ('u','v'))
+        for hx, hy in h:
+            self.assertTrue(system.element_matrix(hx, hy, ('u','v')) is M)
+        #
+        # Constant kernels are detected
+        # 
+        self.assertEqual(system.constant_kernel(2), 2)
+        self.assertEqual(system.constant_kernel(Function(3,'constant')), 3)
+        self.assertIsNone(system.constant_kernel(lambda x,y: x))
+        
+        
+    def test_extract_hanging_nodes(self):
+        #
+        # Mesh with hanging nodes
+        # 
+        mesh = Mesh.newmesh()
+        mesh.root_node().mark(1)
+        mesh.refine(1)
+        mesh.root_node().children['SW'].mark(2)
+        mesh.refine(2)
+        element = QuadFE(2,'Q2')
+        system = System(mesh,element)
+        dofhandler = system.dofhandler()
+        hanging_nodes = dofhandler.get_hanging_nodes()
+        C, free_dofs = dofhandler.constraint_matrix()
+        n_dofs = system.n_dofs()
+        self.assertEqual(C.shape, (n_dofs, n_dofs-len(hanging_nodes)))
+        self.assertFalse(any(hn in free_dofs for hn in hanging_nodes))
+        #
+        # Hanging values of quadratic functions are interpolated exactly
+        # 
+        x = system.dof_vertices()
+        u = x[:,0]**2 - x[:,0]*x[:,1]
+        self.assertTrue(np.allclose(C.dot(u[free_dofs]), u))
+        #
+        # Compressed system is symmetric
+        # 
+        bf = [(1,'ux','vx'),(1,'uy','vy'),(1,'u','v')]
+        lf = [(1,'v')]
+        A, b = system.assemble(bilinear_forms=bf, linear_forms=lf)
+        A_c, b_c = system.extract_hanging_nodes(A, b, compress=True)
+        self.assertTrue(np.allclose(A_c.toarray(), A_c.toarray().T))
+        #
+        # Compressed and full systems have the same solution
+        # 
+        A_f, b_f = system.extract_hanging_nodes(A, b, compress=False)
+        self.assertEqual(A_f.shape, A.shape)
+        u_c = la.solve(A_c.toarray(), b_c)
+        u_f = la.solve(A_f.toarray(), b_f)
+        self.assertTrue(np.allclose(u_f, system.resolve_hanging_nodes(u_c)))
+        self.assertTrue(np.allclose(u_f[free_dofs], u_c))
+    
     
     def test_resolve_hanging_nodes(self):
-        pass
+        mesh = Mesh.newmesh(grid_size=(2,2))
+        mesh.refine()
+        mesh.root_node().children[1,1].split()
+        system = System(mesh, QuadFE(2,'Q1'))
+        _, free_dofs = system.dofhandler().constraint_matrix()
+        x = system.dof_vertices()
+        u = 1 + x[:,0] - 2*x[:,1]
+        self.assertTrue(np.allclose(system.resolve_hanging_nodes(u[free_dofs]),
+                                    u))
     
         
     def test_get_n_nodes(self):
@@ -1659,4 +1903,63 @@ class TestSystem(unittest.TestCase):
             # Restrict to coarse dofs
             # 
             R = system.restrict(0, 1)
-            self.assertTrue(np.allclose(np.dot(R,u_fine),u_coarse,1e-9))
\ No newline at end of file
+            self.assertTrue(np.allclose(np.dot(R,u_fine),u_coarse,1e-9))            
+            
+class TestAssembler(unittest.TestCase):
+    """
+    Test compiled Assembler class
+    """
+    def test_assemble(self):
+        mesh = Mesh.newmesh(grid_size=(2,2))
+        mesh.refine()
+        mesh.refine()
+        element = QuadFE(2,'Q2')
+        system = System(mesh, element)
+        assembler = Assembler(system)
+        
+        def m_dirichlet(x,y):
+            return np.abs(x)<1e-9
+        
+        bc = {'dirichlet': [(m_dirichlet, lambda x,y: 1+y)]}
+        lf = [(1,'v')]
+        indptr, indices = assembler.pattern()
+        for kappa in [1, 2.5, lambda x,y: 1+x*y]:
+            bf = [(kappa,'ux','vx'),(kappa,'uy','vy'),(1,'u','v')]
+            for bnd in [None, bc]:
+                A,b = system.assemble(bf,lf,bnd,vectorized=True)
+                Ac,bc_ = assembler.assemble(bf,lf,bnd)
+                self.assertTrue(np.allclose(A.toarray(),Ac.toarray()),\
+                                'System matrix incorrect.')
+                self.assertTrue(np.allclose(b,bc_),\
+                                'Right hand side incorrect.')
+                #
+                # Pattern is reused
+                # 
+                self.assertTrue(np.shares_memory(Ac.indices, indices))
+                self.assertEqual(Ac.nnz, assembler.nnz())
+
+
+    def test_large_pattern(self):
+        #
+        # More than 46340 dofs: keys row*n+col exceed the int32 range
+        #
+        tree = LinearQuadtree(grid_size=(128,128))
+        tree.refine()
+        system = System(tree, QuadFE(2,'Q1'))
+        n = system.n_dofs()
+        self.assertEqual(n, 257**2)
+        assembler = Assembler(system)
+        indptr, indices = assembler.pattern()
+        self.assertEqual(indptr[-1], assembler.nnz())
+        self.assertTrue(np.all(np.diff(indptr) > 0))
+        self.assertTrue(indices.min() >= 0 and indices.max() < n)
+        #
+        # Compare with the vectorized assembly (Dirichlet rows use the
+        # positions of the diagonal entries)
+        #
+        bc = {'dirichlet': [(lambda x,y: np.abs(x)<1e-9, lambda x,y: y)]}
+        bf, lf = [(1,'ux','vx'),(1,'uy','vy'),(1,'u','v')], [(1,'v')]
+        A, b = system.assemble(bf, lf, bc, vectorized=True)
+        Ac, bc_ = assembler.assemble(bf, lf, bc)
+        self.assertTrue(abs(A.tocsr()-Ac).max() < 1e-12)
+        self.assertTrue(np.allclose(b, bc_))
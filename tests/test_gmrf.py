@@ -6,11 +6,13 @@ Created on Mar 11, 2017
 
 import unittest
 
-from gmrf import Gmrf
-from mesh import Mesh
-from fem import QuadFE, DofHandler, System, Function
+from gmrf import Gmrf, HMatrix, CirculantEmbedding, MaternPrecision
+from mesh import Mesh, LinearQuadtree
+from fem import QuadFE, DofHandler, System, Function, GaussRule
 import numpy as np
 import scipy.sparse as sp
+from scipy import linalg
+from scipy.stats import multivariate_normal
 import scipy.sparse.linalg as spla
 from sksparse.cholmod import cholesky  # @UnresolvedImport
 import matplotlib.pyplot as plt
@@ -161,6 +163,80 @@ class TestGmrf(unittest.TestCase):
         S = cov_fn(X, Y, **cov_par, M=M)   
         
         
+    def test_kernel_matrix(self):
+        mesh = Mesh.newmesh(grid_size=(10,10))
+        mesh.refine()
+        dofhandler = DofHandler(mesh, QuadFE(2,'Q1'))
+        dofhandler.distribute_dofs()
+        x = dofhandler.dof_vertices()
+        n = dofhandler.n_dofs()
+        cov_par = {'sgm': 1, 'l': 0.1}
+        #
+        # Reference: all pairs at once
+        # 
+        i, j = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+        S = Gmrf.gaussian_cov(x[i.ravel(),:], x[j.ravel(),:], 
+                              **cov_par).reshape(n,n)
+        #
+        # Small tiles, several threads
+        # 
+        S_tiled = Gmrf.kernel_matrix(Gmrf.gaussian_cov, cov_par, x, 
+                                     max_memory=2**14, n_threads=3)
+        self.assertTrue(np.allclose(S, S_tiled))
+        #
+        # Single precision, written to preallocated array
+        # 
+        out = np.zeros((n,n), dtype=np.float32)
+        S_32 = Gmrf.covariance_matrix('gaussian', cov_par, mesh, 
+                                      dtype=np.float32, out=out)
+        self.assertTrue(S_32 is out)
+        self.assertTrue(np.allclose(S, S_32, atol=1e-6))
+        
+        
+    def test_galerkin_covariance(self):
+        mesh = Mesh.newmesh(grid_size=(3,3))
+        mesh.refine()
+        mesh.nodes()[0].split()
+        element = QuadFE(2,'Q1')
+        cov_par = {'sgm': 1, 'l': 0.3}
+        Sigma, M = Gmrf.galerkin_covariance(Gmrf.gaussian_cov, cov_par, 
+                                            mesh, element)
+        #
+        # Compare with cell-by-cell assembly
+        # 
+        dofhandler = DofHandler(mesh, element)
+        dofhandler.distribute_dofs()
+        n = dofhandler.n_dofs()
+        rule = GaussRule(9, element=element)
+        phi = element.shape(rule.nodes())
+        S = np.zeros((n,n))
+        for node_1 in mesh.nodes():
+            cell_1 = node_1.quadcell()
+            x_1 = rule.map(cell_1, x=rule.nodes())
+            WPhi_1 = (rule.jacobian(cell_1)*rule.weights())[:,None]*phi
+            dofs_1 = dofhandler.get_global_dofs(node_1)
+            for node_2 in mesh.nodes():
+                cell_2 = node_2.quadcell()
+                x_2 = rule.map(cell_2, x=rule.nodes())
+                WPhi_2 = (rule.jacobian(cell_2)*rule.weights())[:,None]*phi
+                dofs_2 = dofhandler.get_global_dofs(node_2)
+                C = Gmrf.kernel_block(Gmrf.gaussian_cov, cov_par, x_1, x_2)
+                S[np.ix_(dofs_1,dofs_2)] += WPhi_1.T.dot(C.dot(WPhi_2))
+        self.assertTrue(np.allclose(Sigma, S))
+        #
+        # Small tiles
+        # 
+        Sigma_tiled, _ = Gmrf.galerkin_covariance(Gmrf.gaussian_cov, cov_par,
+                                                  mesh, element, 
+                                                  max_memory=2**12)
+        self.assertTrue(np.allclose(Sigma_tiled, S))
+        #
+        # Mass matrix
+        # 
+        system = System(mesh, element)
+        M_sys = system.assemble(bilinear_forms=[(1,'u','v')])
+        self.assertTrue(np.allclose(M.toarray(), M_sys.toarray()))
+        
         
     def test_Q(self):
         # 
@@ -434,6 +510,307 @@ class TestGmrf(unittest.TestCase):
             #                               element=element)
             
     
+    def test_condition_pointwise(self):
+        n = 20
+        mu = np.linspace(0,1,n)
+        i_b, x_b = np.array([0,5,12]), np.array([1.,-1.,2.])
+        i_a = np.setdiff1d(np.arange(n), i_b)
+        Q = laplacian_precision(n, sparse=False)
+        Q_aa = Q[np.ix_(i_a,i_a)]
+        mu_agb = mu[i_a] - np.linalg.solve(Q_aa, 
+                                           Q[np.ix_(i_a,i_b)].dot(x_b-mu[i_b]))
+        S_aa = np.linalg.inv(Q_aa)
+        z = np.random.normal(size=(n-3,4))
+        for sparse in [True, False]:
+            X = Gmrf(mu=mu, precision=laplacian_precision(n, sparse=sparse))
+            #
+            # Conditional field
+            # 
+            X_a = X.condition((i_b, x_b))
+            self.assertTrue(np.allclose(X_a.mu(), mu_agb))
+            Q_cnd = X_a.Q()
+            if sp.isspmatrix(Q_cnd):
+                Q_cnd = Q_cnd.toarray()
+            self.assertTrue(np.allclose(Q_cnd, Q_aa))
+            #
+            # Conditional samples
+            #  
+            x = X.condition((i_b, x_b), output='sample', z=z)
+            self.assertEqual(x.shape, (n,4))
+            self.assertTrue(np.allclose(x[i_b], x_b[:,None]))
+            self.assertTrue(np.allclose(x[i_a], X_a.sample(z=z)))
+            #
+            # Conditional covariance (independent of the factor's ordering)
+            # 
+            x = X.condition((i_b, x_b), output='sample', z=np.eye(n-3))
+            V = x[i_a] - mu_agb[:,None]
+            self.assertTrue(np.allclose(V.dot(V.T), S_aa))
+            x = X.condition((i_b, x_b), output='sample', n_samples=7)
+            self.assertEqual(x.shape, (n,7))
+        
+        
+    def test_condition_soft(self):
+        n = 40
+        mu = np.linspace(0,1,n)
+        Q = laplacian_precision(n, sparse=False)
+        for k, adjacent in [(3,True), (30,True), (20,False)]:
+            #
+            # Observation matrix: averages of two entries
+            # 
+            i = np.random.randint(0,n-1,size=k)
+            j = i+1 if adjacent else np.random.randint(0,n,size=k)
+            A = sp.coo_matrix((0.5*np.ones(2*k), 
+                               (np.tile(np.arange(k),2), np.hstack([i,j]))),
+                              shape=(k,n)).tocsr()
+            e = np.random.rand(k)
+            R = 0.1*np.ones(k)
+            Ad = A.toarray()
+            Q_post = Q + Ad.T.dot(Ad)/0.1
+            mu_post = mu + np.linalg.solve(Q_post, 
+                                           Ad.T.dot(e-Ad.dot(mu))/0.1)
+            for sparse in [True, False]:
+                X = Gmrf(mu=mu, precision=laplacian_precision(n, sparse))
+                Y = X.condition((A,e,R), constraint_type='soft')
+                self.assertTrue(np.allclose(Y.mu(), mu_post))
+                Q_Y = Y.Q()
+                if sp.isspmatrix(Q_Y):
+                    Q_Y = Q_Y.toarray()
+                self.assertTrue(np.allclose(Q_Y, Q_post))
+                y = X.condition((A,e,0.1), constraint_type='soft', 
+                                output='sample', n_samples=5)
+                self.assertEqual(y.shape, (n,5))
+        #
+        # 2D Laplacian (reordered by CHOLMOD), few point observations 
+        # 
+        m = 10
+        T = laplacian_precision(m, sparse=False) - np.eye(m)
+        Q = sp.csc_matrix(np.kron(T, np.eye(m)) + np.kron(np.eye(m), T) + 
+                          0.1*np.eye(m**2))
+        k = 5
+        A = sp.csr_matrix((np.ones(k), (np.arange(k), [3,17,42,61,98])), 
+                          shape=(k,m**2))
+        e, R = np.random.rand(k), 0.2*np.ones(k)
+        Ad = A.toarray()
+        Q_post = Q.toarray() + Ad.T.dot(Ad)/0.2
+        mu_post = np.linalg.solve(Q_post, Ad.T.dot(e)/0.2)
+        Y = Gmrf(precision=Q).condition((A,e,R), constraint_type='soft')
+        self.assertTrue(np.allclose(Y.Q().toarray(), Q_post))
+        self.assertTrue(np.allclose(Y.mu(), mu_post))
+        
+        
+    def test_log_pdf(self):
+        n = 30
+        mu = np.random.rand(n)
+        Q = laplacian_precision(n, sparse=False)
+        S = np.linalg.inv(Q)
+        x = mu[:,None] + np.random.normal(size=(n,4))
+        log_p = multivariate_normal(mu, S).logpdf(x.T)
+        for sparse in [True, False]:
+            X = Gmrf(mu=mu, precision=laplacian_precision(n, sparse=sparse))
+            self.assertEqual(X.rank(), n)
+            self.assertTrue(np.allclose(X.log_pdf(x), log_p))
+            self.assertTrue(np.allclose(X.log_pdf(x[:,0]), log_p[0]))
+        X = Gmrf(mu=mu, covariance=S)
+        self.assertTrue(np.allclose(X.log_pdf(x, mode='covariance'), log_p))
+        #
+        # Degenerate covariance 
+        # 
+        B = np.random.rand(n,5)
+        S = B.dot(B.T)
+        X = Gmrf(mu=mu, covariance=S)
+        self.assertEqual(X.rank(), 5)
+        x = mu[:,None] + B.dot(np.random.normal(size=(5,3)))
+        log_p = multivariate_normal(mu, S, allow_singular=True).logpdf(x.T)
+        self.assertTrue(np.allclose(X.log_pdf(x, mode='covariance'), log_p))
+        #
+        # Intrinsic precision: first and second order random walks
+        #
+        x = mu[:,None] + np.random.normal(size=(n,4))
+        t = np.arange(n)
+        for order, V in [(1, np.ones(n)), (2, np.column_stack([1+0*t, t]))]:
+            D = np.diff(np.eye(n), n=order, axis=0)
+            Q = D.T.dot(D)
+            lmd = np.linalg.eigvalsh(Q)[order:]
+            r = x - mu[:,None]
+            log_p = -0.5*(n-order)*np.log(2*np.pi) + \
+                    0.5*np.sum(np.log(lmd)) - 0.5*np.sum(r*Q.dot(r), axis=0)
+            for Q_in in [Q, sp.csc_matrix(Q)]:
+                X = Gmrf(mu=mu, precision=Q_in, null_space=V)
+                self.assertEqual(X.rank(), n-order)
+                self.assertTrue(np.allclose(X.log_pdf(x), log_p))
+
+        
+    def test_marginal_variance(self):
+        #
+        # Sparse precision (2D Laplacian)
+        # 
+        m = 8
+        T = laplacian_precision(m, sparse=False) - np.eye(m)
+        Q = sp.csc_matrix(np.kron(T, np.eye(m)) + np.kron(np.eye(m), T) + 
+                          0.5*np.eye(m**2))
+        S = np.linalg.inv(Q.toarray())
+        X = Gmrf(precision=Q)
+        var, S_sel = X.marginal_variance(selected=True)
+        self.assertTrue(np.allclose(var, np.diag(S)))
+        i, j = Q.nonzero()
+        self.assertTrue(np.allclose(np.asarray(S_sel[i,j]).ravel(), S[i,j]))
+        #
+        # Full precision and covariance
+        # 
+        X = Gmrf(precision=Q.toarray())
+        self.assertTrue(np.allclose(X.marginal_variance(), np.diag(S)))
+        X = Gmrf(covariance=S)
+        self.assertTrue(np.allclose(X.marginal_variance(), np.diag(S)))
+
+
+    def test_takahashi(self):
+        #
+        # 2D Laplacian on a 60x60 grid (n=3600), natural ordering: the
+        # Cholesky factor fills in the band of width m.
+        #
+        m = 60
+        n = m**2
+        T = laplacian_precision(m, sparse=False) - np.eye(m)
+        Q = sp.kron(T, sp.eye(m)) + sp.kron(sp.eye(m), T) + 0.5*sp.eye(n)
+        ab = np.zeros((m+1,n))
+        for k in range(m+1):
+            ab[k,:n-k] = Q.diagonal(-k)
+        cb = linalg.cholesky_banded(ab, lower=True)
+        d = cb[0]**2
+        L = sp.diags([cb[k,:n-k]/cb[0,:n-k] for k in range(m+1)],
+                     -np.arange(m+1), format='csc')
+        S = Gmrf.takahashi(L, d)
+        self.assertEqual(S.nnz, L.nnz)
+        #
+        # Compare a few columns with direct solves
+        #
+        cols = np.array([0, 1, m, n//2, n-m-1, n-1])
+        E = np.zeros((n,len(cols)))
+        E[cols, np.arange(len(cols))] = 1
+        S_cols = spla.spsolve(Q.tocsc(), E)
+        for a, j in enumerate(cols):
+            i = S[:,j].nonzero()[0]
+            self.assertTrue(np.allclose(S[i,j].toarray().ravel(),
+                                        S_cols[i,a]))
+
+
+    def test_sample_blocks(self):
+        n = 20
+        mu = np.linspace(0,1,n)
+        X = Gmrf(mu=mu, precision=laplacian_precision(n))
+        blocks = list(X.sample_blocks(250, block_size=100, seed=3))
+        self.assertEqual([b.shape for b in blocks], 
+                         [(n,100), (n,100), (n,50)])
+        #
+        # Reproducible, serial or parallel
+        # 
+        x = np.hstack(blocks)
+        x_serial = np.hstack(list(X.sample_blocks(250, 100, seed=3)))
+        self.assertTrue(np.allclose(x, x_serial))
+        x_parallel = np.hstack(list(X.sample_blocks(250, 100, seed=3, 
+                                                    n_workers=2)))
+        self.assertTrue(np.allclose(x, x_parallel))
+        #
+        # Block samples equal the samples from the blocks' streams
+        # 
+        seeds = np.random.SeedSequence(3).spawn(3)
+        rng = np.random.default_rng(seeds[1])
+        self.assertTrue(np.allclose(blocks[1], 
+                                    X.sample(n_samples=100, rng=rng)))
+        
+        
+    def test_krylov_sample(self):
+        mesh = Mesh.newmesh(grid_size=(8,8))
+        mesh.refine()
+        element = QuadFE(2,'Q1')
+        builder = MaternPrecision(mesh, element, 2)
+        Q = builder.operator(10)
+        f = builder.factor(10)
+        P = f.P()
+        L = f.L()
+        LLt = (L*L.T).toarray()
+        self.assertTrue(np.allclose(Q.dot(np.eye(Q.shape[0]))[P][:,P], LLt))
+        #
+        # Compare with dense Q^{-1/2}*z 
+        # 
+        lmd, V = np.linalg.eigh(Q.dot(np.eye(Q.shape[0])))
+        X = Gmrf(precision=Q)
+        self.assertFalse(X.mode_supported('precision'))
+        z = np.random.normal(size=(X.n(),3))
+        v, info = X.krylov_sample(z=z, tol=1e-10)
+        self.assertTrue(info['error'] <= 1e-10)
+        self.assertTrue(np.allclose(v, V.dot(V.T.dot(z)/np.sqrt(lmd)[:,None]),
+                                    rtol=1e-6))
+        #
+        # Blocks of columns, convergence checks, single vector
+        #
+        inv_sqrt = lambda lmd: 1/np.sqrt(lmd)
+        for block_size, check_every in [(1,1), (2,3), (3,10)]:
+            w, info = Gmrf.lanczos(Q.dot, z, inv_sqrt, tol=1e-10,
+                                   max_iter=200, return_info=True,
+                                   block_size=block_size,
+                                   check_every=check_every)
+            self.assertEqual(info['n_iter'].shape, (3,))
+            self.assertTrue(np.allclose(w, v, rtol=1e-6))
+        w = Gmrf.lanczos(Q.dot, z[:,1], inv_sqrt, tol=1e-10, max_iter=200)
+        self.assertTrue(np.allclose(w, v[:,1], rtol=1e-6))
+        self.assertEqual(X.sample(n_samples=2, mode='krylov').shape, 
+                         (X.n(),2))
+        
+        
+    def test_lazy_factorization(self):
+        n = 20
+        Q = laplacian_precision(n, sparse=True)
+        S = np.linalg.inv(Q.toarray())
+        #
+        # Consistency check 
+        # 
+        X = Gmrf(precision=Q, covariance=S)
+        self.assertRaises(AssertionError, Gmrf, precision=Q, covariance=2*S)
+        #
+        # Factors are computed on first use and cached
+        # 
+        L = X.L()
+        self.assertTrue(L is X.L())
+        X = Gmrf(precision=-np.eye(n))
+        self.assertRaises(np.linalg.LinAlgError, X.sample, n_samples=1)
+        X = Gmrf(covariance=sp.diags([1.,-1.,1.]).tocsc())
+        self.assertRaisesRegex(Exception, 'not .* positive definite',
+                               X.sample, n_samples=1, mode='covariance')
+        #
+        # b = Q\mu
+        # 
+        mu = np.random.rand(n)
+        X = Gmrf(mu=mu, precision=Q)
+        self.assertTrue(np.allclose(Q.dot(X.b()), mu))
+        
+        
+    def test_tapered_covariance(self):
+        x = np.random.rand(400,2)
+        theta = 0.15
+        for M in [None, np.array([[2,0.5],[0.5,1]])]:
+            S = Gmrf.tapered_covariance(Gmrf.exponential_cov, {'l': 0.3}, x, 
+                                        theta, k=1, M=M)
+            self.assertTrue(sp.isspmatrix(S))
+            self.assertTrue(S.nnz < 0.5*400**2)
+            S_dense = Gmrf.kernel_block(Gmrf.exponential_cov, {'l': 0.3}, 
+                                        x, x, M=M)*\
+                      Gmrf.kernel_block(Gmrf.wendland_cov, 
+                                        {'theta': theta, 'k': 1}, x, x, M=M)
+            self.assertTrue(np.allclose(S.toarray(), S_dense))
+        #
+        # Sparse covariance field
+        # 
+        mesh = Mesh.newmesh(grid_size=(10,10))
+        mesh.refine()
+        X = Gmrf.from_covariance_kernel('matern', 
+                                        {'sgm': 1, 'nu': 1.5, 'l': 0.2}, 
+                                        mesh, taper=0.3)
+        self.assertTrue(sp.isspmatrix(X.Sigma()))
+        self.assertEqual(X.sample(n_samples=3, mode='covariance').shape, 
+                         (X.n(),3))
+        
+        
     def test_matern_precision(self):
         
         #
@@ -469,6 +846,220 @@ class TestGmrf(unittest.TestCase):
         """
         
         
+    def test_matern_precision_builder(self):
+        mesh = Mesh.newmesh(grid_size=(6,6))
+        mesh.refine()
+        element = QuadFE(2,'Q1')
+        system = System(mesh, element)
+        M = system.assemble(bilinear_forms=[(1,'u','v')]).tocsr()
+        m_lumped = np.array(M.sum(axis=1)).squeeze()
+        D_inv = np.diag(1/m_lumped)
+        builders = [MaternPrecision(mesh, element, alpha) for alpha in [1,2,3]]
+        for kappa, tau in [(1,None), (3,(1,0.2,2)), (2,lambda x,y: 1+x)]:
+            #
+            # Stiffness matrix 
+            # 
+            bf = [(kappa,'u','v')]
+            if type(tau) is tuple:
+                bf += [(tau[0],'ux','vx'),(tau[1],'uy','vx'),
+                       (tau[1],'ux','vy'),(tau[2],'uy','vy')]
+            else:
+                t = 1 if tau is None else tau
+                bf += [(t,'ux','vx'),(t,'uy','vy')]
+            G = system.assemble(bilinear_forms=bf).toarray()
+            self.assertTrue(np.allclose(builders[0].stiffness(kappa, 
+                                                              tau).toarray(),
+                                        G))
+            #
+            # Factors of Q = G, G*M^{-1}*G, G*M^{-1}*G*M^{-1}*G
+            # 
+            Q = G
+            for builder in builders:
+                f = builder.factor(kappa, tau)
+                P = f.P()
+                L = f.L()
+                self.assertTrue(np.allclose((L*L.T).toarray(), Q[P][:,P]))
+                Q = G.dot(D_inv).dot(Q)
+                
+                
+    def test_matern_precision_builder_large(self):
+        #
+        # More than 46340 dofs (257x257 grid of Q1 nodes), see Assembler
+        # 
+        tree = LinearQuadtree(grid_size=(256,256))
+        builder = MaternPrecision(tree, QuadFE(2,'Q1'), 2)
+        kappa = 3
+        n = 257**2
+        one = np.ones(n)
+        for tau in [None, lambda x,y: 1+x]:
+            #
+            # Constant functions are in the kernel of K(tau)
+            # 
+            G = builder.stiffness(kappa, tau)
+            self.assertEqual(G.shape, (n,n))
+            self.assertTrue(abs(G-G.T).max() < 1e-12)
+            Mone = G.dot(one)/kappa
+            self.assertTrue(np.all(Mone > 0))
+            self.assertTrue(np.isclose(Mone.sum(), 1))
+        #
+        # Q*1 = G*M^{-1}*G*1 = kappa^2*M*1
+        # 
+        Q = builder.operator(kappa)
+        self.assertTrue(np.allclose(Q.dot(one), kappa**2*Mone))
+        
+        
+class TestLowRank(unittest.TestCase):
+    """
+    Test low rank factorization of degenerate covariance matrices
+    """
+    def test_pivoted_cholesky(self):
+        x = np.random.rand(300,2)
+        S = Gmrf.kernel_block(Gmrf.gaussian_cov, {'l': 0.5}, x, x)
+        L = Gmrf.pivoted_cholesky(S, tol=1e-12)
+        self.assertTrue(L.shape[1] < 100)
+        self.assertTrue(np.abs(L.dot(L.T)-S).max() < 1e-8)
+        #
+        # Maximum rank
+        # 
+        L = Gmrf.pivoted_cholesky(S, max_rank=5)
+        self.assertEqual(L.shape, (300,5))
+        #
+        # Sample from degenerate covariance
+        # 
+        X = Gmrf(covariance=S)
+        L = Gmrf.pivoted_cholesky(S)
+        z = np.random.normal(size=(300,2))
+        self.assertTrue(np.allclose(X.sample(z=z, mode='covariance'), 
+                                    L.dot(z[:L.shape[1]])))
+        
+        
+class TestKL(unittest.TestCase):
+    """
+    Test truncated Karhunen-Loeve expansion
+    """
+    def test_KL(self):
+        mesh = Mesh.newmesh(grid_size=(8,8))
+        mesh.refine()
+        element = QuadFE(2,'Q1')
+        cov_fn, cov_par = Gmrf.gaussian_cov, {'l': 0.2}
+        #
+        # Covariance of nodal values and mass matrix
+        # 
+        dofhandler = DofHandler(mesh, element)
+        dofhandler.distribute_dofs()
+        x = dofhandler.dof_vertices()
+        S = Gmrf.kernel_block(cov_fn, cov_par, x, x) + 1e-8*np.eye(x.shape[0])
+        system = System(mesh, element)
+        M = system.assemble(bilinear_forms=[(1,'u','v')]).toarray()
+        X = Gmrf(covariance=S, mesh=mesh, element=element)
+        self.assertFalse(X.mode_supported('kl'))
+        #
+        # Compare with dense generalized eigendecomposition
+        # 
+        k = 10
+        lmd, V = X.KL(k)
+        lmd_dense = linalg.eigh(M.dot(S.dot(M)), M, eigvals_only=True)
+        self.assertTrue(np.allclose(lmd, lmd_dense[::-1][:k]))
+        self.assertTrue(np.allclose(V.T.dot(M.dot(V)), np.eye(k)))
+        self.assertTrue(np.allclose(M.dot(S.dot(M.dot(V))), 
+                                    M.dot(V).dot(np.diag(lmd))))
+        #
+        # Sample
+        # 
+        self.assertTrue(X.mode_supported('kl'))
+        z = np.random.normal(size=(k,3))
+        self.assertTrue(np.allclose(X.sample(z=z, mode='kl'), 
+                                    V.dot(np.diag(np.sqrt(lmd)).dot(z))))
+        self.assertEqual(X.sample(n_samples=5, mode='kl').shape, (X.n(),5))
+        
+        
+class TestHMatrix(unittest.TestCase):
+    """
+    Test hierarchical matrix approximation of covariance matrices
+    """
+    def test_dot(self):
+        mesh = Mesh.newmesh(grid_size=(2,2))
+        x = np.random.rand(2000,2)
+        cov_par = {'l': 0.2}
+        H = HMatrix(Gmrf.exponential_cov, cov_par, mesh, x=x, tol=1e-6)
+        S = Gmrf.kernel_block(Gmrf.exponential_cov, cov_par, x, x)
+        #
+        # Compressed and accurate
+        # 
+        self.assertTrue(H.n_entries() < 0.5*2000**2)
+        b = np.random.rand(2000,2)
+        self.assertTrue(np.linalg.norm(H.dot(b)-S.dot(b)) < 
+                        1e-5*np.linalg.norm(S.dot(b)))
+        self.assertTrue(np.allclose(H.diagonal(), np.diag(S)))
+        
+        
+    def test_solve_and_sample(self):
+        mesh = Mesh.newmesh(grid_size=(10,10))
+        mesh.refine()
+        X = Gmrf.from_covariance_kernel('exponential', {'l': 0.2}, mesh, 
+                                        hierarchical=True)
+        H = X.Sigma()
+        S = H.toarray()
+        self.assertTrue(np.allclose(S, S.T))
+        #
+        # Solve
+        # 
+        b = np.random.rand(X.n())
+        self.assertTrue(np.allclose(S.dot(H.solve(b, tol=1e-10)), b))
+        #
+        # Sample 
+        # 
+        z = np.random.normal(size=(X.n(),2))
+        lmd, V = np.linalg.eigh(S)
+        S_sqrt = V.dot(np.diag(np.sqrt(lmd)).dot(V.T))
+        self.assertTrue(np.allclose(X.sample(z=z, mode='covariance'), 
+                                    S_sqrt.dot(z), atol=1e-6))
+        
+        
+class TestCirculantEmbedding(unittest.TestCase):
+    """
+    Test FFT sampling of stationary fields on uniform grids
+    """
+    def test_lattice(self):
+        mesh = Mesh.newmesh(grid_size=(4,3))
+        mesh.refine()
+        ij, m, h = CirculantEmbedding.lattice(mesh)
+        self.assertEqual(m, (5,4))
+        self.assertTrue(np.allclose(h, (0.25,1/3)))
+        #
+        # Hanging nodes: no uniform grid
+        # 
+        mesh.root_node().children[0,0].mark(1)
+        mesh.refine(1)
+        self.assertIsNone(CirculantEmbedding.lattice(mesh))
+        
+        
+    def test_dot_and_sample(self):
+        mesh = Mesh.newmesh(grid_size=(8,6))
+        mesh.refine()
+        dofhandler = DofHandler(mesh, QuadFE(2,'Q1'))
+        dofhandler.distribute_dofs()
+        x = dofhandler.dof_vertices()
+        for cov_fn, cov_par in [(Gmrf.exponential_cov, {'l': 0.2}), 
+                                (Gmrf.gaussian_cov, {'l': 0.1})]:
+            C = CirculantEmbedding(cov_fn, cov_par, mesh)
+            self.assertTrue(C.exact)
+            S = Gmrf.kernel_block(cov_fn, cov_par, x, x)
+            self.assertTrue(np.allclose(C.toarray(), S))
+            self.assertTrue(np.allclose(C.diagonal(), np.diag(S)))
+        #
+        # Sample covariance 
+        # 
+        X = Gmrf.from_covariance_kernel('exponential', {'l': 0.2}, mesh, 
+                                        circulant=None)
+        self.assertTrue(isinstance(X.Sigma(), CirculantEmbedding))
+        np.random.seed(0)
+        v = X.sample(n_samples=20001, mode='covariance')
+        self.assertEqual(v.shape, (X.n(), 20001))
+        S = Gmrf.kernel_block(Gmrf.exponential_cov, {'l': 0.2}, x, x)
+        self.assertTrue(np.abs(np.cov(v)-S).max() < 0.1)
+        
+        
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -4,7 +4,8 @@ Created on Oct 23, 2016
 @author: hans-werner
 '''
 import unittest
-from mesh import Mesh, Node, BiCell, QuadCell, TriCell, Edge, Vertex
+from mesh import Mesh, Node, BiCell, QuadCell, TriCell, Edge, Vertex, \
+                 LinearQuadtree
 from plot import Plot
 import matplotlib.pyplot as plt
 import numpy as np
@@ -83,8 +84,70 @@ class TestMesh(unittest.TestCase):
     
     
     def test_mesh_get_number_of_cells(self):
-        pass
-    
+        mesh = Mesh.newmesh(grid_size=(2,2))
+        mesh.refine()
+        self.assertEqual(mesh.n_cells(), 4)
+        self.assertEqual(mesh.n_cells(flag=1), 0)
+        mesh.root_node().mark(1)
+        mesh.root_node().children[0,0].mark(1)
+        self.assertEqual(mesh.n_cells(flag=1), 1)
+        mesh.refine()
+        self.assertEqual(mesh.n_cells(), 16)
+        
+        
+    def test_mesh_nodes(self):
+        mesh = Mesh.newmesh()
+        mesh.refine()
+        count = mesh.root_node().modification_count()
+        leaves = mesh.nodes()
+        self.assertEqual(leaves, mesh.root_node().find_leaves())
+        #
+        # Cached list is reused while the tree is unchanged 
+        # 
+        self.assertEqual(mesh.nodes(), leaves)
+        self.assertEqual(mesh.root_node().modification_count(), count)
+        #
+        # Splitting, marking and merging update the leaves 
+        # 
+        leaves[0].split()
+        self.assertEqual(len(mesh.nodes()), 7)
+        leaves[0].children['SW'].mark(1)
+        leaves[0].mark(1)
+        mesh.root_node().mark(1)
+        self.assertEqual(mesh.nodes(flag=1), [leaves[0].children['SW']])
+        leaves[0].merge()
+        self.assertEqual(mesh.nodes(flag=1), [leaves[0]])
+        self.assertEqual(mesh.nodes(), leaves)
+        self.assertTrue(mesh.root_node().modification_count() > count)
+    
+        
+    def test_mesh_node_containing_points(self):
+        mesh = Mesh.newmesh(grid_size=(2,2))
+        mesh.refine()
+        mesh.root_node().children[0,0].split()
+        leaves = mesh.nodes()
+        #
+        # Random points
+        # 
+        x = np.random.rand(100,2)
+        nodes = mesh.node_containing_points(x)
+        for k in range(100):
+            self.assertTrue(nodes[k].quadcell().contains_point(x[k:k+1]).all())
+        #
+        # Points on edges 
+        # 
+        x = np.array([[0.5,0.5],[0.25,0.1],[1,1],[2,2]])
+        self.assertEqual(list(mesh.locate_points(x)), [6,1,6,-1])
+        self.assertEqual(list(mesh.locate_points(x, tie_break='lower')), 
+                         [3,0,6,-1])
+        self.assertEqual(mesh.node_containing_points((0.3,0.3)), leaves[3])
+        #
+        # Submesh
+        # 
+        mesh.root_node().mark(1)
+        mesh.root_node().children[0,0].mark(1)
+        self.assertEqual(list(mesh.locate_points(x, flag=1)), [0,0,-1,-1])
+        
         
     def test_mesh_root_node(self):
         pass
@@ -254,6 +317,156 @@ class TestMesh(unittest.TestCase):
         pass
     
      
+class TestLinearQuadtree(unittest.TestCase):
+    """
+    Test LinearQuadtree class
+    """
+    def make_meshes(self):
+        """
+        Return a list of (locally refined) balanced meshes
+        """
+        meshes = []
+        for grid_size in [None, (3,2)]:
+            mesh = Mesh.newmesh(box=[0,2,0,1], grid_size=grid_size)
+            mesh.refine()
+            mesh.refine()
+            leaves = mesh.root_node().find_leaves()
+            leaves[3].mark(1)
+            leaves[5].mark(1)
+            mesh.refine(1)
+            mesh.balance()
+            meshes.append(mesh)
+        return meshes
+    
+    
+    def test_from_mesh(self):
+        for mesh in self.make_meshes():
+            tree = LinearQuadtree.from_mesh(mesh)
+            leaves = mesh.root_node().find_leaves()
+            self.assertEqual(tree.n_cells(), len(leaves))
+            #
+            # Leaves in the same order
+            # 
+            boxes = np.array([leaf.quadcell().box() for leaf in leaves])
+            self.assertTrue(np.allclose(tree.boxes(), boxes))
+            self.assertTrue(np.all(np.diff(tree.anchors())>0),\
+                            'Leaves should be sorted.')
+            self.assertTrue(np.allclose(tree.depths(), \
+                                        [leaf.depth for leaf in leaves]))
+    
+    
+    def test_to_mesh(self):
+        for mesh in self.make_meshes():
+            tree = LinearQuadtree.from_mesh(mesh)
+            tree_copy = LinearQuadtree.from_mesh(tree.to_mesh())
+            self.assertTrue(np.all(tree.keys()==tree_copy.keys()))
+            self.assertTrue(np.all(tree.levels()==tree_copy.levels()))
+            
+            
+    def test_encode_decode(self):
+        i = np.array([0, 1, 2, 5, 7, 2**20+3])
+        j = np.array([0, 3, 1, 6, 7, 2**25+1])
+        keys = LinearQuadtree.interleave(i,j)
+        self.assertEqual(list(keys[:3]), [0, 11, 6])
+        ii, jj = LinearQuadtree.deinterleave(keys)
+        self.assertTrue(np.all(ii==i) and np.all(jj==j))
+        
+        tree = LinearQuadtree(grid_size=(3,2))
+        levels = np.array([0, 1, 2, 3, 3])
+        i = np.array([2, 5, 11, 23, 0])
+        j = np.array([1, 3, 7, 15, 0])
+        keys = tree.encode(i, j, levels)
+        self.assertEqual(keys[0], 5)
+        ii, jj = tree.decode(keys, levels)
+        self.assertTrue(np.all(ii==i) and np.all(jj==j))
+        #
+        # Parents and children
+        # 
+        pi, pj = tree.decode(tree.parent(keys[1:]), levels[1:]-1)
+        self.assertTrue(np.all(pi==i[1:]//2) and np.all(pj==j[1:]//2))
+        ci, cj = tree.decode(tree.children(keys[0]), levels[0]+1)
+        self.assertEqual(list(ci), [4,5,4,5])
+        self.assertEqual(list(cj), [2,2,3,3])
+        
+    
+    def test_neighbors(self):
+        for mesh in self.make_meshes():
+            leaves = mesh.root_node().find_leaves()
+            position = dict((leaf,i) for i,leaf in enumerate(leaves))
+            tree = LinearQuadtree.from_mesh(mesh)
+            for direction in ['N','S','E','W','SW','SE','NW','NE']:
+                nb = tree.neighbors(direction)
+                for i in range(len(leaves)):
+                    nb_node = leaves[i].find_neighbor(direction)
+                    if nb_node is None or nb_node.has_children():
+                        self.assertEqual(nb[i], -1)
+                    else:
+                        self.assertEqual(nb[i], position[nb_node])
+                        
+    
+    def test_adjacency(self):
+        tree = LinearQuadtree()
+        tree.refine()
+        rows, cols = tree.adjacency()
+        self.assertEqual(len(rows), 8)
+        rows, cols = tree.adjacency(corners=True)
+        self.assertEqual(len(rows), 12)
+        marked = np.array([True, False, False, False])
+        tree.refine(marked)
+        #
+        # SE child of SW cell is adjacent to SE cell
+        # 
+        rows, cols = tree.adjacency()
+        self.assertTrue(4 in cols[rows==1])
+        self.assertFalse(4 in cols[rows==0])
+
+
+    def test_is_balanced(self):
+        for mesh in self.make_meshes():
+            self.assertTrue(LinearQuadtree.from_mesh(mesh).is_balanced())
+        #
+        # Refine the NE grandchild of the SW cell: adjacent to level 1 cells
+        #
+        tree = LinearQuadtree()
+        tree.refine()
+        tree.refine(np.array([True, False, False, False]))
+        self.assertTrue(tree.is_balanced())
+        marked = np.zeros(tree.n_cells(), dtype=bool)
+        marked[3] = True
+        tree.refine(marked)
+        self.assertFalse(tree.is_balanced())
+        self.assertFalse(tree.to_mesh().is_balanced())
+
+        
+    def test_refine_coarsen(self):
+        for grid_size in [None, (3,2)]:
+            mesh = Mesh.newmesh(box=[0,2,0,1], grid_size=grid_size)
+            tree = LinearQuadtree(box=[0,2,0,1], grid_size=grid_size)
+            mesh.refine()
+            if grid_size is None:
+                tree.refine()
+            mesh.refine()
+            tree.refine()
+            leaves = mesh.root_node().find_leaves()
+            leaves[3].split()
+            leaves[5].split()
+            marked = np.zeros(tree.n_cells(), dtype=bool)
+            marked[[3,5]] = True
+            tree.refine(marked)
+            self.assertTrue(np.all(tree.keys()==\
+                                   LinearQuadtree.from_mesh(mesh).keys()))
+            #
+            # Coarsen: only complete groups of siblings are merged
+            # 
+            marked = np.ones(tree.n_cells(), dtype=bool)
+            tree.coarsen(marked)
+            self.assertEqual(tree.max_level(), 2 if grid_size is None else 1)
+            tree.coarsen(np.ones(tree.n_cells(), dtype=bool))
+            tree.coarsen(np.ones(tree.n_cells(), dtype=bool))
+            n_coarse = 1 if grid_size is None else 6
+            self.assertEqual(tree.n_cells(), n_coarse)
+            
+    
 class TestNode(unittest.TestCase):
     """
     Test Node Class
@@ -327,6 +540,17 @@ class TestNode(unittest.TestCase):
         self.assertEqual(nw_grandchild.find_neighbor('NE'),
                          node.children['NW'].children['SE'],
                          'Neighbor should be the NW-SE grandchild.')
+        self.assertEqual(nw_grandchild.find_neighbor('N'),
+                         node.children['NW'].children['SW'],
+                         'Neighbor should be the NW-SW grandchild.')
+        #
+        # Merged nodes are no longer neighbors
+        # 
+        node.children['NW'].merge()
+        self.assertEqual(nw_grandchild.find_neighbor('N'), node.children['NW'],
+                         'Neighbor should be NW child of ROOT cell.')
+        self.assertEqual(nw_grandchild.find_neighbor('NE'), None,
+                         'Neighbor should be None.')
     
         
     def test_node_traverse_tree(self):